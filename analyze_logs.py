@@ -0,0 +1,71 @@
+import sys
+import argparse
+import os
+import csv
+
+from utils.logger import logger
+from utils.elastix_logs import collect_runs, aggregate_resolutions, aggregate_runs
+
+def write_columns(columns, output_csv_path):
+    '''
+    Write columnar arrays to a csv file.
+
+    Args:
+        columns ('dict'): Column name -> numpy array, all with the same length.
+        output_csv_path ('str'): Path to the output csv file.
+
+    Returns:
+        None
+    '''
+    with open(output_csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(list(columns))
+        writer.writerows(zip(*[values.tolist() for values in columns.values()]))
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--output_path', type=str, default='output', help='root dir of the experiments outputs')
+    parser.add_argument('--experiment_name', type=str, nargs='*', default=None, help='experiments to analyze, all of them if not given')
+    parser.add_argument('--report_path', type=str, default=None, help='dir to write the runs, resolutions and iterations csv files to')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_path):
+        logger.error(f"Path {args.output_path} does not exist")
+        sys.exit(1)
+
+    runs, resolutions, iterations = collect_runs(args.output_path, experiments=args.experiment_name)
+
+    if len(runs['experiment']) == 0:
+        logger.error(f"No elastix runs found in {args.output_path} directory.")
+        sys.exit(1)
+
+    logger.info(f"Found {len(runs['experiment'])} runs, {len(resolutions['run'])} resolutions and {len(iterations['run'])} iterations.")
+
+    run_summary = aggregate_runs(runs)
+    resolution_summary = aggregate_resolutions(runs, resolutions)
+
+    # log the total runtime of every configuration
+    for idx in range(len(run_summary['experiment'])):
+        print(f"{run_summary['experiment'][idx]} / {run_summary['reg_params_key'][idx]}: "
+              f"{run_summary['subjects'][idx]} subjects ({run_summary['valid_runs'][idx]} with a total time), "
+              f"mean {run_summary['mean_time'][idx]:.1f}s, median {run_summary['median_time'][idx]:.1f}s, max {run_summary['max_time'][idx]:.1f}s")
+
+    # log where the time and the metric improvement go for every resolution
+    for idx in range(len(resolution_summary.get('experiment', []))):
+        print(f"  {resolution_summary['reg_params_key'][idx]} p{resolution_summary['level'][idx]} R{resolution_summary['resolution'][idx]}: "
+              f"{resolution_summary['iterations'][idx]:.0f} it in {resolution_summary['time'][idx]:.1f}s, "
+              f"gain {resolution_summary['metric_gain'][idx]:.4f} ({resolution_summary['gain_per_second'][idx]:.2e}/s), "
+              f"95% of the gain after {resolution_summary['iterations_to_95'][idx]:.0f} it")
+
+    if args.report_path:
+        os.makedirs(args.report_path, exist_ok=True)
+        write_columns(run_summary, os.path.join(args.report_path, 'runs_summary.csv'))
+        write_columns(resolution_summary, os.path.join(args.report_path, 'resolutions_summary.csv'))
+        write_columns({**{f'run_{name}': values[resolutions['run']] for name, values in runs.items()}, **resolutions},
+                      os.path.join(args.report_path, 'resolutions.csv'))
+        write_columns(iterations, os.path.join(args.report_path, 'iterations.csv'))
+        logger.info(f"Reports written to {args.report_path}")
@@ -0,0 +1,115 @@
+import sys
+import argparse
+import os
+import csv
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utils.catalog import load_catalog
+from utils.logger import logger
+from utils.landmarks import read_keypoints
+from utils.metrics import compute_landmark_TRE
+from utils.spatial import landmarks_to_physical, local_mean_error, find_error_clusters, build_boundary_tree, boundary_distance, stratify_errors, BOUNDARY_BINS
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--experiment_name', type=str, nargs='*', default=None, help='experiments to analyze, all of them if not given')
+    parser.add_argument('--reg_params_key', type=str, nargs='*', default=None, help='registration parameters keys to analyze, all of them if not given')
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for the experiments outputs')
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data with the landmarks, the lung masks and description.json')
+    parser.add_argument('--radius', type=float, default=15.0, help='neighbourhood radius (mm) of the local mean error and of the error clusters')
+    parser.add_argument('--cluster_threshold', type=float, default=None, help='TRE (mm) above which a landmark can be part of an error cluster, the 90th percentile of every registration by default')
+    parser.add_argument('--min_cluster_size', type=int, default=3, help='minimum number of landmarks of an error cluster')
+    parser.add_argument('--bins', type=float, nargs='*', default=None, help='edges (mm) of the distance to the lung boundary bins, negative outside the lungs')
+    parser.add_argument('--report_path', type=str, default='spatial_errors', help='dir the per landmark and the stratified csv files are written to')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    bins = [-np.inf, *args.bins, np.inf] if args.bins else BOUNDARY_BINS
+
+    # scan the dataset and the output trees once, the registrations are linked to their subjects
+    catalog = load_catalog(args.dataset_path, output_path=args.output_path, experiments=args.experiment_name)
+
+    landmark_rows, strata_rows, cluster_rows = [], [], []
+    all_distances, all_errors = {}, {}
+
+    for subject in catalog.sorted_subjects():
+        registrations = [
+            registration for registration in subject.registrations if registration.transformed_points
+            and (not args.experiment_name or registration.experiment in args.experiment_name)
+            and (not args.reg_params_key or registration.reg_params_key in args.reg_params_key)]
+
+        if not registrations or not subject.exhale_keypoints or not subject.inhale_keypoints:
+            continue
+
+        voxel_dim = tuple(subject.metadata['voxel_dim'])
+
+        # the landmarks are in the fixed (inhale) space, the same positions for every experiment, so the
+        # landmark tree and the distances to the lung boundary are computed once per subject
+        inhale_keypoints = read_keypoints(subject.inhale_keypoints)
+        points = landmarks_to_physical(inhale_keypoints, voxel_dim)
+        tree = cKDTree(points)
+
+        if subject.inhale_mask:
+            import SimpleITK as sitk
+
+            boundary_tree, mask = build_boundary_tree(sitk.GetArrayFromImage(sitk.ReadImage(subject.inhale_mask)), voxel_dim)
+            distances = boundary_distance(inhale_keypoints, voxel_dim, boundary_tree, mask, index_base=subject.index_base)
+        else:
+            logger.warning(f"No inhale lung mask found for {subject.name}, its landmarks are not stratified.")
+            distances = np.full(len(points), np.nan)
+
+        for registration in registrations:
+            name = f'{registration.experiment}/{registration.reg_params_key}'
+            errors = compute_landmark_TRE(registration.transformed_points, subject.exhale_keypoints, voxel_dim)
+
+            local_error, neighbours = local_mean_error(points, errors, args.radius, tree=tree)
+            labels, clusters = find_error_clusters(points, errors, args.radius, threshold=args.cluster_threshold, min_size=args.min_cluster_size, tree=tree)
+
+            for idx in range(len(errors)):
+                landmark_rows.append([
+                    registration.experiment, registration.reg_params_key, subject.name, idx, *points[idx], errors[idx],
+                    local_error[idx], neighbours[idx], distances[idx], labels[idx]])
+
+            for label, cluster in enumerate(clusters):
+                cluster_rows.append([
+                    registration.experiment, registration.reg_params_key, subject.name, label, cluster['size'],
+                    cluster['mean_error'], cluster['max_error'], *cluster['centroid']])
+
+            print(f"{name} {subject.name}: mean TRE {errors.mean():.3f} mm, max local mean TRE {local_error.max():.3f} mm, "
+                  f"{len(clusters)} error clusters {[cluster['size'] for cluster in clusters]}")
+
+            valid = ~np.isnan(distances)
+            all_distances.setdefault(name, []).append(distances[valid])
+            all_errors.setdefault(name, []).append(errors[valid])
+
+    if not landmark_rows:
+        logger.error(f"No transformed points found in {args.output_path} for the subjects of {args.dataset_path}.")
+        sys.exit(1)
+
+    # the errors of all the subjects of a configuration are stratified together
+    for name in all_distances:
+        strata = stratify_errors(np.concatenate(all_distances[name]), np.concatenate(all_errors[name]), bins)
+        experiment, reg_params_key = name.split('/', 1)
+        print(f"\n{name}, TRE by distance to the lung boundary:")
+        for row in zip(*strata.values()):
+            strata_rows.append([experiment, reg_params_key, *row])
+            print(f"  [{row[0]:g}, {row[1]:g}) mm: {row[2]} landmarks, mean {row[3]:.3f} mm, median {row[4]:.3f} mm, p95 {row[5]:.3f} mm")
+
+    os.makedirs(args.report_path, exist_ok=True)
+
+    reports = {
+        'spatial_landmark_results.csv': (['experiment', 'reg_params_key', 'sample_name', 'landmark', 'x', 'y', 'z', 'tre', 'local_mean_tre', 'neighbours', 'boundary_distance', 'cluster'], landmark_rows),
+        'spatial_cluster_results.csv': (['experiment', 'reg_params_key', 'sample_name', 'cluster', 'size', 'mean_tre', 'max_tre', 'x', 'y', 'z'], cluster_rows),
+        'spatial_boundary_results.csv': (['experiment', 'reg_params_key', 'bin_low', 'bin_high', 'count', 'mean_tre', 'median_tre', 'p95_tre'], strata_rows),
+    }
+    for filename, (header, rows) in reports.items():
+        with open(os.path.join(args.report_path, filename), 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    logger.info(f"Spatial error analysis written to {args.report_path}")
@@ -0,0 +1,88 @@
+import sys
+import argparse
+import os
+import csv
+import shutil
+import tempfile
+
+from utils.logger import logger
+from utils.benchmark import measure_peak_memory
+
+# the arguments of every benchmarked script, {split} is a copy of the dataset split and {output} a scratch folder
+SCRIPT_ARGS = {
+    'segment.py': ['--dataset_path', '{split}'],
+    'preprocess.py': ['--dataset_path', '{split}', '--output_path', '{output}'],
+}
+
+def run_benchmark(scripts, dataset_path, repo_path):
+    '''
+    Run the scripts of a repository on a scratch copy of a dataset split (segment.py writes the masks next to
+    the volumes) and measure their peak memory.
+
+    Args:
+        scripts ('list'): Script names, keys of SCRIPT_ARGS.
+        dataset_path ('str'): Dataset split to copy.
+        repo_path ('str'): Repository the scripts are run from.
+
+    Returns:
+        results ('dict'): Script -> measure_peak_memory result.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        split = os.path.join(scratch, 'dataset', os.path.basename(os.path.normpath(dataset_path)))
+        shutil.copytree(dataset_path, split)
+        description_path = os.path.join(os.path.dirname(os.path.normpath(dataset_path)), 'description.json')
+        if os.path.exists(description_path):
+            shutil.copy2(description_path, os.path.join(scratch, 'dataset', 'description.json'))
+
+        for script in scripts:
+            args = [arg.format(split=split, output=os.path.join(scratch, 'output')) for arg in SCRIPT_ARGS[script]]
+            results[script] = measure_peak_memory(script, args, repo_path=repo_path)
+
+    return results
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='dataset split the scripts are run on, a scratch copy is used')
+    parser.add_argument('--scripts', type=str, nargs='*', default=list(SCRIPT_ARGS), choices=list(SCRIPT_ARGS), help='scripts to benchmark')
+    parser.add_argument('--baseline_path', type=str, default=None, help='another checkout of the repository to compare with, e.g. created with git worktree add')
+    parser.add_argument('--report_path', type=str, default=None, help='csv file to write the peak memory to')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dataset_path):
+        logger.error(f"Path {args.dataset_path} does not exist")
+        sys.exit(1)
+
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+    logger.info(f"Measuring the peak memory of {args.scripts} on {args.dataset_path}...")
+
+    results = run_benchmark(args.scripts, args.dataset_path, repo_path)
+    baseline = run_benchmark(args.scripts, args.dataset_path, args.baseline_path) if args.baseline_path else {}
+
+    def describe(memory):
+        if memory is None:
+            return 'failed'
+        return f"{memory['traced_mb']:.0f} MB traced" + (f", {memory['rss_mb']:.0f} MB resident" if memory['rss_mb'] is not None else '')
+
+    rows = []
+    for script, memory in results.items():
+        line = f"{script}: {describe(memory)}"
+        row = [script] + ([memory['traced_mb'], memory['rss_mb']] if memory else [None, None])
+
+        if script in baseline:
+            line += f", baseline {describe(baseline[script])}"
+            row += [baseline[script]['traced_mb'], baseline[script]['rss_mb']] if baseline[script] else [None, None]
+
+        rows.append(row)
+        print(line)
+
+    if args.report_path:
+        with open(args.report_path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['script', 'traced_mb', 'rss_mb'] + (['baseline_traced_mb', 'baseline_rss_mb'] if baseline else []))
+            writer.writerows(rows)
+        logger.info(f"Peak memory written to {args.report_path}")
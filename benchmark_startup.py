@@ -0,0 +1,59 @@
+import sys
+import argparse
+import os
+import csv
+from glob import glob
+
+from utils.logger import logger
+from utils.benchmark import benchmark_scripts, HEAVY_MODULES
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--scripts', type=str, nargs='*', default=None, help='scripts to benchmark, all the command line scripts of the repository by default')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of every script, the median is reported')
+    parser.add_argument('--baseline_path', type=str, default=None, help='another checkout of the repository to compare with, e.g. created with git worktree add')
+    parser.add_argument('--report_path', type=str, default=None, help='csv file to write the startup times to')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+
+    # the scripts are run with --help, only the ones with an argument parser exit right after their imports
+    scripts = args.scripts or sorted(
+        os.path.basename(path) for path in glob(os.path.join(repo_path, '*.py'))
+        if 'argparse' in open(path).read() and os.path.basename(path) != os.path.basename(__file__))
+
+    if not scripts:
+        logger.error("No scripts to benchmark.")
+        sys.exit(1)
+
+    logger.info(f"Benchmarking the startup of {len(scripts)} scripts ({args.repeat} runs each)...")
+    results = benchmark_scripts(scripts, repo_path=repo_path, repeat=args.repeat)
+    baseline = benchmark_scripts(scripts, repo_path=args.baseline_path, repeat=args.repeat) if args.baseline_path else {}
+
+    # one column per heavy package, the cumulative import time of the package or empty if the script does not import it
+    rows = []
+    for script, result in results.items():
+        heavy_modules = ', '.join(f'{package} {seconds:.2f}s' for package, seconds in result['heavy_modules'].items()) or '-'
+        row = [script, result['seconds']] + [result['heavy_modules'].get(package, '') for package in HEAVY_MODULES]
+        line = f"{script}: {result['seconds']:.3f}s (imports {heavy_modules})"
+
+        if script in baseline:
+            row.extend([baseline[script]['seconds'], ' '.join(baseline[script]['heavy_modules'])])
+            line += f", baseline {baseline[script]['seconds']:.3f}s ({baseline[script]['seconds'] / result['seconds']:.1f}x)"
+
+        rows.append(row)
+        print(line)
+
+    total = sum(result['seconds'] for result in results.values())
+    print(f"\nTotal startup time: {total:.3f}s" + (f", baseline {sum(result['seconds'] for result in baseline.values()):.3f}s" if baseline else ''))
+
+    if args.report_path:
+        with open(args.report_path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['script', 'seconds'] + [f'{package}_seconds' for package in HEAVY_MODULES] + (['baseline_seconds', 'baseline_heavy_modules'] if baseline else []))
+            writer.writerows(rows)
+        logger.info(f"Startup times written to {args.report_path}")
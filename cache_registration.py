@@ -0,0 +1,35 @@
+import sys
+import argparse
+import os
+
+from utils.logger import logger
+from utils.cache import store
+from utils.checkpoint import is_resumed
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cache_dir', type=str, required=True, help='registration cache directory')
+    parser.add_argument('--key', type=str, required=True, help='cache key of the registration, written by create_script.py')
+    parser.add_argument('--elastix_output_dir', type=str, required=True, help='elastix output directory of the registration')
+    parser.add_argument('--points_output_dir', type=str, default=None, help='transformix output directory of the inhale keypoints')
+    parser.add_argument('--input_points', type=str, default=None, help='inhale keypoints file the points were transformed from')
+    parser.add_argument('--transform_count', type=int, default=None, help='number of TransformParameters files of a finished registration')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.exists(args.elastix_output_dir):
+        logger.error(f"Path {args.elastix_output_dir} does not exist")
+        sys.exit(1)
+
+    # the transforms of a resumed registration are chained through its checkpoints, they are not cached
+    if is_resumed(args.elastix_output_dir):
+        logger.warning(f"Registration {args.elastix_output_dir} was resumed from a checkpoint, it is not cached.")
+        sys.exit(0)
+
+    if store(args.cache_dir, args.key, args.elastix_output_dir, args.points_output_dir, args.transform_count, args.input_points):
+        logger.info(f"Registration {args.elastix_output_dir} cached as {args.key}")
+    else:
+        logger.warning(f"Registration {args.elastix_output_dir} did not finish, it is not cached.")
@@ -0,0 +1,74 @@
+import sys
+import argparse
+import os
+
+from utils.logger import logger
+from utils.storage import compact_key, restore_key, gc_store, PRUNE_POLICIES, RUN_KINDS, STORE_DIRNAME
+
+def tree_usage(path):
+    '''
+    Number of files and bytes of a directory tree, the inodes and the disk the outputs take.
+    '''
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.lstat(os.path.join(root, name)).st_size
+    return files, size
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--output_path', type=str, default='output', help='root dir of the experiments outputs, the packs are stored in <output_path>/.store')
+    parser.add_argument('--experiment_name', type=str, nargs='*', default=None, help='experiments to compact, all of them if not given')
+    parser.add_argument('--reg_params_key', type=str, nargs='*', default=None, help='registration parameters keys to compact, all of them if not given')
+    parser.add_argument('--policy', type=str, default='default', choices=list(PRUNE_POLICIES), help='files dropped from the runs: keep nothing extra, default drops the per resolution transforms and result images, minimal also drops the IterationInfo files and every result image')
+    parser.add_argument("--restore", action='store_true', help='if True, the compacted runs are extracted back to the disk instead')
+    parser.add_argument("--gc", action='store_true', help='if True, the blobs no run refers to anymore are removed from the packs')
+    parser.add_argument("--dry_run", action='store_true', help='if True, only report what would be compacted')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_path):
+        logger.error(f"Path {args.output_path} does not exist")
+        sys.exit(1)
+
+    # the experiment keys, <output_path>/<experiment>/<key> with images, points or labels folders
+    experiments = args.experiment_name or sorted(name for name in os.listdir(args.output_path) if name != STORE_DIRNAME and os.path.isdir(os.path.join(args.output_path, name)))
+    key_dirs = []
+    for experiment in experiments:
+        experiment_dir = os.path.join(args.output_path, experiment)
+        for key in sorted(os.listdir(experiment_dir)) if os.path.isdir(experiment_dir) else []:
+            if args.reg_params_key and key not in args.reg_params_key:
+                continue
+            if any(os.path.isdir(os.path.join(experiment_dir, key, kind)) for kind in RUN_KINDS):
+                key_dirs.append(os.path.join(experiment_dir, key))
+
+    files_before, bytes_before = tree_usage(args.output_path)
+
+    if args.restore:
+        restored = sum(restore_key(key_dir) for key_dir in key_dirs)
+        logger.info(f"Restored {restored} files of {len(key_dirs)} experiment keys.")
+    else:
+        totals = {}
+        for key_dir in key_dirs:
+            stats = compact_key(key_dir, args.output_path, policy=args.policy, dry_run=args.dry_run)
+            totals = {name: totals.get(name, 0) + value for name, value in stats.items()}
+            if stats['runs']:
+                print(f"{os.path.relpath(key_dir, args.output_path)}: {stats['runs']} runs, {stats['files']} files "
+                      f"({stats['bytes'] / 2 ** 20:.1f} MB), {stats['pruned']} pruned, {stats['deduplicated']} deduplicated")
+
+        if not totals.get('runs'):
+            logger.info(f"No finished runs to compact in {args.output_path}.")
+        else:
+            logger.info(f"{'Would compact' if args.dry_run else 'Compacted'} {totals['runs']} runs: {totals['files']} files, "
+                        f"{totals['pruned']} pruned, {totals['deduplicated']} deduplicated, "
+                        f"{totals['bytes'] / 2 ** 20:.1f} MB stored in {totals['stored_bytes'] / 2 ** 20:.1f} MB")
+
+    if args.gc and not args.dry_run:
+        logger.info(f"Removed {gc_store(args.output_path)} unreferenced blobs from the store.")
+
+    files_after, bytes_after = tree_usage(args.output_path)
+    print(f"{args.output_path}: {files_before} files ({bytes_before / 2 ** 20:.1f} MB) -> {files_after} files ({bytes_after / 2 ** 20:.1f} MB)")
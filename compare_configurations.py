@@ -0,0 +1,52 @@
+import sys
+import argparse
+import os
+import csv
+
+from utils.logger import logger
+from utils.results import connect, get_landmark_matrix, RESULTS_DB_FILENAME
+from utils.statistics import compare_configurations
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for the experiments outputs')
+    parser.add_argument('--results_db', type=str, default=None, help='results database, <output_path>/results.sqlite by default')
+    parser.add_argument('--experiment_name', type=str, nargs='*', default=None, help='experiments to compare, all of them if not given')
+    parser.add_argument('--split', type=str, default='train', help='dataset split the landmarks come from')
+    parser.add_argument('--reference', type=str, default=None, help='<experiment>/<reg_params_key> the others are tested against, the best one by default')
+    parser.add_argument('--n_resamples', type=int, default=2000, help='number of bootstrap resamples')
+    parser.add_argument('--n_permutations', type=int, default=10000, help='number of permutations of the paired tests')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the intervals')
+    parser.add_argument("--resample_subjects", action='store_true', help='if True, the bootstrap resamples the subjects instead of the landmarks.')
+    parser.add_argument('--seed', type=int, default=1234, help='random seed')
+    parser.add_argument('--report_path', type=str, default=None, help='csv file to write the comparison to')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    connection = connect(args.results_db or os.path.join(args.output_path, RESULTS_DB_FILENAME))
+    tre, names, groups = get_landmark_matrix(connection, experiments=args.experiment_name, split=args.split)
+
+    if len(names) < 2 or tre.shape[1] == 0:
+        logger.error(f"At least two configurations evaluated on the same landmarks are needed, found {len(names)}.")
+        sys.exit(1)
+
+    logger.info(f"Comparing {len(names)} configurations on {tre.shape[1]} landmarks of {len(set(groups))} subjects...")
+
+    comparison = compare_configurations(
+        tre, names, reference=args.reference, n_resamples=args.n_resamples, n_permutations=args.n_permutations,
+        confidence=args.confidence, groups=groups if args.resample_subjects else None, seed=args.seed)
+
+    for idx in range(len(names)):
+        print(f"{comparison['name'][idx]}: {comparison['mean'][idx]:.3f} mm "
+              f"[{comparison['ci_low'][idx]:.3f}, {comparison['ci_high'][idx]:.3f}], "
+              f"difference {comparison['difference'][idx]:+.3f} mm, p = {comparison['p_value'][idx]:.4f} (Holm {comparison['p_value_holm'][idx]:.4f})")
+
+    if args.report_path:
+        with open(args.report_path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(list(comparison))
+            writer.writerows(zip(*[values.tolist() for values in comparison.values()]))
+        logger.info(f"Comparison written to {args.report_path}")
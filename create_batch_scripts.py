@@ -1,6 +1,8 @@
 from utils.elastix import excute_cmd
+from utils.monitor import run_batch_file
 from utils.logger import logger
 from utils.filemanager import extract_parameter
+from utils.service import run_pipeline_script
 
 if __name__ == '__main__':
     # list down the parameters files to create a batch script for each
@@ -45,6 +47,16 @@ if __name__ == '__main__':
     # create a batch script for each parameters file
     experiment_name = 'CLAHE+UseMasks3+SingleParamFile'
     dataset_path    = 'dataset_processed/CLAHE/train'
+
+    # monitor the elastix iterations and stop the registrations that diverge or go NaN, None uses the default rule
+    # (utils.monitor.DEFAULT_STOPPING_RULE), set monitor_registrations to False to call the .bat files directly
+    monitor_registrations = True
+    stopping_rule = None
+
+    # port of a running pipeline_service.py, the python scripts are then run by the service (warm imports and
+    # catalogs) instead of a new interpreter each, None starts a new interpreter for every script
+    service_port = None
+
     print(f"Experiment name: {experiment_name}...")
     print(f"Dataset path: {dataset_path}... \n")
 
@@ -52,23 +64,17 @@ if __name__ == '__main__':
     for idx, param_path in enumerate(single_parameters_to_script):
         logger.info(f"[{idx+1}/{len(single_parameters_to_script)}] Creating batch script for {param_path}.")
 
-        # create the script
-        command = f'python create_script.py \
-            --dataset_path "{dataset_path}" \
-            --experiment_name "{experiment_name}" \
-            --parameters_path "{param_path}" \
-            --use_masks'
-        excute_cmd(command)
+        # create the script, the registrations are not run when it fails
+        if run_pipeline_script('create_script.py', ['--dataset_path', dataset_path, '--experiment_name', experiment_name, '--parameters_path', param_path, '--use_masks'], port=service_port) != 0:
+            continue
 
         # run the script
         # {param_path.split("/")[-1].replace(".txt", "")} was taken from create_script.py for a single command passed
-        command = f'call output/{experiment_name}/{param_path.split("/")[-1].replace(".txt", "")}/elastix_transformix.bat'
-        excute_cmd(command)
+        bat_path = f'output/{experiment_name}/{param_path.split("/")[-1].replace(".txt", "")}/elastix_transformix.bat'
+        if monitor_registrations:
+            run_batch_file(bat_path, rule=stopping_rule)
+        else:
+            excute_cmd(f'call {bat_path}')
 
         # evaluate the script
-        command = f'python evaluate_transformation.py \
-            --experiment_name "{experiment_name}" \
-            --reg_params_key "{param_path.split("/")[-1].replace(".txt", "")}" \
-            --dataset_path "{dataset_path}"\
-            --generate_report'
-        excute_cmd(command)
+        run_pipeline_script('evaluate_transformation.py', ['--experiment_name', experiment_name, '--reg_params_key', param_path.split("/")[-1].replace(".txt", ""), '--dataset_path', dataset_path, '--generate_report'], port=service_port)
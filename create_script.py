@@ -3,7 +3,11 @@ import argparse
 import os
 
 from utils.logger import logger
-from utils.filemanager import create_directory_if_not_exists, get_paths, check_paths, extract_parameter
+from utils.filemanager import create_directory_if_not_exists, check_paths, extract_parameter
+from utils.catalog import load_catalog
+from utils.elastix import write_run_manifest, find_warm_start, stage_transforms
+from utils.cache import registration_key, lookup, restore, elastix_version
+from utils.storage import output_exists, materialize_transform
 
 if __name__ == "__main__":
     # optional arguments from the command line 
@@ -14,6 +18,9 @@ if __name__ == "__main__":
     parser.add_argument('--parameters_path', type=str, default='elastix-parameters/Par0003', help='root dir for elastix parameters. The script will use all the parameters in this directory. A single .txt file can also be used.')
     parser.add_argument('--output_path', type=str, default='output', help='root dir for output scripts')
     parser.add_argument("--use_masks", action='store_true', help='if True, segmentation masks will be used during the registration.')
+    parser.add_argument("--warm_start", action='store_true', help='if True, reuse the transforms of an earlier experiment sharing a prefix of parameter files as the initial transform (-t0), and only run the remaining parameter files.')
+    parser.add_argument('--initial_transform_dir', type=str, default=None, help='output of prealign.py (<output_path>/<experiment_name>/prealign-<mode>[+refine]), its transform of every subject is passed to elastix as the initial transform (-t0). Not used with a warm start.')
+    parser.add_argument('--cache_dir', type=str, default=None, help='registration cache directory. Registrations already computed (same volumes, masks, parameters and elastix version) are restored from the cache instead of being run, and new ones are added to it.')
 
     # parse the arguments
     args = parser.parse_args()
@@ -21,6 +28,7 @@ if __name__ == "__main__":
     # check if parameters_path is .txt file
     if os.path.isfile(args.parameters_path):
         parameters      = args.parameters_path
+        parameter_files = [parameters]
 
         # cteate params key folder name
         reg_params      = '-p "{}"'.format(parameters).replace('\\', '/')
@@ -28,15 +36,16 @@ if __name__ == "__main__":
         transform_idx   = 0
 
     elif os.path.isdir(args.parameters_path):
-        # get the parameters from the parameters_path
-        parameters = os.listdir(args.parameters_path)
+        # get the parameters from the parameters_path, sorted as elastix runs them in the given order
+        parameters = sorted(os.listdir(args.parameters_path))
+        parameter_files = [os.path.join(args.parameters_path, param) for param in parameters]
 
         if len(parameters) == 0:
             logger.error(f"No parameters found in {args.parameters_path} directory.")
             sys.exit(1)
     
         # cteate params key folder name
-        reg_params      = ' '.join(['-p "{}"'.format(os.path.join(args.parameters_path, param)) for param in parameters]).replace('\\', '/')    
+        reg_params      = ' '.join(['-p "{}"'.format(param) for param in parameter_files]).replace('\\', '/')    
         reg_params_key  = '+'.join(['{}'.format(param.replace('.txt', '')) for param in parameters])
         transform_idx   = len(parameters) - 1
 
@@ -49,16 +58,53 @@ if __name__ == "__main__":
     args.exp_output = os.path.join(args.output_path, args.experiment_name, reg_params_key)
     create_directory_if_not_exists(args.exp_output)
 
+    # elastix and transformix executables of the parameters folder, the same for every subject
+    if params_folder_name == 'Par0003':
+        # elastix version: 3.9 -- fails to allocate memory to register; also can't -def point transformation
+        # elastix_v_path      = '.\\elastix-versions\\elastix_windows32_v3.9\\elastix'
+        # transformix_v_path  = '.\\elastix-versions\\elastix_windows32_v3.9\\transformix'
+            
+        # using default is 4.7
+        elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.7\\elastix'
+        transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.7\\transformix'
+        
+    elif params_folder_name == 'Par0007':
+        # elastix version: 4.0 -- fails to allocate memory to register; also can't -def point transformation
+        # elastix_v_path      = '.\\elastix-versions\\elastix_windows32_v4.0\\elastix'
+        # transformix_v_path  = '.\\elastix-versions\\elastix_windows32_v4.0\\transformix'
+
+        # using default is 4.7
+        elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.7\\elastix'
+        transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.7\\transformix'
+
+    elif params_folder_name == 'Par0011':
+        # elastix version: 4.301
+        elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.3\\elastix'
+        transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.3\\transformix'
+    else:
+        # default is 4.7
+        elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.7\\elastix'
+        transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.7\\transformix'
+
+    # record the parameter files of this experiment and look for an earlier one sharing a prefix of them
+    manifest = write_run_manifest(args.exp_output, parameter_files, args.dataset_path, args.use_masks, elastix_version(elastix_v_path), initial_transform_dir=args.initial_transform_dir)
+    warm_start = find_warm_start(args.output_path, manifest, exclude=args.exp_output) if args.warm_start else None
+
+    if warm_start:
+        warm_start_output, shared_params, warm_start_transforms = warm_start
+        logger.info(f"Warm start from {warm_start_output}, reusing {shared_params}/{len(parameter_files)} parameter files.")
+
     # get the exhale and inhale volumes and segmentations
-    exhale_volumes = get_paths(args, "eBHCT")
-    inhale_volumes = get_paths(args, "iBHCT")
+    catalog = load_catalog(args.dataset_path, cache_dir=args.output_path)
+    exhale_volumes = catalog.paths('exhale_volume')
+    inhale_volumes = catalog.paths('inhale_volume')
 
     check_paths(args, exhale_volumes, "exhale volumes")
     check_paths(args, inhale_volumes, "inhale volumes")
 
     # get the exhale and inhale segmentations if args.use_masks is True
-    exhale_seg = get_paths(args, "eBHCT_lung") if args.use_masks else [0 for _ in range(len(exhale_volumes))] # the list has to have values for the zip(*) to return the values inside
-    inhale_seg = get_paths(args, "iBHCT_lung") if args.use_masks else [0 for _ in range(len(inhale_volumes))]
+    exhale_seg = catalog.paths('exhale_mask') if args.use_masks else [0 for _ in range(len(exhale_volumes))] # the list has to have values for the zip(*) to return the values inside
+    inhale_seg = catalog.paths('inhale_mask') if args.use_masks else [0 for _ in range(len(inhale_volumes))]
 
     if args.use_masks:
         check_paths(args, exhale_seg, "exhale segmentations")
@@ -73,6 +119,7 @@ if __name__ == "__main__":
         file.write("@echo on\n")
         file.write(f"echo To execute this file, use: call {os.path.join(args.exp_output, 'elastix_transformix.bat')} \n")
 
+        runs = {}
         for e_path, i_path, e_seg_path, i_seg_path in zip(exhale_volumes, inhale_volumes, exhale_seg, inhale_seg):
             # Append commands to the .bat file
             file.write(f"\nREM Processing {e_path} and {i_path}\n")
@@ -90,7 +137,7 @@ if __name__ == "__main__":
             mMask = e_seg_path
 
             # defining the control point to be transformed abd transform file paths
-            input_points = os.path.join(args.dataset_path ,f'{sample_name}/{sample_name}_300_iBH_xyz_r1.txt') # i_cntl_pt
+            input_points = catalog.subjects[sample_name].inhale_keypoints # i_cntl_pt
             transform_path = f'{args.exp_output}/images/output_{i_filename_full}/{e_filename_full}/TransformParameters.{transform_idx}.txt'
 
             # Get the names of the fixed and moving images for the output directory, names without the file extensions
@@ -103,43 +150,86 @@ if __name__ == "__main__":
             create_directory_if_not_exists(elastix_output_dir)
             create_directory_if_not_exists(transformix_output_dir)
 
-            if params_folder_name == 'Par0003':
-                # elastix version: 3.9 -- fails to allocate memory to register; also can't -def point transformation
-                # elastix_v_path      = '.\\elastix-versions\\elastix_windows32_v3.9\\elastix'
-                # transformix_v_path  = '.\\elastix-versions\\elastix_windows32_v3.9\\transformix'
-                
-                # using default is 4.7
-                elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.7\\elastix'
-                transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.7\\transformix'
-            
-            elif params_folder_name == 'Par0007':
-                # elastix version: 4.0 -- fails to allocate memory to register; also can't -def point transformation
-                # elastix_v_path      = '.\\elastix-versions\\elastix_windows32_v4.0\\elastix'
-                # transformix_v_path  = '.\\elastix-versions\\elastix_windows32_v4.0\\transformix'
-
-                # using default is 4.7
-                elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.7\\elastix'
-                transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.7\\transformix'
-
-            elif params_folder_name == 'Par0011':
-                # elastix version: 4.301
-                elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.3\\elastix'
-                transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.3\\transformix'
-            else:
-                # default is 4.7
-                elastix_v_path      = '.\\elastix-versions\\elastix_windows64_v4.7\\elastix'
-                transformix_v_path  = '.\\elastix-versions\\elastix_windows64_v4.7\\transformix'
-
+            # reuse the finished transform of the shared parameter files, only if that subject run has finished
+            initial_transform = None
+            remaining_params = reg_params
+            reused_transforms = []
+            run_name = f'{reg_fixed_name}/{reg_moving_name}'
+            if warm_start:
+                # the file of the last shared stage, as recorded by the earlier experiment (it can itself be warm started)
+                shared_transforms = warm_start_transforms.get(run_name)
+
+                # elastix reads the transform (and its initial transforms) from the disk, compacted runs are extracted
+                if shared_transforms and output_exists(shared_transforms[-1]):
+                    initial_transform = materialize_transform(shared_transforms[-1])
+                    remaining_params = ' '.join(['-p "{}"'.format(param) for param in parameter_files[shared_params:]]).replace('\\', '/')
+                    transform_path = f'{elastix_output_dir}/TransformParameters.{len(parameter_files) - shared_params - 1}.txt'
+                    reused_transforms = shared_transforms
+                elif shared_transforms:
+                    logger.warning(f"Warm start transform {shared_transforms[-1]} of {sample_name} not found, {sample_name} runs all the parameter files.")
+                else:
+                    logger.warning(f"{warm_start_output} has no registration of {run_name}, {sample_name} runs all the parameter files.")
+            reused_params = len(reused_transforms)
+            runs[run_name] = stage_transforms(elastix_output_dir, len(parameter_files), reused_transforms)
+
+            # start from the moment based pre-alignment of prealign.py
+            if initial_transform is None and args.initial_transform_dir:
+                prealign_transform = f'{args.initial_transform_dir}/images/output_{reg_fixed_name}/{reg_moving_name}/TransformParameters.0.txt'.replace('\\', '/')
+
+                if output_exists(prealign_transform):
+                    initial_transform = materialize_transform(prealign_transform)
+                else:
+                    logger.warning(f"No pre-alignment found for {sample_name} in {args.initial_transform_dir}, elastix starts from the identity.")
 
             # create elastix command line
             if args.use_masks:
-                elastix_command_line = f'{elastix_v_path} -f "{fixed_path}" -m "{moving_path}" -fMask "{fMask}" -mMask "{mMask}" {reg_params} -out "{elastix_output_dir}"'
+                elastix_command_line = f'{elastix_v_path} -f "{fixed_path}" -m "{moving_path}" -fMask "{fMask}" -mMask "{mMask}" {remaining_params} -out "{elastix_output_dir}"'
             else:
-                elastix_command_line = f'{elastix_v_path} -f "{fixed_path}" -m "{moving_path}" {reg_params} -out "{elastix_output_dir}"'
+                elastix_command_line = f'{elastix_v_path} -f "{fixed_path}" -m "{moving_path}" {remaining_params} -out "{elastix_output_dir}"'
 
-            # create transformix command line
-            trasformix_command_line = f'{transformix_v_path} -def "{input_points}" -tp "{transform_path}"  -out "{transformix_output_dir}"'
+            if initial_transform:
+                elastix_command_line = elastix_command_line.replace(' -out ', f' -t0 "{initial_transform}" -out ')
+
+            # all the parameter files are shared, the earlier transform is the final one
+            if initial_transform and not remaining_params:
+                transform_path = initial_transform
+                elastix_command_line = f'REM Registration reused from {initial_transform}'
+
+            # create transformix command line, a subject without inhale keypoints only gets its registration
+            if input_points:
+                trasformix_command_line = f'{transformix_v_path} -def "{input_points}" -tp "{transform_path}"  -out "{transformix_output_dir}"'
+            else:
+                logger.warning(f"No inhale keypoints found for {sample_name} in {args.dataset_path}, its points will not be transformed.")
+                trasformix_command_line = f'REM No inhale keypoints for {sample_name}'
+
+            # restore the registration from the cache, or add it to the cache once it has run
+            cache_command_line = None
+            if args.cache_dir and not elastix_command_line.startswith('REM '):
+                run_parameter_files = parameter_files[reused_params:]
+                cache_key = registration_key(
+                    fixed_path, moving_path, run_parameter_files, elastix=elastix_v_path,
+                    fixed_mask=fMask if args.use_masks else None, moving_mask=mMask if args.use_masks else None,
+                    initial_transform=initial_transform, cache_dir=args.cache_dir)
+                entry = lookup(args.cache_dir, cache_key, input_points=input_points)
+
+                if entry:
+                    restore(entry, elastix_output_dir, transformix_output_dir if entry['points'] else None, initial_transform)
+                    logger.info(f"Registration of {sample_name} restored from the cache ({cache_key}).")
+                    elastix_command_line = f'REM Registration restored from cache {cache_key}'
+                    if entry['points']:
+                        trasformix_command_line = f'REM Points restored from cache {cache_key}'
+                else:
+                    cache_command_line = (
+                        f'python cache_registration.py --cache_dir "{args.cache_dir}" --key {cache_key} --elastix_output_dir "{elastix_output_dir}" '
+                        f'--points_output_dir "{transformix_output_dir}" --transform_count {len(run_parameter_files)}')
+                    if input_points:
+                        cache_command_line += f' --input_points "{input_points}"'
 
             file.write(f"{elastix_command_line}\n")
             file.write(f"{trasformix_command_line}\n")
-            
\ No newline at end of file
+            if cache_command_line:
+                file.write(f"{cache_command_line}\n")
+            
+
+    # the TransformParameters file of every stage of every registration, for the next warm starts
+    write_run_manifest(args.exp_output, parameter_files, args.dataset_path, args.use_masks, manifest['elastix'], runs, args.initial_transform_dir)
@@ -0,0 +1,80 @@
+import sys
+import argparse
+import os
+import json
+import time
+import numpy as np
+
+from utils.logger import logger
+from utils.catalog import load_catalog, load_description
+from utils.filemanager import create_directory_if_not_exists
+from utils.crop import union_bounding_box, crop_image, shift_keypoints
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data with the lung masks')
+    parser.add_argument('--output_path', type=str, default='dataset_cropped', help='root dir of the cropped dataset, the split is written to <output_path>/<split>')
+    parser.add_argument('--padding', type=float, default=10.0, help='margin (mm) added around the union of the inhale and exhale lung bounding boxes')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    import SimpleITK as sitk
+
+    catalog = load_catalog(args.dataset_path)
+    subjects = [subject for subject in catalog.sorted_subjects()
+                if subject.inhale_volume and subject.exhale_volume and subject.inhale_mask and subject.exhale_mask]
+
+    if len(subjects) == 0:
+        logger.error(f"No subjects with inhale and exhale volumes and lung masks found in {args.dataset_path}.")
+        sys.exit(1)
+
+    split_output = os.path.join(args.output_path, catalog.split).replace('\\', '/')
+    logger.info(f"Cropping {len(subjects)} subjects to their lungs (padding {args.padding} mm), written to {split_output}")
+
+    # the description of the cropped dataset keeps the other splits already written there
+    description = load_description(split_output) or load_description(args.dataset_path)
+    description.setdefault(catalog.split, {})
+
+    total_voxels, cropped_voxels = 0, 0
+    for subject in subjects:
+        start_time = time.time()
+        subject_output = f'{split_output}/{subject.name}'
+        create_directory_if_not_exists(subject_output)
+
+        inhale_mask = sitk.ReadImage(subject.inhale_mask)
+        exhale_mask = sitk.ReadImage(subject.exhale_mask)
+
+        # the same index box for both phases, the fixed and moving volumes stay in the same frame
+        start, size = union_bounding_box([inhale_mask, exhale_mask], padding=args.padding)
+
+        for path, image in [(subject.inhale_mask, inhale_mask), (subject.exhale_mask, exhale_mask),
+                            (subject.inhale_volume, None), (subject.exhale_volume, None)]:
+            image = image if image is not None else sitk.ReadImage(path)
+            sitk.WriteImage(crop_image(image, start, size), f"{subject_output}/{os.path.basename(path)}")
+
+        # the landmarks are indices, they move by the start of the crop
+        for keypoints_path in [subject.inhale_keypoints, subject.exhale_keypoints]:
+            if keypoints_path:
+                shift_keypoints(keypoints_path, f"{subject_output}/{os.path.basename(keypoints_path)}", -start)
+
+        source_dim = list(inhale_mask.GetSize())
+        fraction = float(np.prod(size) / np.prod(source_dim))
+        total_voxels += np.prod(source_dim)
+        cropped_voxels += np.prod(size)
+
+        metadata = dict(subject.metadata)
+        metadata.update({'image_dim': [int(value) for value in size],
+                         'crop': {'start': [int(value) for value in start], 'source_dim': [int(value) for value in source_dim]}})
+        description[catalog.split][subject.name] = metadata
+
+        print(f"{subject.name}: {source_dim} -> {metadata['image_dim']} from {metadata['crop']['start']}, "
+              f"{fraction * 100:.1f}% of the voxels ({time.time() - start_time:.2f}s)")
+
+    with open(os.path.join(args.output_path, 'description.json'), 'w') as json_file:
+        json.dump(description, json_file, indent=4)
+
+    logger.info(f"The cropped volumes keep {cropped_voxels / total_voxels * 100:.1f}% of the voxels. "
+                f"Use --dataset_path {split_output} with create_script.py and evaluate_transformation.py.")
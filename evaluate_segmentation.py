@@ -0,0 +1,71 @@
+import sys
+import argparse
+import os
+import csv
+import tempfile
+import numpy as np
+
+from utils.catalog import load_catalog
+from utils.logger import logger
+from utils.metrics import compute_overlap_metrics_batch
+from utils.storage import materialize
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--experiment_name', type=str, nargs='*', default=None, help='experiments to evaluate, all of them if not given')
+    parser.add_argument('--reg_params_key', type=str, nargs='*', default=None, help='registration parameters keys to evaluate, all of them if not given')
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for the experiments outputs')
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data to get the inhale lung masks')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='number of processes computing the metrics')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    # every warped exhale mask (see propagate_labels.py) of the selected configurations, with its inhale mask
+    catalog = load_catalog(args.dataset_path, output_path=args.output_path, experiments=args.experiment_name)
+    rows, pairs = [], []
+    for subject in catalog.sorted_subjects():
+        for registration in subject.registrations:
+            if args.experiment_name and registration.experiment not in args.experiment_name:
+                continue
+            if args.reg_params_key and registration.reg_params_key not in args.reg_params_key:
+                continue
+
+            for warped_label in registration.warped_labels:
+                if subject.inhale_mask and warped_label.split('/')[-1] == subject.exhale_mask.split('/')[-1]:
+                    rows.append({'experiment': registration.experiment, 'reg_params_key': registration.reg_params_key, 'sample_name': subject.name})
+                    pairs.append((subject.inhale_mask, warped_label))
+
+    if len(pairs) == 0:
+        logger.error(f"No propagated masks found in {args.output_path} directory, run propagate_labels.py first.")
+        sys.exit(1)
+
+    logger.info(f"Computing the overlap metrics of {len(pairs)} propagated masks...")
+
+    # the masks of the runs compacted by compact_outputs.py are extracted to a scratch folder for SimpleITK
+    with tempfile.TemporaryDirectory() as scratch:
+        pairs = [(inhale_mask, materialize(warped_label, directory=scratch)) for inhale_mask, warped_label in pairs]
+        for row, metrics in zip(rows, compute_overlap_metrics_batch(pairs, num_workers=args.num_workers)):
+            row.update(metrics)
+
+    # one csv per configuration, next to the warped masks
+    configurations = sorted({(row['experiment'], row['reg_params_key']) for row in rows})
+    for experiment, reg_params_key in configurations:
+        results = [row for row in rows if (row['experiment'], row['reg_params_key']) == (experiment, reg_params_key)]
+
+        output_csv_path = os.path.join(args.output_path, experiment, reg_params_key, 'labels', 'overlap_sample_results.csv')
+        with open(output_csv_path, 'w', newline='') as csv_file:
+            fieldnames = ['sample_name', 'dice', 'hd95', 'msd']
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames, extrasaction='ignore')
+
+            # Write the header
+            writer.writeheader()
+
+            # Write the data
+            for result in results:
+                writer.writerow(result)
+
+        print(f"{experiment} / {reg_params_key}: Dice {np.nanmean([row['dice'] for row in results]):.4f}, "
+              f"HD95 {np.nanmean([row['hd95'] for row in results]):.2f} mm, MSD {np.nanmean([row['msd'] for row in results]):.2f} mm")
@@ -1,14 +1,18 @@
 import sys
 import argparse
 import os
-import json
 import csv
 import numpy as np
 
-from utils.filemanager import get_points_paths
+from utils.catalog import load_catalog
 from utils.logger import logger, pprint
-from utils.landmarks import get_landmarks_from_txt, write_landmarks_to_list
-from utils.metrics import compute_TRE
+from utils.landmarks import write_transformix_landmarks
+from utils.metrics import compute_landmark_TRE
+from utils.crop import shift_keypoints
+from utils.results import connect, get_experiment_configuration, ingest_subject, RESULTS_DB_FILENAME
+from utils.elastix_logs import parse_elastix_log
+from utils.manifest import load_manifest, save_manifest, get_inputs_signature, EVALUATION_MANIFEST_FILENAME
+from utils.storage import output_exists
 
 if __name__ == "__main__":
     # optional arguments from the command line 
@@ -19,6 +23,8 @@ if __name__ == "__main__":
     parser.add_argument('--output_path', type=str, default='output', help='root dir for output scripts')
     parser.add_argument("--generate_report", action='store_true', help='if True, an evaluation report .txt file will be generated. If not, only the transformed keypoints txt file will be generated for each test sample.')
     parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data to get the gt exhale landmarks')
+    parser.add_argument("--incremental", action='store_true', help='if True, only the new or changed transformed points files are processed, the results of the others are taken from the evaluation manifest.')
+    parser.add_argument('--results_db', type=str, default=None, help='results database the per landmark and per subject TRE are added to, <output_path>/results.sqlite by default')
 
     # parse the arguments
     args = parser.parse_args()
@@ -27,8 +33,15 @@ if __name__ == "__main__":
     # points is the folder where the transformed points are saved using transformix
     args.exp_points_output = os.path.join(args.output_path, args.experiment_name, args.reg_params_key, 'points')
     
+    # scan the dataset and the output trees once, the registrations are linked to their subjects
+    catalog = load_catalog(args.dataset_path, output_path=args.output_path, experiments=[args.experiment_name])
+    registrations = [
+        (subject, subject.get_registration(args.experiment_name, args.reg_params_key))
+        for subject in catalog.sorted_subjects()]
+    registrations = [(subject, registration) for subject, registration in registrations if registration and registration.output_points]
+
     # get a list of all the transformed keypoints files
-    transformed_points = get_points_paths(args.exp_points_output, "outputpoints", num_occurrences=2)
+    transformed_points = [registration.output_points for _, registration in registrations]
 
     if len(transformed_points) == 0:
         logger.error(f"No transformed points found in {args.exp_points_output} directory.")
@@ -36,52 +49,94 @@ if __name__ == "__main__":
 
     # check if generate_report is True
     if args.generate_report:
-        gt_points = get_points_paths(args.dataset_path, "_300_eBH_xyz_r1", num_occurrences=1)
+        gt_points = [subject.exhale_keypoints for subject, _ in registrations]
 
-        if len(gt_points) == 0:
+        if len(gt_points) == 0 or not all(gt_points):
             logger.error(f"No gt points found in {args.dataset_path} directory.")
             sys.exit(1)
 
         # Create a list to store the TRE results
         tre_results = []
 
+        # the results of every subject are also added to the results database, next to the other experiments
+        connection = connect(args.results_db or os.path.join(args.output_path, RESULTS_DB_FILENAME))
+        configuration = get_experiment_configuration(os.path.join(args.output_path, args.experiment_name, args.reg_params_key), args.experiment_name)
+        configuration.update({'experiment': args.experiment_name, 'reg_params_key': args.reg_params_key, 'split': catalog.split})
+
     else:
         gt_points = [0 for _ in range(len(transformed_points))] # the list has to have values for the zip(*) to return the values inside
 
 
     logger.info(f"Found {len(transformed_points)} transformed points files for subjects ({[subject.split('/')[-2] for subject in transformed_points]})")
 
+    # the manifest records the inputs (path, size, mtime, hash) and the results of every processed points file
+    manifest_path = os.path.join(args.exp_points_output, EVALUATION_MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path)
+    skipped = 0
+
     # extract the transformed points from the transformed_points transformix files and save them in a separate file
-    for transformed_points_file, gt_point in zip(transformed_points, gt_points):
-        print(f"Processing {transformed_points_file}...")
+    for (subject, registration), transformed_points_file, gt_point in zip(registrations, transformed_points, gt_points):
+        output_landmarks_path = os.path.join(transformed_points_file.replace('outputpoints.txt', ''), 'outputpoints_transformed.txt')
+
+        # the results depend on the points files and on the voxel size of the subject
+        settings = {'generate_report': args.generate_report, 'voxel_dim': subject.metadata.get('voxel_dim') if args.generate_report else None}
+        if subject.metadata.get('crop'):
+            settings['crop'] = subject.metadata['crop']
+        signatures, changed = get_inputs_signature(
+            manifest, transformed_points_file, [transformed_points_file, gt_point if args.generate_report else None], settings)
+
+        # merge the results of the unchanged files into the report
+        if args.incremental and not changed and output_exists(output_landmarks_path):
+            manifest[transformed_points_file].update(signatures)
+            if args.generate_report:
+                tre_results.append(manifest[transformed_points_file]['result'])
+            skipped += 1
+            continue
 
-        # get the transformed points
-        transformed_landmarks = get_landmarks_from_txt(transformed_points_file, search_key='OutputIndexFixed')
+        print(f"Processing {transformed_points_file}...")
 
-        # the transformed points has to be 300
-        assert len(transformed_landmarks) == 300, f"Transformed points file {transformed_points_file} has {len(transformed_landmarks)} points instead of 300."
-        
-        # write the transformed points to a file 
+        # write the transformed points to a file, chunk by chunk, any number of points is supported
         # the points are written inside the same directory as the transformed_points_file
-        output_landmarks_path = os.path.join(transformed_points_file.replace('outputpoints.txt', ''), 'outputpoints_transformed.txt')
-        write_landmarks_to_list(transformed_landmarks, output_landmarks_path)
+        # (created again when the run was compacted by compact_outputs.py)
+        os.makedirs(os.path.dirname(output_landmarks_path), exist_ok=True)
+        landmarks_count = write_transformix_landmarks(transformed_points_file, output_landmarks_path, search_key='OutputIndexFixed')
+
+        if landmarks_count == 0:
+            logger.error(f"Transformed points file {transformed_points_file} has no points.")
+            sys.exit(1)
+
+        # the points of a dataset cropped by crop_volumes.py are also written in the frame of the original volumes
+        if subject.metadata.get('crop'):
+            shift_keypoints(output_landmarks_path, os.path.join(os.path.dirname(output_landmarks_path), 'outputpoints_uncropped.txt'), subject.metadata['crop']['start'])
 
         # generate the evaluation report if args.generate_report is True, this is when we have the ground truth exhale files
         if args.generate_report:
-            sample_name = gt_point.split('/')[-1].split('_')[0] #copd1, copd2, ...
+            sample_name = subject.name #copd1, copd2, ...
 
-            # load the dataset dictionary, we remove the last path element because we want to get the description.json file
-            with open(os.path.join(args.dataset_path.replace("train", "", 1).replace("test", "", 1),'description.json'), 'r') as json_file:
-                dictionary = json.loads(json_file.read())
-            file_information = dictionary[args.dataset_path.replace('\\', '/').split("/")[-1]][sample_name]
+            # the dataset description is loaded once by the catalog
+            file_information = subject.metadata
             print(file_information)
 
-            TRE_mean, TRE_std = compute_TRE(output_landmarks_path, gt_point, tuple(file_information['voxel_dim']))
-            print("TRE (After Registration):- ", f"(Mean TRE: {TRE_mean})", f"(STD TRE: {TRE_std}). \n")
+            # the TRE of every landmark, the mean and std are taken from it
+            landmark_TRE = compute_landmark_TRE(output_landmarks_path, gt_point, tuple(file_information['voxel_dim']))
+            TRE_mean, TRE_std = np.round(np.mean(landmark_TRE), 2), np.round(np.std(landmark_TRE), 2)
+            print(f"TRE (After Registration) over {landmarks_count} points:- ", f"(Mean TRE: {TRE_mean})", f"(STD TRE: {TRE_std}). \n")
 
             # Append TRE results to the list
             tre_results.append({'sample_name': sample_name, 'TRE_mean': TRE_mean, 'TRE_std': TRE_std})
 
+            # the registration runtime comes from its elastix.log
+            log_path = os.path.join(registration.images_dir, 'elastix.log') if registration.images_dir else None
+            runtime = parse_elastix_log(log_path)['total_time'] if log_path and output_exists(log_path) else None
+
+            ingest_subject(connection, configuration, sample_name, landmark_TRE, runtime=runtime)
+
+        manifest[transformed_points_file] = {**signatures, 'result': tre_results[-1] if args.generate_report else {}}
+
+    save_manifest(manifest_path, manifest)
+    if skipped:
+        logger.info(f"{skipped}/{len(transformed_points)} transformed points files are unchanged, their results were reused.")
+
     # generate the evaluation report if args.generate_report is True, this is when we have the ground truth exhale files
     if args.generate_report:
         # write the TRE results to a csv file for each sample
@@ -0,0 +1,34 @@
+import sys
+import argparse
+import os
+
+from utils.logger import logger
+from utils.results import connect, get_leaderboard, ingest_csv_results, RESULTS_DB_FILENAME
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for the experiments outputs')
+    parser.add_argument('--results_db', type=str, default=None, help='results database, <output_path>/results.sqlite by default')
+    parser.add_argument('--split', type=str, default=None, help='dataset split to rank the configurations on, all of them if not given')
+    parser.add_argument('--limit', type=int, default=20, help='number of configurations to show')
+    parser.add_argument('--import_csv', type=str, nargs='*', default=None, help='experiments whose TRE_sample_results.csv reports are imported first')
+    parser.add_argument('--import_split', type=str, default=None, help='split of the imported reports (e.g. train, test), read from the parameters.json of every key by default')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    connection = connect(args.results_db or os.path.join(args.output_path, RESULTS_DB_FILENAME))
+
+    for experiment_name in args.import_csv or []:
+        count = ingest_csv_results(connection, args.output_path, experiment_name, split=args.import_split)
+        logger.info(f"Imported {count} subject results of {experiment_name}")
+
+    leaderboard = get_leaderboard(connection, split=args.split, limit=args.limit)
+
+    if leaderboard.empty:
+        logger.error(f"No results found, run evaluate_transformation.py with --generate_report first.")
+        sys.exit(1)
+
+    print(leaderboard.to_string(index=False))
@@ -0,0 +1,104 @@
+import sys
+import argparse
+import os
+import json
+import time
+import numpy as np
+import SimpleITK as sitk
+
+from utils.logger import logger
+from utils.catalog import load_catalog, load_description
+from utils.filemanager import create_directory_if_not_exists
+from utils.synthetic import make_phantom, breathing_transform, min_jacobian_determinant, deform_pair, sample_landmarks
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str, default=None, help='dataset split whose exhale volumes (and lung masks) are deformed, chest phantoms are generated if not given')
+    parser.add_argument('--output_path', type=str, default='dataset_synthetic', help='root dir of the synthetic dataset, the pairs are written to <output_path>/<split>/copdN')
+    parser.add_argument('--split', type=str, default='train', help='split name of the synthetic dataset')
+    parser.add_argument('--subjects', type=int, default=4, help='number of synthetic subjects, the source volumes are reused with new deformations when there are fewer')
+    parser.add_argument('--landmarks', type=int, default=300, help='number of landmarks of every subject')
+    parser.add_argument('--magnitude', type=float, default=30.0, help='largest breathing displacement (mm), at the diaphragm')
+    parser.add_argument('--noise', type=float, default=2.0, help='standard deviation (mm) of the random part of the B-spline coefficients')
+    parser.add_argument('--grid_spacing', type=float, default=40.0, help='B-spline control point spacing (mm)')
+    parser.add_argument('--phantom_size', type=int, nargs=3, default=[128, 128, 64], help='size (x y z) of the phantom volumes')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the deformations, the landmarks and the phantoms')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    if args.dataset_path:
+        catalog = load_catalog(args.dataset_path)
+        sources = [(subject.exhale_volume, subject.exhale_mask) for subject in catalog.sorted_subjects() if subject.exhale_volume]
+
+        if len(sources) == 0:
+            logger.error(f"No exhale volumes found in {args.dataset_path}.")
+            sys.exit(1)
+    else:
+        sources = [None]
+
+    split_output = os.path.join(args.output_path, args.split).replace('\\', '/')
+    logger.info(f"Generating {args.subjects} synthetic subjects with {args.landmarks} landmarks each in {split_output}")
+
+    # the entries of the other splits already written there are kept
+    description = load_description(split_output)
+    description[args.split] = {}
+
+    for idx in range(args.subjects):
+        start_time = time.time()
+        name = f'copd{idx + 1}'
+        seed = args.seed + idx
+        subject_output = f'{split_output}/{name}'
+        create_directory_if_not_exists(subject_output)
+
+        # the source volume is the exhale (moving) image, its deformed partner the inhale (fixed) image
+        source = sources[idx % len(sources)]
+        if source is None:
+            moving, moving_mask = make_phantom(size=args.phantom_size, seed=seed)
+        else:
+            moving = sitk.ReadImage(source[0])
+            moving_mask = sitk.ReadImage(source[1]) if source[1] else None
+
+        transform = breathing_transform(moving, magnitude=args.magnitude, noise=args.noise, grid_spacing=args.grid_spacing, seed=seed)
+        fixed, fixed_mask = deform_pair(moving, transform, mask=moving_mask)
+        inhale_points, exhale_points = sample_landmarks(transform, fixed, moving, count=args.landmarks, fixed_mask=fixed_mask, seed=seed)
+
+        sitk.WriteImage(moving, f'{subject_output}/{name}_eBHCT.nii.gz')
+        sitk.WriteImage(fixed, f'{subject_output}/{name}_iBHCT.nii.gz')
+        if moving_mask is not None:
+            sitk.WriteImage(moving_mask, f'{subject_output}/{name}_eBHCT_lung.nii.gz')
+            sitk.WriteImage(fixed_mask, f'{subject_output}/{name}_iBHCT_lung.nii.gz')
+
+        # the inhale landmarks are voxels, the exhale ones are their exact images under the deformation
+        np.savetxt(f'{subject_output}/{name}_{len(inhale_points)}_iBH_xyz_r1.txt', inhale_points, fmt='%d', delimiter='\t')
+        np.savetxt(f'{subject_output}/{name}_{len(exhale_points)}_eBH_xyz_r1.txt', exhale_points, fmt='%.4f', delimiter='\t')
+
+        voxel_dim = np.array(moving.GetSpacing())
+        displacement = np.linalg.norm((exhale_points - inhale_points) * voxel_dim, axis=1)
+        jacobian = min_jacobian_determinant(transform, moving)
+
+        description[args.split][name] = {
+            'name': name,
+            'image_dim': [int(value) for value in moving.GetSize()],
+            'voxel_dim': [float(value) for value in voxel_dim],
+            'features': int(len(inhale_points)),
+            'displacement_mean': round(float(displacement.mean()), 2),
+            'displacement_std': round(float(displacement.std()), 2),
+            'origin': [float(value) for value in moving.GetOrigin()],
+            'index_base': 0,
+            'synthetic': {'source': source[0] if source else 'phantom', 'seed': seed, 'magnitude': args.magnitude,
+                          'noise': args.noise, 'grid_spacing': args.grid_spacing, 'min_jacobian': round(jacobian, 4)},
+        }
+
+        if jacobian <= 0:
+            logger.warning(f"The deformation of {name} folds (Jacobian determinant {jacobian:.3f}), lower --noise or raise --grid_spacing.")
+
+        print(f"{name}: {len(inhale_points)} landmarks, displacement {displacement.mean():.2f} +- {displacement.std():.2f} mm, "
+              f"min Jacobian {jacobian:.3f} ({time.time() - start_time:.2f}s)")
+
+    with open(os.path.join(args.output_path, 'description.json'), 'w') as json_file:
+        json.dump(description, json_file, indent=4)
+
+    logger.info(f"Use --dataset_path {split_output} with create_script.py and evaluate_transformation.py.")
@@ -0,0 +1,88 @@
+import sys
+import argparse
+import os
+import shutil
+import time
+import SimpleITK as sitk
+
+from utils.logger import logger
+from utils.catalog import load_catalog
+from utils.filemanager import create_directory_if_not_exists
+from utils.masks import lung_mask_variants, parse_structure
+
+def link_or_copy(source, destination):
+    '''
+    Hard link a file of the dataset into a variant dataset, or copy it when the file system does not allow it.
+
+    Args:
+        source ('str'): Existing file.
+        destination ('str'): New file.
+
+    Returns:
+        None
+    '''
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data')
+    parser.add_argument('--output_path', type=str, default='dataset_masks', help='root dir of the variant datasets, every variant is written to <output_path>/<variant>/<split>')
+    parser.add_argument('--structures', type=str, nargs='*', default=['7x7x7'], help='closing structuring elements (slice x H x W), e.g. 7x7x7 5x5x3')
+    parser.add_argument('--margins', type=float, nargs='*', default=[-5, -2, 2, 5], help='erosion (negative) and dilation (positive) margins of the masks, in mm')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    catalog = load_catalog(args.dataset_path)
+    volumes = catalog.paths('exhale_volume') + catalog.paths('inhale_volume')
+
+    if len(volumes) == 0:
+        logger.error(f"No volumes found in {args.dataset_path}.")
+        sys.exit(1)
+
+    structures = [parse_structure(structure) for structure in args.structures]
+    logger.info(f"Generating the mask variants of {len(volumes)} volumes (structures {args.structures}, margins {args.margins} mm) in {args.output_path}")
+
+    variants = set()
+    for volume in volumes:
+        start_time = time.time()
+        subject = catalog.subjects[volume.split('/')[-2]]
+
+        sitk_image = sitk.ReadImage(volume)
+        np_image = sitk.GetArrayFromImage(sitk_image)
+
+        # the same thresholds as segment.py
+        threshold = 430 if subject.name == 'copd2' else 700
+        fill_holes_before_trachea_removal = subject.name == 'copd2'
+
+        for name, mask in lung_mask_variants(np_image, sitk_image.GetSpacing()[::-1], threshold=threshold, structures=structures,
+                                             margins=args.margins, fill_holes_before_trachea_removal=fill_holes_before_trachea_removal):
+            subject_output = os.path.join(args.output_path, name, catalog.split, subject.name)
+            create_directory_if_not_exists(subject_output)
+
+            mask_sitk = sitk.GetImageFromArray(mask)
+            mask_sitk.CopyInformation(sitk_image)
+            sitk.WriteImage(mask_sitk, os.path.join(subject_output, os.path.basename(volume).replace('.nii.gz', '_lung.nii.gz')))
+
+            # every variant is a complete dataset split, the volumes and the keypoints are linked, not copied
+            for path in [volume, subject.exhale_keypoints if '_eBHCT' in volume else subject.inhale_keypoints]:
+                if path:
+                    link_or_copy(path, os.path.join(subject_output, os.path.basename(path)))
+            variants.add(name)
+
+        print(f"{os.path.basename(volume)}: {len(variants)} mask variants ({time.time() - start_time:.2f}s)")
+
+    # the description is needed next to every variant split for the evaluation
+    description_path = os.path.join(os.path.dirname(os.path.normpath(args.dataset_path)), 'description.json')
+    for name in sorted(variants):
+        if os.path.exists(description_path):
+            shutil.copy2(description_path, os.path.join(args.output_path, name, 'description.json'))
+
+    logger.info(f"Mask variants: {sorted(variants)}. Use --dataset_path {args.output_path}/<variant>/{catalog.split} --use_masks with create_script.py.")
@@ -1,13 +1,12 @@
 import sys
 import argparse
 import os
-from glob import glob
-import json
 import SimpleITK as sitk
 
 # importing utils and 
 from utils.logger import logger
 from utils.dataset import read_raw
+from utils.catalog import load_catalog
 from enums.dtype import DataTypes
 
 
@@ -27,22 +26,19 @@ if __name__ == "__main__":
 
     # get the list of exhale and inhale files from the dataset_path
     logger.info(f"Reading raw data from '{args.dataset_path}'")
-    exhale_volumes = [path.replace('\\', '/') for path in sorted(glob(os.path.join(args.dataset_path, "***" , "*eBHCT.img"), recursive=True))]
-    inhale_volumes = [path.replace('\\', '/') for path in sorted(glob(os.path.join(args.dataset_path, "***" , "*iBHCT.img"), recursive=True))]
+    catalog = load_catalog(args.dataset_path)
+    exhale_volumes = catalog.paths('exhale_raw')
+    inhale_volumes = catalog.paths('inhale_raw')
 
     # log the number of exhale and inhale files
     logger.info(f"Found {len(exhale_volumes)} exhale volumes: ({[subject.split('/')[-2] for subject in exhale_volumes]})")
     logger.info(f"Found {len(inhale_volumes)} inhale volumes: ({[subject.split('/')[-2] for subject in inhale_volumes]})\n")
 
-    # read the data dictionary
-    with open(os.path.join(args.dataset_path.replace("train", "", 1).replace("test", "", 1), 'description.json'), 'r') as json_file:
-        dictionary = json.loads(json_file.read())
-
     # iterate over all of the raw inhale and exhale volumes and export them as nifti files
     for exhale_volume, inhale_volume in zip(exhale_volumes, inhale_volumes):
         # get the subject name and information
         subject_name = exhale_volume.split('/')[-2]
-        subject_information = dictionary[args.dataset_path.replace('\\', '/').split("/")[-1]][subject_name]
+        subject_information = catalog.subjects[subject_name].metadata
 
         # Access the sitkPixelType value for RAW_DATA
         sitk_pixel_type = DataTypes.RAW_DATA.value
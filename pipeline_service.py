@@ -0,0 +1,49 @@
+import sys
+import argparse
+import os
+import json
+import asyncio
+
+from utils.logger import logger
+from utils.service import PipelineService, install_request_context, send_requests, SERVICE_PORT
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help='local port the service listens on')
+    parser.add_argument("--stdio", action='store_true', help='if True, the requests are read from stdin and the responses written to stdout instead of a socket.')
+    parser.add_argument('--max_workers', type=int, default=os.cpu_count(), help='number of requests run at once')
+    parser.add_argument('--send', type=str, nargs='*', default=None, help='json requests to send to a running service instead of starting one, e.g. \'{"op": "status"}\'')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    # client mode, the responses are printed as json lines
+    if args.send is not None:
+        responses = send_requests([json.loads(request) for request in args.send], port=args.port)
+        for response in responses:
+            print(json.dumps(response))
+        sys.exit(max([abs(response.get('returncode') or 0) for response in responses] + [0]))
+
+    # the responses of the stdio mode are written to a copy of the real stdout, the output of the scripts is captured
+    # per request, and file descriptor 1 goes to stderr so the subprocesses of the scripts (e.g. the executor
+    # commands) never write into the responses
+    protocol_output = sys.stdout
+    if args.stdio:
+        sys.stdout.flush()
+        protocol_output = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    install_request_context(default_stream=sys.stderr if args.stdio else sys.stdout)
+
+    service = PipelineService(os.path.dirname(os.path.abspath(__file__)), max_workers=args.max_workers)
+    service.scripts.remove(os.path.basename(__file__))
+    service.preload()
+    logger.info(f"Pipeline service ready, {len(service.scripts)} scripts available ({'stdin' if args.stdio else f'port {args.port}'})")
+
+    if args.stdio:
+        asyncio.run(service.serve_stdio(protocol_output))
+    else:
+        asyncio.run(service.serve_socket(port=args.port))
+
+    logger.info(f"Pipeline service stopped: {service.stats}")
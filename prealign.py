@@ -0,0 +1,91 @@
+import sys
+import argparse
+import os
+import csv
+import time
+import numpy as np
+
+from utils.logger import logger
+from utils.catalog import load_catalog
+from utils.filemanager import create_directory_if_not_exists
+from utils.landmarks import read_keypoints
+from utils.prealign import moment_affine, refine_affine, write_elastix_affine, index_to_physical, physical_to_index, apply_affine, MOMENT_MODES
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data with the lung masks')
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for output scripts')
+    parser.add_argument('--experiment_name', type=str, default='prealign', help='experiment name, the transforms are written to <output_path>/<experiment_name>/prealign-<mode>[+refine]')
+    parser.add_argument('--mode', type=str, default='scaling', choices=MOMENT_MODES, help='moments matched by the initial transform: centroids only, per axis spread, or full covariance')
+    parser.add_argument("--refine", action='store_true', help='if True, the moment based transform is refined by a quick affine registration of the downsampled volumes.')
+    parser.add_argument('--shrink_factors', type=int, nargs='*', default=[4, 2], help='downsampling factor of every resolution level of the refinement')
+    parser.add_argument('--iterations', type=int, default=200, help='maximum number of iterations of every resolution level of the refinement')
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(), help='number of threads of the refinement')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    import SimpleITK as sitk
+
+    reg_params_key = f'prealign-{args.mode}' + ('+refine' if args.refine else '')
+    exp_output = os.path.join(args.output_path, args.experiment_name, reg_params_key).replace('\\', '/')
+
+    catalog = load_catalog(args.dataset_path, cache_dir=args.output_path)
+    subjects = [subject for subject in catalog.sorted_subjects() if subject.inhale_mask and subject.exhale_mask]
+
+    if len(subjects) == 0:
+        logger.error(f"No subjects with inhale and exhale lung masks found in {args.dataset_path}.")
+        sys.exit(1)
+
+    logger.info(f"Pre-aligning {len(subjects)} subjects ({reg_params_key}), transforms written to {exp_output}")
+
+    results = []
+    for subject in subjects:
+        start_time = time.time()
+
+        # the inhale volume is the fixed image of the registrations, as in create_script.py
+        fixed_name = os.path.basename(subject.inhale_volume or subject.inhale_mask).split('.')[0].replace('_lung', '')
+        moving_name = os.path.basename(subject.exhale_volume or subject.exhale_mask).split('.')[0].replace('_lung', '')
+
+        fixed_mask = sitk.ReadImage(subject.inhale_mask)
+        moving_mask = sitk.ReadImage(subject.exhale_mask)
+        transform = moment_affine(fixed_mask, moving_mask, mode=args.mode)
+
+        if args.refine:
+            refined = refine_affine(
+                sitk.ReadImage(subject.inhale_volume), sitk.ReadImage(subject.exhale_volume), transform, fixed_mask=fixed_mask,
+                shrink_factors=args.shrink_factors, iterations=args.iterations, num_threads=args.num_threads)
+            logger.info(f"{subject.name}: refinement metric {refined['initial_metric']:.4f} -> {refined['final_metric']:.4f} in {refined['iterations']} iterations")
+            transform = refined
+
+        transform_dir = f'{exp_output}/images/output_{fixed_name}/{moving_name}'
+        create_directory_if_not_exists(transform_dir)
+        transform_path = f'{transform_dir}/TransformParameters.0.txt'
+        write_elastix_affine(transform, fixed_mask, transform_path)
+
+        row = {'sample_name': subject.name, 'transform': transform_path, 'seconds': time.time() - start_time,
+               'displacement': float(np.linalg.norm(transform['translation'])), 'scaling': np.diag(transform['matrix']).round(4).tolist()}
+
+        # the landmarks show how much of the motion is already recovered, indices as transformix reads them
+        if subject.inhale_keypoints and subject.exhale_keypoints and subject.metadata.get('voxel_dim'):
+            voxel_dim = np.array(subject.metadata['voxel_dim'])
+            inhale_keypoints = read_keypoints(subject.inhale_keypoints)
+            exhale_keypoints = read_keypoints(subject.exhale_keypoints)
+            mapped = physical_to_index(moving_mask, apply_affine(transform, index_to_physical(fixed_mask, inhale_keypoints)))
+
+            row['TRE_before'] = float(np.linalg.norm((inhale_keypoints - exhale_keypoints) * voxel_dim, axis=1).mean())
+            row['TRE_after'] = float(np.linalg.norm((mapped - exhale_keypoints) * voxel_dim, axis=1).mean())
+
+        print(f"{subject.name}: translation {row['displacement']:.2f} mm, scaling {row['scaling']}"
+              + (f", TRE {row['TRE_before']:.2f} -> {row['TRE_after']:.2f} mm" if 'TRE_after' in row else '') + f" ({row['seconds']:.2f}s)")
+        results.append(row)
+
+    output_csv_path = os.path.join(exp_output, 'prealign_results.csv')
+    with open(output_csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=['sample_name', 'transform', 'seconds', 'displacement', 'scaling', 'TRE_before', 'TRE_after'])
+        writer.writeheader()
+        writer.writerows(results)
+
+    logger.info(f"Use --initial_transform_dir {exp_output} with create_script.py to start elastix from these transforms.")
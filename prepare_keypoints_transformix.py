@@ -1,10 +1,12 @@
 import sys
 import argparse
 import os
-from glob import glob
+import shutil
 
 # importing utils and 
 from utils.logger import logger, pprint
+from utils.catalog import load_catalog
+from utils.landmarks import has_transformix_header, count_keypoints
 
 if __name__ == "__main__":
     # optional arguments from the command line 
@@ -28,10 +30,8 @@ if __name__ == "__main__":
 
     # get the list of exhale and inhale files from the dataset_path
     logger.info(f"Reading keypoint data from '{args.dataset_path}'")
-    if args.keypoint_type == 'inhale':
-        keypoint_files = [path.replace('\\', '/') for path in sorted(glob(os.path.join(args.dataset_path, "***" , "*300_iBH_xyz_r1.txt"), recursive=True))]
-    else:
-        keypoint_files = [path.replace('\\', '/') for path in sorted(glob(os.path.join(args.dataset_path, "***" , "*300_eBH_xyz_r1.txt"), recursive=True))]
+    catalog = load_catalog(args.dataset_path)
+    keypoint_files = catalog.paths(f'{args.keypoint_type}_keypoints')
     
     logger.info(f"Found {len(keypoint_files)} keypoint files for subjects ({[subject.split('/')[-2] for subject in keypoint_files]})")
     pprint(keypoint_files)
@@ -49,8 +49,15 @@ if __name__ == "__main__":
     for kp_file in keypoint_files:
         print(f"Processing {kp_file}")
 
-        # read and update the keypoint file
-        with open(kp_file, 'r+') as file:
-            content = file.read()
-            file.seek(0, 0)
-            file.write('index' + '\n' + '300' + '\n' + content)
+        # the files already prepared are left untouched, running the script twice does not add a second header
+        if has_transformix_header(kp_file):
+            logger.info(f"{kp_file} already has the transformix header, skipping")
+            continue
+
+        # the header is followed by the original content, copied in blocks so the file is never fully loaded
+        num_points = count_keypoints(kp_file)
+        tmp_file = f'{kp_file}.{os.getpid()}.tmp'
+        with open(kp_file, 'r') as source, open(tmp_file, 'w') as file:
+            file.write('index' + '\n' + str(num_points) + '\n')
+            shutil.copyfileobj(source, file)
+        os.replace(tmp_file, kp_file)
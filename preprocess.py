@@ -4,7 +4,8 @@ import numpy as np
 import SimpleITK as sitk
 
 from utils.logger import logger
-from utils.filemanager import create_directory_if_not_exists, get_paths, check_paths
+from utils.filemanager import create_directory_if_not_exists, check_paths
+from utils.catalog import load_catalog
 from utils.preprocess import bilateral_filter_3d, clahe_3d
 from utils.dataset import segment_body, min_max_normalization
 
@@ -49,8 +50,9 @@ if __name__ == "__main__":
     create_directory_if_not_exists(args.exp_output)
 
     # get the exhale and inhale volumes and segmentations
-    exhale_volumes = get_paths(args, "eBHCT")
-    inhale_volumes = get_paths(args, "iBHCT")
+    catalog = load_catalog(args.dataset_path)
+    exhale_volumes = catalog.paths('exhale_volume')
+    inhale_volumes = catalog.paths('inhale_volume')
 
     check_paths(args, exhale_volumes, "exhale volumes")
     check_paths(args, inhale_volumes, "inhale volumes")
@@ -70,7 +72,7 @@ if __name__ == "__main__":
 
         # read the sample
         sample_sitk     = sitk.ReadImage(sample_path)
-        sample_image    = sitk.GetArrayFromImage(sample_sitk)
+        sample_image    = sitk.GetArrayViewFromImage(sample_sitk) # read only view of the image buffer, no copy
 
         # Get the minimum and maximum intensity values of the input image
         min_max_filter = sitk.MinimumMaximumImageFilter()
@@ -89,19 +91,17 @@ if __name__ == "__main__":
 
         # note that the gantry and black background are still present and we need to remove them.
         # segmenting the body and removing the gantry
-        mask, labeled_mask, largest_masks, body_segmented = \
-            segment_body(sample_image, threshold=threshold)
+        # only the largest masks are kept, the other outputs are released right away
+        largest_masks = segment_body(sample_image, threshold=threshold)[2]
         
-        # inverging the largest masks to focus on the body for being used as a mask
-        largest_masks_sitk = sitk.GetImageFromArray(largest_masks)
-        largest_masks_sitk.CopyInformation(sample_sitk)
-
-        largest_masks_inverted_sitk = sitk.Not(largest_masks_sitk)
-        largest_masks_inverted_image = sitk.GetArrayFromImage(largest_masks_inverted_sitk)
+        # inverging the largest masks to focus on the body for being used as a mask, a boolean numpy array
+        largest_masks_inverted_image = largest_masks == 0
+        del largest_masks
 
         # normalize the image using min-max normalization, excluding the gantry and black background using the largest mask that represents anything except the body
         logger.info(">> Normalizing using min-max...")
-        normalized_image = min_max_normalization(sample_image, largest_masks_inverted_image).astype(np.int16) # 
+        normalized_image = min_max_normalization(sample_image, largest_masks_inverted_image).astype(np.int16, copy=False)
+        del largest_masks_inverted_image
 
         normalized_image_sitk = sitk.GetImageFromArray(normalized_image)
         normalized_image_sitk.CopyInformation(sample_sitk)
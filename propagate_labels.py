@@ -0,0 +1,47 @@
+import sys
+import argparse
+import os
+
+from utils.logger import logger
+from utils.catalog import load_catalog
+from utils.filemanager import create_directory_if_not_exists
+from utils.warp import label_propagation_resample, SLAB_SIZE
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--experiment_name', type=str, default='elastix_01', help='experiment name')
+    parser.add_argument('--reg_params_key', type=str, default='Parameter.affine+Parameter.bsplines', help='registration parameters key generated by create_script.py')
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for the experiments outputs')
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data to get the exhale lung masks')
+    parser.add_argument('--slab_size', type=int, default=SLAB_SIZE, help='number of z slices warped at once, lower values use less memory')
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(), help='number of slabs warped in parallel')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    # the registrations of the experiment and the moving (exhale) masks of their subjects
+    catalog = load_catalog(args.dataset_path, output_path=args.output_path, experiments=[args.experiment_name])
+    registrations = [
+        (subject, subject.get_registration(args.experiment_name, args.reg_params_key))
+        for subject in catalog.sorted_subjects()]
+    registrations = [
+        (subject, registration) for subject, registration in registrations
+        if registration and registration.transform_parameters and subject.exhale_mask]
+
+    if len(registrations) == 0:
+        logger.error(f"No registrations with exhale masks found for {args.experiment_name}/{args.reg_params_key}.")
+        sys.exit(1)
+
+    for subject, registration in registrations:
+        # the output follows the images and points folders of the experiment
+        output_dir = os.path.join(
+            args.output_path, args.experiment_name, args.reg_params_key, 'labels',
+            f'output_{registration.fixed_name}', registration.moving_name).replace('\\', '/')
+
+        output_paths = label_propagation_resample(
+            registration.transform_parameters[-1], [subject.exhale_mask], output_dir, create_directory_if_not_exists,
+            slab_size=args.slab_size, num_threads=args.num_threads)
+
+        logger.info(f"Propagated {subject.name} labels to {output_paths}")
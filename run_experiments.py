@@ -0,0 +1,54 @@
+import sys
+import argparse
+import os
+
+from utils.logger import logger
+from utils.scheduler import jobs_from_batch_file, run_scheduled, default_memory_budget
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--bat_path', type=str, nargs='+', required=True, help='elastix_transformix.bat files created by create_script.py')
+    parser.add_argument('--memory_budget', type=float, default=None, help='memory budget in GB for all the registrations running at once, 90%% of the available memory by default')
+    parser.add_argument('--max_concurrency', type=int, default=os.cpu_count(), help='maximum number of registrations running at once')
+    parser.add_argument('--history_path', type=str, default='output/memory_history.json', help='json file of the measured memory used to refine the estimates')
+    parser.add_argument('--timeout', type=float, default=None, help='time limit in seconds for every command')
+    parser.add_argument('--log_dir', type=str, default='output/logs', help='dir the output of every command is written to')
+    parser.add_argument("--no_resume", action='store_true', help='if True, the interrupted registrations start over instead of resuming from their last finished resolution.')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    jobs = []
+    for bat_path in args.bat_path:
+        if not os.path.exists(bat_path):
+            logger.error(f"Path {bat_path} does not exist")
+            sys.exit(1)
+
+        # name the jobs after their experiment, the log files are then easy to find
+        experiment_jobs = jobs_from_batch_file(bat_path)
+        for idx, job in enumerate(experiment_jobs):
+            job['name'] = f"{os.path.basename(os.path.dirname(bat_path))}.{idx}"
+        jobs += experiment_jobs
+
+    memory_budget = int(args.memory_budget * 1024 ** 3) if args.memory_budget else default_memory_budget()
+    os.makedirs(os.path.dirname(args.history_path) or '.', exist_ok=True)
+
+    logger.info(f"Running {len(jobs)} registrations within {memory_budget / 1024 ** 3:.1f} GB using up to {args.max_concurrency} processes.")
+
+    results = run_scheduled(
+        jobs,
+        memory_budget=memory_budget,
+        max_concurrency=args.max_concurrency,
+        history_path=args.history_path,
+        timeout=args.timeout,
+        log_dir=args.log_dir,
+        resume=not args.no_resume)
+
+    for result in results:
+        registration = result['results'][0] if result['results'] else {}
+        peak = registration.get('peak_memory')
+        print(f"{result['name']}: estimated {result['corrected_estimate'] / 1024 ** 2:.0f} MB, "
+              f"peak {peak / 1024 ** 2 if peak else float('nan'):.0f} MB, "
+              f"returncodes {[command_result['returncode'] for command_result in result['results']]}")
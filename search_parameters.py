@@ -0,0 +1,144 @@
+import sys
+import argparse
+import os
+import csv
+import json
+from glob import glob
+import numpy as np
+
+from utils.logger import logger
+from utils.catalog import load_catalog
+from utils.elastix import read_parameter_file
+from utils.elastix_logs import parse_elastix_log
+from utils.monitor import run_batch_file
+from utils.service import run_pipeline_script
+from utils.search import parse_grid, expand_grid, rung_fractions, promoted_count, scale_iterations, write_variant, run_iterations, read_score, select_promoted
+
+def run_seconds(exp_output):
+    '''
+    Total elastix time (s) of the registrations of an experiment key, from their elastix.log.
+    '''
+    times = [parse_elastix_log(log_path)['total_time'] for log_path in glob(os.path.join(exp_output, 'images', 'output_*', '*', 'elastix.log'))]
+    return float(np.nansum(times)) if times else np.nan
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='dataset split the configurations are evaluated on, with the exhale keypoints')
+    parser.add_argument('--parameters_path', type=str, default='elastix-parameters/ParCOPDBest/Par0003.bs-R6-ug-5000SpatialSamples-3000itr.txt', help='base elastix parameter file, its MaximumNumberOfIterations is the full budget')
+    parser.add_argument('--grid', type=str, nargs='*', default=[], help='searched parameters, Name=value,value entries, e.g. FinalGridSpacingInPhysicalUnits=10,15 NumberOfSpatialSamples=2000,5000')
+    parser.add_argument('--experiment_name', type=str, default='search_01', help='experiment the runs of every rung are written to')
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for output scripts')
+    parser.add_argument('--rungs', type=int, default=3, help='number of budgets, the last one is the full iteration schedule')
+    parser.add_argument('--eta', type=float, default=3.0, help='the budget grows by eta from a rung to the next, and the best 1/eta of the configurations are promoted')
+    parser.add_argument("--use_masks", action='store_true', help='if True, segmentation masks will be used during the registration.')
+    parser.add_argument("--no_reuse", action='store_true', help='if True, the promoted configurations start from scratch instead of from their transform of the previous rung')
+    parser.add_argument('--initial_transform_dir', type=str, default=None, help='output of prealign.py, the initial transform of the runs that do not continue from the previous rung')
+    parser.add_argument('--cache_dir', type=str, default=None, help='registration cache directory, see create_script.py')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.parameters_path):
+        logger.error(f"Parameter file {args.parameters_path} does not exist")
+        sys.exit(1)
+
+    base = read_parameter_file(args.parameters_path)
+    base_name = os.path.basename(args.parameters_path).replace('.txt', '')
+    full_iterations = base.get('MaximumNumberOfIterations')
+    if not full_iterations:
+        logger.error(f"{args.parameters_path} has no MaximumNumberOfIterations")
+        sys.exit(1)
+
+    configurations = expand_grid(parse_grid(args.grid))
+    fractions = rung_fractions(args.rungs, args.eta)
+    subjects = len(load_catalog(args.dataset_path, cache_dir=args.output_path).sorted_subjects())
+
+    search_output = os.path.join(args.output_path, args.experiment_name)
+    parameters_dir = os.path.join(search_output, 'search_parameters')
+    logger.info(f"Searching {len(configurations)} configurations of {base_name} on {subjects} subjects, budgets {[max(scale_iterations(full_iterations, fraction)) for fraction in fractions]} iterations.")
+
+    active = list(configurations)
+    previous = {}
+    rows = []
+    for rung, fraction in enumerate(fractions):
+        iterations = scale_iterations(full_iterations, fraction)
+        scores = {}
+
+        for name in active:
+            key = f'{base_name}-{name}-it{max(iterations)}'
+            exp_output = os.path.join(search_output, key)
+
+            # a promoted configuration continues from its transform of the previous rung with the remaining iterations,
+            # that transform already starts from the pre-alignment, the other runs start from the pre-alignment itself
+            initial_transform_dir = args.initial_transform_dir
+            run_schedule = iterations
+            if name in previous and not args.no_reuse:
+                initial_transform_dir = previous[name]['exp_output']
+                run_schedule = [max(1, value - done) for value, done in zip(iterations, previous[name]['iterations'])]
+
+            # forward slashes, create_script.py takes the key from the last part of the parameters path
+            variant_path = os.path.join(parameters_dir, f'{key}.txt').replace('\\', '/')
+            parameters = write_variant(args.parameters_path, configurations[name], run_schedule, variant_path)
+
+            # the keys already evaluated (e.g. an interrupted search started again) are not run again
+            score, evaluated = read_score(os.path.join(exp_output, 'points'))
+            if evaluated == 0:
+                print(f"[rung {rung + 1}/{len(fractions)}] {name} {configurations[name]}: {max(iterations)} iterations")
+                create_args = ['--dataset_path', args.dataset_path, '--output_path', args.output_path, '--experiment_name', args.experiment_name, '--parameters_path', variant_path]
+                create_args += ['--use_masks'] if args.use_masks else []
+                create_args += ['--initial_transform_dir', initial_transform_dir] if initial_transform_dir else []
+                create_args += ['--cache_dir', args.cache_dir] if args.cache_dir else []
+
+                # a configuration whose script could not be created is not run, its score stays inf
+                if run_pipeline_script('create_script.py', create_args) == 0:
+                    run_batch_file(os.path.join(exp_output, 'elastix_transformix.bat'))
+                    run_pipeline_script('evaluate_transformation.py', ['--experiment_name', args.experiment_name, '--reg_params_key', key,
+                                        '--output_path', args.output_path, '--dataset_path', args.dataset_path, '--generate_report'])
+                    score, evaluated = read_score(os.path.join(exp_output, 'points'))
+
+            scores[name] = score
+            previous[name] = {'exp_output': exp_output, 'iterations': iterations}
+            rows.append({'rung': rung, 'configuration': name, 'reg_params_key': key, 'iterations': max(iterations),
+                         'run_iterations': run_iterations(parameters) * subjects, 'seconds': run_seconds(exp_output),
+                         'TRE_mean': round(score, 2), 'overrides': json.dumps(configurations[name])})
+            print(f"{key}: mean TRE {score:.2f} over {evaluated} subjects")
+
+        # the best 1/eta of the configurations go on to the next budget
+        if rung < len(fractions) - 1:
+            promoted = select_promoted(scores, promoted_count(len(active), args.eta))
+            if len(promoted) == 0:
+                logger.error(f"No configuration of rung {rung + 1} was evaluated, see the logs of {search_output}.")
+                sys.exit(1)
+            logger.info(f"Rung {rung + 1}: promoting {promoted} out of {len(active)} configurations.")
+            active = promoted
+
+    for row in rows:
+        row['promoted'] = row['rung'] < len(fractions) - 1 and row['configuration'] in {other['configuration'] for other in rows if other['rung'] == row['rung'] + 1}
+
+    best = min(active, key=lambda name: (scores[name], name))
+    if not np.isfinite(scores[best]):
+        logger.error(f"No configuration of the last rung was evaluated, see the logs of {search_output}.")
+        sys.exit(1)
+
+    # the best configuration with the full schedule, e.g. for create_script.py on the test split
+    best_path = os.path.join(parameters_dir, f'{base_name}-{best}-best.txt')
+    write_variant(args.parameters_path, configurations[best], full_iterations, best_path)
+
+    report_path = os.path.join(search_output, 'search_results.csv')
+    with open(report_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=['rung', 'configuration', 'reg_params_key', 'iterations', 'run_iterations', 'seconds', 'TRE_mean', 'promoted', 'overrides'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    # the compute of the search against every configuration run with the full schedule
+    search_iterations = sum(row['run_iterations'] for row in rows)
+    grid_iterations = len(configurations) * run_iterations({**base, 'MaximumNumberOfIterations': full_iterations}) * subjects
+    search_seconds = float(np.nansum([row['seconds'] for row in rows]))
+
+    print(f"Best configuration {best} {configurations[best]}: mean TRE {scores[best]:.2f}, written to {best_path}")
+    print(f"Search: {search_iterations} iterations ({search_seconds:.0f}s), full grid: {grid_iterations} iterations"
+          + (f" (~{search_seconds * grid_iterations / search_iterations:.0f}s)" if search_seconds > 0 else '')
+          + f", {100 * (1 - search_iterations / grid_iterations):.0f}% saved")
+    logger.info(f"Search results written to {report_path}")
@@ -1,13 +1,12 @@
 import sys
 import argparse
 import os
-from glob import glob
-import json
 import SimpleITK as sitk
 
 # importing utils and 
 from utils.logger import logger, pprint
 from utils.dataset import segment_lungs_and_remove_trachea
+from utils.catalog import load_catalog
 from enums.dtype import DataTypes
 
 
@@ -27,8 +26,9 @@ if __name__ == "__main__":
 
     # get the list of exhale and inhale files from the dataset_path
     logger.info(f"Reading nifti data from '{args.dataset_path}'")
-    exhale_volumes = [path.replace('\\', '/') for path in sorted(glob(os.path.join(args.dataset_path, "***" , "*eBHCT.nii.gz"), recursive=True))]
-    inhale_volumes = [path.replace('\\', '/') for path in sorted(glob(os.path.join(args.dataset_path, "***" , "*iBHCT.nii.gz"), recursive=True))]
+    catalog = load_catalog(args.dataset_path)
+    exhale_volumes = catalog.paths('exhale_volume')
+    inhale_volumes = catalog.paths('inhale_volume')
 
     # log the number of exhale and inhale files
     logger.info(f"Found {len(exhale_volumes)} exhale volumes: ({[subject.split('/')[-2] for subject in exhale_volumes]})")
@@ -36,19 +36,15 @@ if __name__ == "__main__":
     pprint(exhale_volumes, inhale_volumes)
     print('\n')
 
-    # read the data dictionary
-    with open(os.path.join(args.dataset_path.replace("train", "", 1).replace("test", "", 1), 'description.json'), 'r') as json_file:
-        dictionary = json.loads(json_file.read())
-
     # iterate over all of the nifti inhale and exhale volumes and segment the lungs
     for volume in exhale_volumes + inhale_volumes:
         # get the subject name and information
         subject_name = volume.split('/')[-2]
-        subject_information = dictionary[args.dataset_path.replace('\\', '/').split("/")[-1]][subject_name]
+        subject_information = catalog.subjects[subject_name].metadata
 
         logger.info(f"Segmenting {volume}")
         sitk_image = sitk.ReadImage(volume)
-        np_image = sitk.GetArrayFromImage(sitk_image)
+        np_image = sitk.GetArrayViewFromImage(sitk_image) # read only view of the image buffer, no copy
 
         # logs
         print(subject_information)
@@ -0,0 +1,74 @@
+import sys
+import argparse
+import os
+
+from utils.logger import logger
+from utils.catalog import load_catalog
+from utils.filemanager import check_paths
+from utils.workqueue import make_job, submit_job, queue_status
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--queue_dir', type=str, required=True, help='shared queue directory the workers pull the jobs from')
+    parser.add_argument('--dataset_path', type=str, default='dataset/train', help='root dir for nifti data')
+    parser.add_argument('--experiment_name', type=str, default='elastix_01', help='experiment name')
+    parser.add_argument('--parameters_path', type=str, default='elastix-parameters/Par0003', help='root dir for elastix parameters. The jobs will use all the parameters in this directory. A single .txt file can also be used.')
+    parser.add_argument('--output_path', type=str, default='output', help='root dir for the experiments outputs')
+    parser.add_argument("--use_masks", action='store_true', help='if True, segmentation masks will be used during the registration.')
+    parser.add_argument("--generate_report", action='store_true', help='if True, an evaluation job generating the TRE report runs once all the registrations are done.')
+    parser.add_argument('--elastix', type=str, default='elastix', help='elastix executable on the workers')
+    parser.add_argument('--transformix', type=str, default='transformix', help='transformix executable on the workers')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    # the parameter files and the output folders follow create_script.py
+    if os.path.isfile(args.parameters_path):
+        parameter_files = [args.parameters_path.replace('\\', '/')]
+    elif os.path.isdir(args.parameters_path):
+        parameter_files = [os.path.join(args.parameters_path, param).replace('\\', '/') for param in sorted(os.listdir(args.parameters_path))]
+    else:
+        logger.error(f"Path {args.parameters_path} does not exist")
+        sys.exit(1)
+
+    reg_params_key = '+'.join([path.split('/')[-1].replace('.txt', '') for path in parameter_files])
+    exp_output = f'{args.output_path}/{args.experiment_name}/{reg_params_key}'
+
+    catalog = load_catalog(args.dataset_path, cache_dir=args.output_path)
+    subjects = [subject for subject in catalog.sorted_subjects() if subject.inhale_volume and subject.exhale_volume]
+    check_paths(args, subjects, "subjects with inhale and exhale volumes")
+
+    job_ids = []
+    for subject in subjects:
+        reg_fixed_name = subject.inhale_volume.split('/')[-1].split('.')[0]
+        reg_moving_name = subject.exhale_volume.split('/')[-1].split('.')[0]
+
+        job = make_job(
+            'register',
+            fixed_path=subject.inhale_volume,
+            moving_path=subject.exhale_volume,
+            fixed_mask=subject.inhale_mask if args.use_masks else None,
+            moving_mask=subject.exhale_mask if args.use_masks else None,
+            parameter_files=parameter_files,
+            output_dir=f'{exp_output}/images/output_{reg_fixed_name}/{reg_moving_name}',
+            input_points=subject.inhale_keypoints,
+            points_output_dir=f'{exp_output}/points/output_{reg_fixed_name}/{reg_moving_name}',
+            elastix=args.elastix,
+            transformix=args.transformix)
+
+        submitted = submit_job(args.queue_dir, job)
+        job_ids.append(job['job_id'])
+        logger.info(f"{'Submitted' if submitted else 'Already queued'} {job['job_id']} for {subject.name}")
+
+    # the evaluation runs after all the registrations of the experiment
+    if args.generate_report:
+        evaluation_command = (
+            f'python evaluate_transformation.py --experiment_name "{args.experiment_name}" --reg_params_key "{reg_params_key}" '
+            f'--output_path "{args.output_path}" --dataset_path "{args.dataset_path}" --generate_report')
+        job = make_job('command', depends_on=job_ids, commands=[evaluation_command])
+        submitted = submit_job(args.queue_dir, job)
+        logger.info(f"{'Submitted' if submitted else 'Already queued'} {job['job_id']} for the evaluation")
+
+    logger.info(f"Queue status: {queue_status(args.queue_dir)}")
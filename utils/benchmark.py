@@ -0,0 +1,129 @@
+import os
+import re
+import sys
+import time
+import subprocess
+import statistics
+
+# third party packages worth tracking in the startup of the scripts, the plotting stack first
+HEAVY_MODULES = ['matplotlib', 'pandas', 'skimage', 'nibabel', 'scipy', 'SimpleITK']
+
+# import time: self [us] | cumulative | imported package
+IMPORT_TIME_PATTERN = re.compile(r'^import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumulative>\d+)\s+\|\s+(?P<module>\S+)$')
+
+
+def measure_startup(script, repo_path='.', repeat=5, python=sys.executable):
+    '''
+    Measure the startup time of a command line script, the wall time of `<script> --help`, which imports
+    all the modules of the script and exits before doing any work.
+
+    Args:
+        script ('str'): Script path, relative to the repository.
+        repo_path ('str'): Repository the script is run from.
+        repeat ('int'): Number of runs, the median is reported.
+        python ('str'): Python interpreter.
+
+    Returns:
+        seconds ('float'): Median wall time of the runs, in seconds.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([python, script, '--help'], cwd=repo_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+def measure_imports(script, repo_path='.', python=sys.executable):
+    '''
+    Get the top level packages imported by a script on startup and their cumulative import time, with
+    python -X importtime.
+
+    Args:
+        script ('str'): Script path, relative to the repository.
+        repo_path ('str'): Repository the script is run from.
+        python ('str'): Python interpreter.
+
+    Returns:
+        imports ('dict'): Top level package -> cumulative import time in seconds.
+    '''
+    result = subprocess.run(
+        [python, '-X', 'importtime', script, '--help'], cwd=repo_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    # a package is imported once, its own line carries the cumulative time of its subtree, at any nesting level
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match and '.' not in match.group('module'):
+            imports[match.group('module')] = int(match.group('cumulative')) / 1e6
+
+    return imports
+
+def benchmark_scripts(scripts, repo_path='.', repeat=5, python=sys.executable):
+    '''
+    Benchmark the startup of several scripts of a repository.
+
+    Args:
+        scripts ('list'): Script paths, relative to the repository.
+        repo_path ('str'): Repository the scripts are run from.
+        repeat ('int'): Number of runs of every script.
+        python ('str'): Python interpreter.
+
+    Returns:
+        results ('dict'): Script -> {'seconds': median startup time, 'heavy_modules': {package: import seconds}}.
+    '''
+    results = {}
+    for script in scripts:
+        if not os.path.exists(os.path.join(repo_path, script)):
+            continue
+
+        imports = measure_imports(script, repo_path=repo_path, python=python)
+        results[script] = {
+            'seconds': measure_startup(script, repo_path=repo_path, repeat=repeat, python=python),
+            'heavy_modules': {package: imports[package] for package in HEAVY_MODULES if package in imports},
+        }
+
+    return results
+
+# runs a script under tracemalloc (numpy reports its buffers to it) and prints the peak traced and resident memory
+PEAK_MEMORY_WRAPPER = '''
+import sys, runpy, tracemalloc
+script, sys.argv = sys.argv[1], sys.argv[1:]
+sys.path.insert(0, '.')
+tracemalloc.start()
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    traced = tracemalloc.get_traced_memory()[1]
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+        rss = -1
+    sys.stderr.write(f'\\nPEAK_MEMORY {traced} {rss}\\n')
+'''
+
+def measure_peak_memory(script, args=(), repo_path='.', python=sys.executable):
+    '''
+    Measure the peak memory of a command line script run: the peak of the memory traced by tracemalloc (the
+    numpy arrays and the python objects, not the SimpleITK image buffers) and the peak resident memory of
+    the process (not available on Windows).
+
+    Args:
+        script ('str'): Script path, relative to the repository.
+        args ('list'): Command line arguments of the script.
+        repo_path ('str'): Repository the script is run from.
+        python ('str'): Python interpreter.
+
+    Returns:
+        memory ('dict'): traced_mb and rss_mb (None if not available), None if the script failed.
+    '''
+    result = subprocess.run(
+        [python, '-c', PEAK_MEMORY_WRAPPER, script, *map(str, args)], cwd=repo_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    match = re.search(r'^PEAK_MEMORY (\d+) (-?\d+)$', result.stderr, re.MULTILINE)
+    if result.returncode != 0 or not match:
+        return None
+
+    traced, rss = int(match.group(1)), int(match.group(2))
+    return {'traced_mb': traced / 2 ** 20, 'rss_mb': rss / 2 ** 20 if rss >= 0 else None}
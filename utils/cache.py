@@ -0,0 +1,301 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+
+from .elastix import parameters_fingerprint, read_parameter_file
+from .monitor import EARLY_STOPPING_FILENAME
+
+# bump when the key components or the entry layout change, older entries are then never hit
+CACHE_VERSION = 1
+
+# files of an elastix output directory kept in the cache, the result images are not kept
+CACHED_IMAGES_PATTERN = re.compile(r'^(TransformParameters\.\d+\.txt|elastix\.log|IterationInfo\.\d+\.R\d+\.txt)$')
+
+# files of a transformix output directory kept in the cache
+CACHED_POINTS_PATTERN = re.compile(r'^(outputpoints\.txt|transformix\.log)$')
+
+# size of the chunks the volumes are hashed with, the volumes are never fully loaded
+HASH_CHUNK_SIZE = 8 * 1024 ** 2
+
+# digests of the already hashed files, per process
+_digests = {}
+
+# elastix versions of the already queried executables, per process
+_versions = {}
+
+
+def file_digest(file_path, cache_dir=None):
+    '''
+    Compute the sha256 of a file content. The digest is memoized by path, size and modification time, in
+    memory and in <cache_dir>/digests.json, so an unchanged volume is hashed only once.
+
+    Args:
+        file_path ('str'): Path to the file.
+        cache_dir ('str'): Optional cache directory the memoized digests are kept in.
+
+    Returns:
+        digest ('str'): Hex digest of the file content.
+    '''
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+
+    index_path = os.path.join(cache_dir, 'digests.json') if cache_dir else None
+    if index_path and path not in _digests and os.path.exists(index_path):
+        with open(index_path, 'r') as json_file:
+            _digests.update({key: value for key, value in json.load(json_file).items() if key not in _digests})
+
+    if path in _digests and _digests[path]['signature'] == signature:
+        return _digests[path]['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    _digests[path] = {'signature': signature, 'sha256': sha256.hexdigest()}
+
+    if index_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(_digests, json_file)
+        os.replace(tmp_path, index_path)
+
+    return _digests[path]['sha256']
+
+def elastix_version(executable):
+    '''
+    Get the version of an elastix executable from its --version output. When the executable can not be
+    run on this machine (e.g. the windows binaries of elastix-versions), the digest of the binary, or its
+    path, is used instead.
+
+    Args:
+        executable ('str'): Path to the elastix executable (or the name of one on the PATH).
+
+    Returns:
+        version ('str'): Version of the executable.
+    '''
+    if executable in _versions:
+        return _versions[executable]
+
+    try:
+        output = subprocess.run([executable, '--version'], capture_output=True, text=True, timeout=60)
+        version = output.stdout.strip() if output.returncode == 0 else None
+    except (OSError, subprocess.SubprocessError):
+        version = None
+
+    if not version:
+        binary = executable.replace('\\', '/')
+        binaries = [path for path in [binary, f'{binary}.exe'] if os.path.isfile(path)]
+        version = f'sha256:{file_digest(binaries[0])}' if binaries else f'path:{binary}'
+
+    _versions[executable] = version
+    return version
+
+def transform_chain(transform_path):
+    '''
+    Get a TransformParameters file and the chain of its initial transforms, e.g. a warm start transform, the
+    transforms it was warm started from and the pre-alignment of prealign.py.
+
+    Args:
+        transform_path ('str'): Path to the TransformParameters file.
+
+    Returns:
+        chain ('list'): Paths of the transforms, the given one first.
+    '''
+    chain = []
+    path = transform_path
+    while path and path != 'NoInitialTransform' and path not in chain:
+        # the initial transforms are usually relative to the directory elastix ran from, as in utils.storage
+        if not os.path.exists(path):
+            path = os.path.join(os.path.dirname(transform_path), os.path.basename(path))
+        chain.append(path)
+        path = read_parameter_file(path).get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+
+    return chain
+
+def registration_key(fixed_path, moving_path, parameter_files, elastix='elastix', fixed_mask=None, moving_mask=None,
+                     initial_transform=None, cache_dir=None):
+    '''
+    Compute the content address of a registration, a hash of the fixed and moving volumes, the masks,
+    the normalized parameter files (in order), the initial transform with the chain of its own initial
+    transforms (e.g. a pre-alignment) and the elastix version. The paths of the files do not change the key, so
+    two experiments registering the same data share their results.
+
+    Args:
+        fixed_path ('str'): Path to the fixed volume.
+        moving_path ('str'): Path to the moving volume.
+        parameter_files ('list'): Parameter files passed to elastix, in order.
+        elastix ('str'): Elastix executable.
+        fixed_mask ('str'): Optional fixed mask.
+        moving_mask ('str'): Optional moving mask.
+        initial_transform ('str'): Optional initial transform (-t0).
+        cache_dir ('str'): Optional cache directory the file digests are memoized in.
+
+    Returns:
+        key ('str'): Hex digest identifying the registration.
+    '''
+    def digest(path):
+        return file_digest(path, cache_dir) if path else None
+
+    components = {
+        'version': CACHE_VERSION,
+        'fixed': digest(fixed_path),
+        'moving': digest(moving_path),
+        'fixed_mask': digest(fixed_mask),
+        'moving_mask': digest(moving_mask),
+        'initial_transform': [digest(path) for path in transform_chain(initial_transform)] if initial_transform else None,
+        'parameters': [parameters_fingerprint(path) for path in parameter_files],
+        'elastix': elastix_version(elastix),
+    }
+    return hashlib.sha256(json.dumps(components, sort_keys=True).encode()).hexdigest()
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, 'entries', key[:2], key)
+
+def lookup(cache_dir, key, require_points=False, input_points=None):
+    '''
+    Find a cached registration. The key does not cover the keypoints, the transformed points of an entry are
+    only used when they were computed from the same input points file content.
+
+    Args:
+        cache_dir ('str'): Cache directory.
+        key ('str'): Key from registration_key.
+        require_points ('bool'): If True, only entries with transformed points are hits.
+        input_points ('str'): Input points file (e.g. the inhale keypoints) the points should be transformed from.
+
+    Returns:
+        entry ('dict'): Entry info (with its directory), None on a cache miss. Its points are empty when they
+            were transformed from other input points.
+    '''
+    entry_path = os.path.join(_entry_dir(cache_dir, key), 'entry.json')
+    if not os.path.exists(entry_path):
+        return None
+
+    with open(entry_path, 'r') as json_file:
+        entry = json.load(json_file)
+
+    # stale transformed points, e.g. the keypoints were edited or cropped since the entry was stored
+    if entry['points'] and (not input_points or entry.get('input_points') != file_digest(input_points, cache_dir)):
+        entry['points'] = []
+
+    if require_points and not entry['points']:
+        return None
+
+    entry['directory'] = os.path.dirname(entry_path)
+    return entry
+
+def store(cache_dir, key, elastix_output_dir, points_output_dir=None, transform_count=None, input_points=None):
+    '''
+    Copy the transforms, logs and transformed points of a finished registration into the cache. Runs that
+    were stopped early or did not write their last transform are not stored.
+
+    Args:
+        cache_dir ('str'): Cache directory.
+        key ('str'): Key from registration_key.
+        elastix_output_dir ('str'): Elastix output directory of the registration.
+        points_output_dir ('str'): Optional transformix output directory of the inhale keypoints.
+        transform_count ('int'): Optional number of TransformParameters files the finished run has.
+        input_points ('str'): Input points file transformix read, the points are not stored without it.
+
+    Returns:
+        stored ('bool'): True if the entry was stored (or already in the cache).
+    '''
+    if lookup(cache_dir, key) is not None:
+        return True
+
+    if not os.path.isdir(elastix_output_dir) or os.path.exists(os.path.join(elastix_output_dir, EARLY_STOPPING_FILENAME)):
+        return False
+
+    images = sorted(filename for filename in os.listdir(elastix_output_dir) if CACHED_IMAGES_PATTERN.match(filename))
+    transforms = [filename for filename in images if filename.startswith('TransformParameters.')]
+    if not transforms or (transform_count and f'TransformParameters.{transform_count - 1}.txt' not in transforms):
+        return False
+
+    points = []
+    if points_output_dir and input_points and os.path.isdir(points_output_dir):
+        points = sorted(filename for filename in os.listdir(points_output_dir) if CACHED_POINTS_PATTERN.match(filename))
+        if 'outputpoints.txt' not in points:
+            points = []
+
+    # the entry is assembled in a temporary directory and renamed, a reader never sees half an entry
+    entry_dir = _entry_dir(cache_dir, key)
+    tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, 'images'))
+    os.makedirs(os.path.join(tmp_dir, 'points'))
+
+    for filename in images:
+        shutil.copy2(os.path.join(elastix_output_dir, filename), os.path.join(tmp_dir, 'images', filename))
+    for filename in points:
+        shutil.copy2(os.path.join(points_output_dir, filename), os.path.join(tmp_dir, 'points', filename))
+
+    with open(os.path.join(tmp_dir, 'entry.json'), 'w') as json_file:
+        json.dump({
+            'key': key,
+            'created_at': time.time(),
+            'source': elastix_output_dir.replace('\\', '/'),
+            'transforms': transforms,
+            'points': points,
+            'input_points': file_digest(input_points, cache_dir) if points else None,
+        }, json_file, indent=4)
+
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # stored by another run in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return True
+
+def _relink_transforms(elastix_output_dir, transforms, initial_transform):
+    '''
+    Point the InitialTransformParametersFileName of restored transforms to their new location, the
+    TransformParameters.N.txt files are chained in order and the first one starts from the -t0 transform.
+    '''
+    for filename in transforms:
+        index = int(filename.split('.')[1])
+        previous = f'{elastix_output_dir}/TransformParameters.{index - 1}.txt' if index > 0 else initial_transform
+
+        file_path = os.path.join(elastix_output_dir, filename)
+        with open(file_path, 'r') as file:
+            text = file.read()
+
+        text = re.sub(
+            r'\(InitialTransformParametersFileName\s+"[^"]*"\)',
+            lambda _: f'(InitialTransformParametersFileName "{previous or "NoInitialTransform"}")',
+            text)
+
+        with open(file_path, 'w') as file:
+            file.write(text)
+
+def restore(entry, elastix_output_dir, points_output_dir=None, initial_transform=None):
+    '''
+    Copy a cached registration into its output directories, as if elastix and transformix had run.
+
+    Args:
+        entry ('dict'): Entry from lookup.
+        elastix_output_dir ('str'): Elastix output directory to restore the transforms and logs to.
+        points_output_dir ('str'): Optional transformix output directory to restore the points to.
+        initial_transform ('str'): Optional initial transform (-t0) of the registration.
+
+    Returns:
+        restored ('list'): Paths of the restored files.
+    '''
+    restored = []
+
+    for subdir, output_dir in [('images', elastix_output_dir), ('points', points_output_dir)]:
+        if not output_dir:
+            continue
+        os.makedirs(output_dir, exist_ok=True)
+        source_dir = os.path.join(entry['directory'], subdir)
+        for filename in sorted(os.listdir(source_dir)):
+            restored.append(shutil.copy2(os.path.join(source_dir, filename), os.path.join(output_dir, filename)))
+
+    _relink_transforms(elastix_output_dir.replace('\\', '/'), entry['transforms'], initial_transform)
+    return restored
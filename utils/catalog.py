@@ -0,0 +1,408 @@
+import os
+import re
+import copy
+import json
+import hashlib
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+from .storage import expand_compacted
+
+# directory of the cached scans, under the experiments output root. The dataset trees are input and stay read-only
+CATALOG_DIRNAME = '.catalog'
+
+# name of the cached scan older versions wrote at the root of every scanned tree, skipped by the scans
+CATALOG_FILENAME = '.catalog.json'
+
+# bump this when the cached scan layout changes, older caches are then rebuilt
+CATALOG_VERSION = 1
+
+# scans and descriptions already loaded by this process (e.g. the pipeline service), checked like the files
+_SCANS = {}
+_DESCRIPTIONS = {}
+
+# copd1_eBHCT.img, copd1_iBHCT.nii.gz, copd1_eBHCT_lung.nii.gz, ...
+VOLUME_PATTERN = re.compile(r'^(?P<subject>[^_]+)_(?P<phase>[ei])BHCT(?P<mask>_lung)?\.(?P<ext>img|nii\.gz)$')
+
+# copd1_300_iBH_xyz_r1.txt, copd1_300_eBH_xyz_r1.txt, ...
+KEYPOINTS_PATTERN = re.compile(r'^(?P<subject>[^_]+)_(?P<count>\d+)_(?P<phase>[ei])BH_xyz_r1\.txt$')
+
+
+@dataclass
+class RegistrationRecord:
+    '''
+    Outputs of a single elastix/transformix run found in the output tree.
+
+    The layout follows create_script.py:
+    <output>/<experiment>/<reg_params_key>/{images,points,labels}/output_<fixed_name>/<moving_name>/
+    '''
+    experiment: str
+    reg_params_key: str
+    fixed_name: str
+    moving_name: str
+    images_dir: Optional[str] = None
+    points_dir: Optional[str] = None
+    labels_dir: Optional[str] = None
+    transform_parameters: list = field(default_factory=list)
+    output_points: Optional[str] = None
+    transformed_points: Optional[str] = None
+    warped_labels: list = field(default_factory=list)
+
+
+@dataclass
+class SubjectRecord:
+    '''
+    All the files and metadata known about a single subject (e.g. copd1) of a dataset split.
+    '''
+    name: str
+    split: str
+    directory: str
+    exhale_raw: Optional[str] = None
+    inhale_raw: Optional[str] = None
+    exhale_volume: Optional[str] = None
+    inhale_volume: Optional[str] = None
+    exhale_mask: Optional[str] = None
+    inhale_mask: Optional[str] = None
+    exhale_keypoints: Optional[str] = None
+    inhale_keypoints: Optional[str] = None
+    metadata: dict = field(default_factory=dict)
+    registrations: list = field(default_factory=list)
+
+    def get_registration(self, experiment, reg_params_key):
+        '''
+        Get the registration outputs of this subject for a given experiment and parameters key.
+
+        Args:
+            experiment ('str'): Experiment name.
+            reg_params_key ('str'): Registration parameters key generated by create_script.py.
+
+        Returns:
+            registration ('RegistrationRecord'): The matching record, None if the run was not found.
+        '''
+        for registration in self.registrations:
+            if registration.experiment == experiment and registration.reg_params_key == reg_params_key:
+                return registration
+        return None
+
+    @property
+    def index_base(self):
+        '''
+        Base of the keypoint indices, 1 as in the DIR-Lab files unless description.json records it (e.g. 0 for
+        the synthetic datasets of make_synthetic_dataset.py).
+        '''
+        return self.metadata.get('index_base', 1)
+
+
+@dataclass
+class Catalog:
+    '''
+    Per-subject records of a dataset split, optionally linked to the registration outputs of an output tree.
+    '''
+    dataset_path: str
+    split: str
+    subjects: dict = field(default_factory=dict)
+    description: dict = field(default_factory=dict)
+
+    def sorted_subjects(self):
+        '''
+        Get the subject records sorted by name, the same order the glob based scripts used.
+
+        Returns:
+            subjects ('list'): List of SubjectRecord.
+        '''
+        return [self.subjects[name] for name in sorted(self.subjects)]
+
+    def paths(self, attribute):
+        '''
+        Get a sorted list of an existing path attribute over all subjects (e.g. 'exhale_volume').
+
+        Args:
+            attribute ('str'): SubjectRecord attribute name.
+
+        Returns:
+            paths ('list'): List of paths, subjects missing the file are skipped.
+        '''
+        return [getattr(subject, attribute) for subject in self.sorted_subjects() if getattr(subject, attribute)]
+
+
+def _join(*parts):
+    return '/'.join(part.replace('\\', '/').rstrip('/') for part in parts if part)
+
+
+def _scan_directory(root):
+    '''
+    Walk a directory tree once, collecting the relative file paths and the mtime of every directory.
+
+    Args:
+        root ('str'): Root directory to scan.
+
+    Returns:
+        files ('list'): Sorted list of file paths relative to root (forward slashes).
+        directories ('dict'): Relative directory path -> mtime_ns.
+    '''
+    files, directories = [], {}
+    stack = ['']
+
+    while stack:
+        relative = stack.pop()
+        absolute = os.path.join(root, relative) if relative else root
+        try:
+            directories[relative] = os.stat(absolute).st_mtime_ns
+            entries = list(os.scandir(absolute))
+        except FileNotFoundError:
+            continue
+
+        for entry in entries:
+            entry_relative = _join(relative, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != CATALOG_DIRNAME:
+                    stack.append(entry_relative)
+            elif entry.name != CATALOG_FILENAME:
+                files.append(entry_relative)
+
+    return sorted(files), directories
+
+
+def _is_scan_valid(root, scan):
+    '''
+    Check a cached scan against the directory mtimes. Adding, removing or renaming a file changes the
+    mtime of its parent directory, so a stat per directory is enough to detect a stale scan.
+
+    Args:
+        root ('str'): Root directory of the scan.
+        scan ('dict'): Cached scan loaded from disk.
+
+    Returns:
+        valid ('bool'): True if none of the directories changed since the scan.
+    '''
+    if scan.get('version') != CATALOG_VERSION:
+        return False
+
+    for relative, mtime_ns in scan['directories'].items():
+        try:
+            if os.stat(os.path.join(root, relative) if relative else root).st_mtime_ns != mtime_ns:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def scan_tree(root, cache_dir=None, refresh=False):
+    '''
+    Get the list of files of a tree, reusing the scan saved in <cache_dir>/.catalog while it is still valid.
+
+    Args:
+        root ('str'): Root directory to scan.
+        cache_dir ('str'): Experiments output root the scan is saved under. If None, the scan is only kept in memory.
+        refresh ('bool'): If True, ignore the saved scan and walk the tree again.
+
+    Returns:
+        files ('list'): Sorted list of file paths relative to root (forward slashes).
+    '''
+    if not os.path.isdir(root):
+        return []
+
+    memory_key = os.path.abspath(root)
+    cache_path = None
+    if cache_dir:
+        # one file per scanned tree, named after its absolute path
+        digest = hashlib.sha1(memory_key.replace('\\', '/').encode()).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, CATALOG_DIRNAME, f'{digest}.json')
+
+    # a long running process validates the scan it already holds instead of reading the file again
+    if not refresh and memory_key in _SCANS and _is_scan_valid(root, _SCANS[memory_key]):
+        return _SCANS[memory_key]['files']
+
+    if not refresh and cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as json_file:
+                scan = json.load(json_file)
+            if _is_scan_valid(root, scan):
+                _SCANS[memory_key] = scan
+                return scan['files']
+        except (ValueError, KeyError, OSError):
+            pass
+
+    # the cache directory can sit in the scanned tree (the output root), it is created before the directory mtimes
+    # are taken. The scans written in it afterwards only change its own mtime, which is not tracked.
+    if cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        except OSError:
+            cache_path = None
+
+    files, directories = _scan_directory(root)
+    scan = {'version': CATALOG_VERSION, 'files': files, 'directories': directories}
+    _SCANS[memory_key] = scan
+
+    if cache_path:
+        try:
+            with open(cache_path, 'w') as json_file:
+                json.dump(scan, json_file)
+        except OSError:
+            # read-only outputs are still scanned, just not cached
+            pass
+
+    return files
+
+
+def get_split_name(dataset_path):
+    '''
+    Get the split name (e.g. train, test) from a dataset split path such as dataset/train.
+
+    Args:
+        dataset_path ('str'): Path to the dataset split.
+
+    Returns:
+        split ('str'): Split name.
+    '''
+    return os.path.normpath(dataset_path).replace('\\', '/').split('/')[-1]
+
+
+def load_description(dataset_path):
+    '''
+    Load the description.json file that sits next to the dataset split directory.
+
+    Args:
+        dataset_path ('str'): Path to the dataset split (e.g. dataset/train).
+
+    Returns:
+        description ('dict'): The dataset description, empty if the file does not exist.
+    '''
+    description_path = os.path.join(os.path.dirname(os.path.normpath(dataset_path)), 'description.json')
+
+    if not os.path.exists(description_path):
+        return {}
+
+    mtime_ns = os.stat(description_path).st_mtime_ns
+    cached = _DESCRIPTIONS.get(os.path.abspath(description_path))
+    if cached is None or cached[0] != mtime_ns:
+        with open(description_path, 'r') as json_file:
+            cached = (mtime_ns, json.load(json_file))
+        _DESCRIPTIONS[os.path.abspath(description_path)] = cached
+
+    return copy.deepcopy(cached[1])
+
+
+def _add_dataset_file(subjects, dataset_path, split, relative):
+    '''
+    Classify a single dataset file and attach it to its subject record.
+    '''
+    filename = relative.split('/')[-1]
+    directory = _join(dataset_path, os.path.dirname(relative))
+
+    volume_match = VOLUME_PATTERN.match(filename)
+    keypoints_match = KEYPOINTS_PATTERN.match(filename)
+
+    if volume_match:
+        name = volume_match.group('subject')
+        phase = 'exhale' if volume_match.group('phase') == 'e' else 'inhale'
+        if volume_match.group('mask'):
+            attribute = f'{phase}_mask'
+        elif volume_match.group('ext') == 'img':
+            attribute = f'{phase}_raw'
+        else:
+            attribute = f'{phase}_volume'
+    elif keypoints_match:
+        name = keypoints_match.group('subject')
+        phase = 'exhale' if keypoints_match.group('phase') == 'e' else 'inhale'
+        attribute = f'{phase}_keypoints'
+    else:
+        return
+
+    subject = subjects.setdefault(name, SubjectRecord(name=name, split=split, directory=directory))
+    setattr(subject, attribute, _join(dataset_path, relative))
+
+
+def _add_output_file(registrations, output_path, relative):
+    '''
+    Classify a single output file (<experiment>/<key>/{images,points,labels}/output_<fixed>/<moving>/<file>) and
+    attach it to its registration record.
+    '''
+    parts = relative.split('/')
+    if len(parts) != 6 or parts[2] not in ('images', 'points', 'labels') or not parts[3].startswith('output_'):
+        return
+
+    experiment, reg_params_key, kind, fixed_dir, moving_name, filename = parts
+    fixed_name = fixed_dir[len('output_'):]
+
+    key = (experiment, reg_params_key, fixed_name, moving_name)
+    registration = registrations.setdefault(key, RegistrationRecord(
+        experiment=experiment, reg_params_key=reg_params_key, fixed_name=fixed_name, moving_name=moving_name))
+
+    path = _join(output_path, relative)
+    if kind == 'images':
+        registration.images_dir = os.path.dirname(path)
+        if re.match(r'^TransformParameters\.\d+\.txt$', filename):
+            registration.transform_parameters.append(path)
+    elif kind == 'labels':
+        registration.labels_dir = os.path.dirname(path)
+        if filename.endswith('.nii.gz'):
+            registration.warped_labels.append(path)
+    else:
+        registration.points_dir = os.path.dirname(path)
+        if filename == 'outputpoints.txt':
+            registration.output_points = path
+        elif filename == 'outputpoints_transformed.txt':
+            registration.transformed_points = path
+
+
+def load_catalog(dataset_path, output_path=None, experiments=None, cache_dir=None, refresh=False):
+    '''
+    Build the catalog of a dataset split from a single (cached) scan of the dataset tree and, optionally,
+    of the experiments output tree.
+
+    Args:
+        dataset_path ('str'): Path to the dataset split (e.g. dataset/train).
+        output_path ('str'): Optional experiments output root (e.g. output) to link the registration outputs.
+        experiments ('list'): Optional experiment names to restrict the output scan to.
+        cache_dir ('str'): Experiments output root the scans are saved under, output_path by default. If neither
+            is given, the scans are only kept in memory.
+        refresh ('bool'): If True, ignore the saved scans.
+
+    Returns:
+        catalog ('Catalog'): Catalog of the dataset split.
+    '''
+    dataset_path = dataset_path.replace('\\', '/').rstrip('/')
+    split = get_split_name(dataset_path)
+    description = load_description(dataset_path)
+    cache_dir = cache_dir or output_path
+
+    subjects = {}
+    for relative in scan_tree(dataset_path, cache_dir=cache_dir, refresh=refresh):
+        _add_dataset_file(subjects, dataset_path, split, relative)
+
+    for name, subject in subjects.items():
+        subject.metadata = description.get(split, {}).get(name, {})
+
+    if output_path:
+        output_path = output_path.replace('\\', '/').rstrip('/')
+        roots = [('', output_path)] if experiments is None else [(experiment, f'{output_path}/{experiment}') for experiment in experiments]
+
+        registrations = {}
+        for prefix, root in roots:
+            # the compacted runs are listed from their index, see utils.storage
+            for relative in expand_compacted(root, scan_tree(root, cache_dir=cache_dir, refresh=refresh)):
+                _add_output_file(registrations, output_path, _join(prefix, relative))
+
+        for registration in registrations.values():
+            registration.transform_parameters.sort(key=lambda path: int(path.split('.')[-2]))
+            registration.warped_labels.sort()
+            subject = subjects.get(registration.fixed_name.split('_')[0])
+            if subject is not None:
+                subject.registrations.append(registration)
+
+    return Catalog(dataset_path=dataset_path, split=split, subjects=subjects, description=description)
+
+
+def catalog_to_dict(catalog):
+    '''
+    Convert a catalog to a json serializable dictionary.
+
+    Args:
+        catalog ('Catalog'): Catalog to convert.
+
+    Returns:
+        dictionary ('dict'): Dictionary representation of the catalog.
+    '''
+    return asdict(catalog)
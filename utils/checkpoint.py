@@ -0,0 +1,307 @@
+import os
+import re
+import json
+import shutil
+
+from .elastix import read_parameter_file, write_parameter_file, parameters_fingerprint
+from .monitor import EARLY_STOPPING_FILENAME
+
+# record of a registration written in its elastix output directory, the checkpoints of the directory are only
+# used to resume the registration it describes
+CHECKPOINT_FILENAME = 'checkpoint.json'
+
+# TransformParameters.<level>.txt after every parameter file, TransformParameters.<level>.R<resolution>.txt after
+# every resolution with (WriteTransformParametersEachResolution "true"), IterationInfo.<level>.R<resolution>.txt
+CHECKPOINT_PATTERN = re.compile(r'^TransformParameters\.(?P<level>\d+)(?:\.R(?P<resolution>\d+))?\.txt$')
+RESUMED_FILE_PATTERN = re.compile(r'^(?P<prefix>TransformParameters|IterationInfo)\.(?P<level>\d+)(?:\.R(?P<resolution>\d+))?\.txt$')
+
+# parameters with one value per resolution (or one per resolution and dimension for the schedules)
+PER_RESOLUTION_PARAMETERS = (
+    'MaximumNumberOfIterations', 'NumberOfSpatialSamples', 'NumberOfHistogramBins', 'NumberOfFixedHistogramBins',
+    'NumberOfMovingHistogramBins', 'SP_a', 'SP_A', 'SP_alpha', 'MaximumStepLength', 'MaximumNumberOfSamplingAttempts',
+    'NewSamplesEveryIteration', 'ImageSampler', 'BSplineInterpolationOrder', 'FixedKernelBSplineOrder',
+    'MovingKernelBSplineOrder', 'NumberOfJacobianMeasurements', 'NumberOfGradientMeasurements',
+    'NumberOfSamplesForExactGradient', 'ErodeMask', 'Metric0Weight', 'Metric1Weight')
+SCHEDULE_PARAMETERS = ('ImagePyramidSchedule', 'FixedImagePyramidSchedule', 'MovingImagePyramidSchedule', 'GridSpacingSchedule')
+
+
+def is_elastix_command(command):
+    '''
+    True for elastix command lines with an output directory (-out), the commands that can be resumed.
+    '''
+    executable = command.strip().split(' ')[0].replace('\\', '/').split('/')[-1].lower()
+    return executable.startswith('elastix') and _argument_values(command, '-out') != []
+
+def _argument_values(command, flag):
+    return [quoted or plain for quoted, plain in re.findall(rf'(?:^|\s){flag}\s+(?:"([^"]+)"|(\S+))', command)]
+
+def _replace_arguments(command, parameter_files, initial_transform, output_dir):
+    # the -p, -t0 and -out arguments are written again, the others (images, masks, -threads) are kept
+    command = re.sub(r'\s(?:-p|-t0|-out)\s+(?:"[^"]+"|\S+)', '', command)
+    command += ''.join(f' -p "{path}"' for path in parameter_files)
+    command += f' -t0 "{initial_transform}"' if initial_transform else ''
+    return command + f' -out "{output_dir}"'
+
+def _signature(command):
+    # what makes a registration, its checkpoints are not valid for another one
+    return {
+        'fixed': _argument_values(command, '-f'),
+        'moving': _argument_values(command, '-m'),
+        'masks': _argument_values(command, '-fMask') + _argument_values(command, '-mMask'),
+        'initial_transform': _argument_values(command, '-t0'),
+        'parameters': [parameters_fingerprint(path) for path in _argument_values(command, '-p')],
+    }
+
+def load_record(output_dir):
+    '''
+    Load the checkpoint record of an elastix output directory.
+
+    Args:
+        output_dir ('str'): Elastix output directory.
+
+    Returns:
+        record ('dict'): signature, resumes and completed checkpoints, None without record.
+    '''
+    record_path = os.path.join(output_dir, CHECKPOINT_FILENAME)
+    try:
+        with open(record_path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+def _save_record(output_dir, record):
+    tmp_path = os.path.join(output_dir, f'{CHECKPOINT_FILENAME}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as json_file:
+        json.dump(record, json_file, indent=4)
+    os.replace(tmp_path, os.path.join(output_dir, CHECKPOINT_FILENAME))
+
+def is_complete_transform(path):
+    '''
+    True if a TransformParameters file was completely written, elastix may have been killed while writing it.
+    '''
+    try:
+        parameters = read_parameter_file(path)
+    except (OSError, UnicodeDecodeError):
+        return False
+    count = parameters.get('NumberOfParameters', [None])[0]
+    return 'TransformParameters' in parameters and (count is None or len(parameters['TransformParameters']) == count)
+
+def find_checkpoints(output_dir):
+    '''
+    Complete transforms of an elastix output directory, in the order elastix wrote them.
+
+    Args:
+        output_dir ('str'): Elastix output directory.
+
+    Returns:
+        checkpoints ('list'): (level, resolution, path) tuples, resolution is None for the transform of a finished
+            parameter file, which comes after the transforms of its resolutions.
+    '''
+    checkpoints = []
+    for filename in os.listdir(output_dir) if os.path.isdir(output_dir) else []:
+        match = CHECKPOINT_PATTERN.match(filename)
+        if match and is_complete_transform(os.path.join(output_dir, filename)):
+            resolution = None if match.group('resolution') is None else int(match.group('resolution'))
+            checkpoints.append((int(match.group('level')), resolution, os.path.join(output_dir, filename).replace('\\', '/')))
+
+    return sorted(checkpoints, key=lambda checkpoint: (checkpoint[0], float('inf') if checkpoint[1] is None else checkpoint[1]))
+
+def truncate_resolutions(parameters, start):
+    '''
+    Drop the first resolutions of a parameter file, the remaining schedule of a resumed registration.
+
+    Args:
+        parameters ('dict'): Parameters, see read_parameter_file.
+        start ('int'): Number of finished resolutions.
+
+    Returns:
+        parameters ('dict'): Parameters of the remaining resolutions.
+    '''
+    resolutions = parameters.get('NumberOfResolutions', [1])[0]
+    dimension = parameters.get('FixedImageDimension', [3])[0]
+    truncated = dict(parameters)
+
+    for key, values in parameters.items():
+        if key in SCHEDULE_PARAMETERS and len(values) == resolutions * dimension:
+            truncated[key] = values[start * dimension:]
+        elif key in PER_RESOLUTION_PARAMETERS + SCHEDULE_PARAMETERS and len(values) == resolutions and resolutions > 1:
+            truncated[key] = values[start:]
+
+    truncated['NumberOfResolutions'] = [resolutions - start]
+    return truncated
+
+def prepare_resume(command):
+    '''
+    Prepare an elastix command to resume from the last checkpoint of its output directory. The first run of a
+    registration records it; when it runs again (e.g. after a crash or a preemption), the parameter files and
+    resolutions that finished are skipped: the last complete transform is the initial transform (-t0) of the
+    remaining schedule, which runs in a resume<N> subdirectory (see finish_resume). A registration stopped on
+    purpose by the stopping rule (early_stopping.txt, see utils.monitor) is not resumed, it runs again from the start.
+
+    The resumed B-spline levels start from the per-resolution transform instead of the upsampled grid elastix
+    would carry over, so the result is close to, not the same as, an uninterrupted run.
+
+    Args:
+        command ('str'): Elastix command line.
+
+    Returns:
+        command ('str'): Command to run, None if the registration already finished.
+        resume ('dict'): State for finish_resume, None if the command runs from the start.
+    '''
+    if not is_elastix_command(command):
+        return command, None
+
+    output_dir = _argument_values(command, '-out')[-1]
+    parameter_files = _argument_values(command, '-p')
+    signature = _signature(command)
+    record = load_record(output_dir)
+
+    # a new registration, the transforms of an earlier one in the same directory are not checkpoints, and the
+    # checkpoints of a stopped (diverged) run would only resume the divergence
+    stopped = os.path.exists(os.path.join(output_dir, EARLY_STOPPING_FILENAME))
+    if record is None or record.get('signature') != signature or stopped:
+        os.makedirs(output_dir, exist_ok=True)
+        for filename in os.listdir(output_dir):
+            if CHECKPOINT_PATTERN.match(filename) or filename == EARLY_STOPPING_FILENAME:
+                os.remove(os.path.join(output_dir, filename))
+            elif re.match(r'^resume\d+$', filename) and os.path.isdir(os.path.join(output_dir, filename)):
+                shutil.rmtree(os.path.join(output_dir, filename))
+        _save_record(output_dir, {'signature': signature, 'resumes': 0, 'completed': [], 'pending': None})
+        return command, None
+
+    # the checkpoints of an interrupted resumed run are in its resume<N> subdirectory
+    if record.get('pending'):
+        finish_resume(record['pending'])
+        record = load_record(output_dir)
+
+    checkpoints = find_checkpoints(output_dir)
+    record['completed'] = [[level, resolution] for level, resolution, _ in checkpoints]
+    if not checkpoints:
+        _save_record(output_dir, record)
+        return command, None
+
+    last_level = len(parameter_files) - 1
+    level, resolution, checkpoint = checkpoints[-1]
+    if level == last_level and resolution is None:
+        _save_record(output_dir, record)
+        return None, None
+
+    # the last resolution of the level finished, only the final transform of the level is missing
+    if resolution is not None and resolution + 1 >= read_parameter_file(parameter_files[level]).get('NumberOfResolutions', [1])[0]:
+        final_path = os.path.join(output_dir, f'TransformParameters.{level}.txt').replace('\\', '/')
+        shutil.copy2(checkpoint, final_path)
+        checkpoint, resolution = final_path, None
+        if level == last_level:
+            _save_record(output_dir, record)
+            return None, None
+
+    record['resumes'] += 1
+    resume_dir = os.path.join(output_dir, f"resume{record['resumes']}").replace('\\', '/')
+    os.makedirs(resume_dir, exist_ok=True)
+
+    # the remaining resolutions of the interrupted parameter file, then the next parameter files
+    remaining = parameter_files[level + 1:]
+    resume = {'output_dir': output_dir, 'resume_dir': resume_dir, 'checkpoint': checkpoint, 'level_offset': level + 1, 'resolution_offset': 0}
+    if resolution is not None:
+        truncated_path = os.path.join(resume_dir, os.path.basename(parameter_files[level])).replace('\\', '/')
+        write_parameter_file(truncate_resolutions(read_parameter_file(parameter_files[level]), resolution + 1), truncated_path)
+        remaining = [truncated_path] + remaining
+        resume.update({'level_offset': level, 'resolution_offset': resolution + 1})
+
+    record['pending'] = resume
+    _save_record(output_dir, record)
+    return _replace_arguments(command, remaining, checkpoint, resume_dir), resume
+
+def finish_resume(resume):
+    '''
+    Move the transforms and iteration logs of a resumed run to the output directory, numbered as the
+    uninterrupted run would have numbered them, so transformix and the log analysis find them. Called when
+    the run finished, or by prepare_resume when it was interrupted too (its complete transforms are checkpoints).
+
+    Args:
+        resume ('dict'): State returned by prepare_resume.
+
+    Returns:
+        moved ('list'): Paths of the moved files.
+    '''
+    output_dir, resume_dir = resume['output_dir'], resume['resume_dir']
+
+    def target_name(match):
+        level = int(match.group('level'))
+        name = f"{match.group('prefix')}.{level + resume['level_offset']}"
+        if match.group('resolution') is not None:
+            name += f".R{int(match.group('resolution')) + (resume['resolution_offset'] if level == 0 else 0)}"
+        return name + '.txt'
+
+    renamed = {}
+    for filename in os.listdir(resume_dir):
+        match = RESUMED_FILE_PATTERN.match(filename)
+        if match and (match.group('prefix') == 'IterationInfo' or is_complete_transform(os.path.join(resume_dir, filename))):
+            renamed[filename] = target_name(match)
+
+    moved = []
+    for filename, target in sorted(renamed.items()):
+        with open(os.path.join(resume_dir, filename), 'r') as file:
+            text = file.read()
+
+        # the transforms of the resumed run point to each other inside resume_dir
+        def relink(match):
+            path = match.group(1)
+            name = os.path.basename(path)
+            if os.path.normpath(os.path.dirname(path)) == os.path.normpath(resume_dir) and name in renamed:
+                path = f'{output_dir}/{renamed[name]}'.replace('\\', '/')
+            return f'(InitialTransformParametersFileName "{path}")'
+        text = re.sub(r'\(InitialTransformParametersFileName\s+"([^"]*)"\)', relink, text)
+
+        target_path = os.path.join(output_dir, target)
+        with open(target_path, 'w') as file:
+            file.write(text)
+        moved.append(target_path)
+
+    # the log of the resumed run goes after the log of the interrupted one, it holds the total time
+    log_path = os.path.join(resume_dir, 'elastix.log')
+    if os.path.exists(log_path):
+        with open(log_path, 'r', errors='replace') as source, open(os.path.join(output_dir, 'elastix.log'), 'a') as destination:
+            destination.write(f"\nResumed from {resume['checkpoint']}\n")
+            shutil.copyfileobj(source, destination)
+
+    record = load_record(output_dir)
+    if record is not None:
+        record['completed'] = [[level, resolution] for level, resolution, _ in find_checkpoints(output_dir)]
+        record['pending'] = None
+        _save_record(output_dir, record)
+
+    return moved
+
+def is_resumed(output_dir):
+    '''
+    True if the registration of an elastix output directory was resumed, its transforms then depend on the
+    checkpoint files of the directory.
+    '''
+    record = load_record(output_dir)
+    return bool(record and record.get('resumes'))
+
+async def run_resumable(command, log_path=None, timeout=None):
+    '''
+    utils.executor.run_command for the commands of the registration runners, the elastix commands resume from
+    their checkpoints (see prepare_resume) and the finished ones are not run again.
+
+    Args:
+        command ('str'): Command line.
+        log_path ('str'): Optional file the output of the command is written to.
+        timeout ('float'): Optional time limit in seconds.
+
+    Returns:
+        result ('dict'): run_command result, with resumed (bool) and skipped (bool).
+    '''
+    from .executor import run_command
+
+    resumed_command, resume = prepare_resume(command)
+    if resumed_command is None:
+        return {'command': command, 'returncode': 0, 'duration': 0.0, 'peak_memory': None, 'timed_out': False,
+                'log_path': log_path, 'resumed': False, 'skipped': True}
+
+    result = await run_command(resumed_command, log_path=log_path, timeout=timeout)
+    if resume and result['returncode'] == 0:
+        finish_resume(resume)
+    return {**result, 'resumed': resume is not None, 'skipped': False}
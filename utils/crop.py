@@ -0,0 +1,103 @@
+import numpy as np
+
+from .landmarks import iter_keypoints, has_transformix_header, POINTS_CHUNK_SIZE
+
+
+def mask_bounding_box(mask_image):
+    '''
+    Bounding box of the foreground of a mask, in voxel indices (x y z).
+
+    Args:
+        mask_image ('sitk.Image'): Lung mask, any non zero voxel is foreground.
+
+    Returns:
+        start ('np.array'): First foreground index along every axis (3,).
+        stop ('np.array'): One past the last foreground index along every axis (3,).
+    '''
+    import SimpleITK as sitk
+
+    # the projections of the mask on every axis are enough, no foreground coordinates are stored
+    array = sitk.GetArrayViewFromImage(mask_image) != 0
+    if not array.any():
+        raise ValueError("The mask is empty, its bounding box is not defined")
+
+    start, stop = [], []
+    for axis in (2, 1, 0):
+        profile = np.flatnonzero(array.any(axis=tuple(other for other in range(3) if other != axis)))
+        start.append(profile[0])
+        stop.append(profile[-1] + 1)
+
+    return np.array(start), np.array(stop)
+
+def union_bounding_box(mask_images, padding=10.0):
+    '''
+    Padded union of the bounding boxes of several masks sharing the same voxel grid (e.g. the inhale and
+    exhale lung masks of a subject), so both volumes are cropped to the same index frame.
+
+    Args:
+        mask_images ('list'): Masks (sitk.Image).
+        padding ('float'): Margin added on every side, in mm.
+
+    Returns:
+        start ('np.array'): First index of the crop (3,).
+        size ('np.array'): Size of the crop (3,), clipped to the smallest mask.
+    '''
+    boxes = [mask_bounding_box(mask_image) for mask_image in mask_images]
+    spacing = np.array(mask_images[0].GetSpacing())
+    grid_size = np.min([mask_image.GetSize() for mask_image in mask_images], axis=0)
+
+    margin = np.ceil(padding / spacing).astype(int)
+    start = np.maximum(np.min([box[0] for box in boxes], axis=0) - margin, 0)
+    stop = np.minimum(np.max([box[1] for box in boxes], axis=0) + margin, grid_size)
+
+    return start, stop - start
+
+def crop_image(image, start, size):
+    '''
+    Crop an image to a region of its voxel grid. The origin of the cropped image is moved to the physical
+    position of the first voxel kept, so every voxel keeps its physical coordinates.
+
+    Args:
+        image ('sitk.Image'): Volume or mask.
+        start ('np.array'): First index of the region (3,).
+        size ('np.array'): Size of the region (3,).
+
+    Returns:
+        cropped ('sitk.Image'): Cropped image.
+    '''
+    import SimpleITK as sitk
+
+    return sitk.RegionOfInterest(image, [int(value) for value in size], [int(value) for value in start])
+
+def shift_keypoints(file_path, output_path, offset, chunk_size=POINTS_CHUNK_SIZE):
+    '''
+    Write the keypoints of a file shifted by an index offset, chunk by chunk. Subtracting the crop start
+    moves landmarks into the cropped frame, adding it moves them back to the original frame. The transformix
+    header, if any, is kept.
+
+    Args:
+        file_path ('str'): Path to the keypoints text file.
+        output_path ('str'): Path to the shifted keypoints text file.
+        offset ('np.array'): Offset added to every keypoint (3,).
+        chunk_size ('int'): Number of points per chunk.
+
+    Returns:
+        count ('int'): Number of keypoints written.
+    '''
+    offset = np.asarray(offset)
+    chunks = iter_keypoints(file_path, chunk_size=chunk_size)
+
+    with open(file_path, 'r') as file:
+        header = [next(file), next(file)] if has_transformix_header(file_path) else []
+
+    count = 0
+    with open(output_path, 'w') as file:
+        file.writelines(header)
+        for chunk in chunks:
+            shifted = chunk + offset
+            # integer indices stay integers, the subvoxel ones keep their precision
+            fmt = '%d' if np.all(shifted == np.round(shifted)) else '%.6f'
+            np.savetxt(file, shifted, fmt=fmt, delimiter='\t')
+            count += len(chunk)
+
+    return count
@@ -2,9 +2,7 @@ import SimpleITK as sitk
 import os
 import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.ndimage import binary_closing
-from skimage import measure
+from .lazy import moved_attributes
 
 def read_raw(
     binary_file_name,
@@ -127,9 +125,9 @@ def create_mask(volume, threshold = 700):
         threshold (int): threshold to be used for the masking
 
     Returns:
-        numpy array: masked volume
+        numpy array: boolean mask, 1 byte per voxel
     '''
-    return np.where(volume <= threshold, 1, 0)
+    return volume <= threshold
 
 def label_regions(mask):
     '''
@@ -139,9 +137,13 @@ def label_regions(mask):
         mask (numpy array): Binary mask.
 
     Returns:
-        tuple: A tuple containing labeled mask and the number of labels.
+        tuple: A tuple containing labeled mask (int32) and the number of labels.
     '''
-    labeled_mask, num_labels = measure.label(mask, connectivity=2, return_num=True, background=0)
+    from scipy.ndimage import label, generate_binary_structure
+
+    # the connectivity=2 neighbourhood of skimage.measure.label, written straight to int32 labels (skimage returns int64)
+    labeled_mask = np.empty(mask.shape, dtype=np.int32)
+    num_labels = label(mask, structure=generate_binary_structure(mask.ndim, 2), output=labeled_mask)
     return labeled_mask, num_labels
 
 def get_largest_regions(labeled_mask, num_regions=2):
@@ -155,6 +157,8 @@ def get_largest_regions(labeled_mask, num_regions=2):
     Returns:
         list: List of region properties for the largest regions.
     '''
+    from skimage import measure
+
     regions = measure.regionprops(labeled_mask)
     regions.sort(key=lambda x: x.area, reverse=True)
     regions = regions[:min(num_regions, len(regions))]
@@ -188,7 +192,9 @@ def fill_holes_and_erode(mask, structure=(7, 7, 5)):
     Returns:
         numpy array: Processed mask after filling holes and erosion.
     '''
-    processed_mask = binary_closing(mask, structure=np.ones(structure))
+    from scipy.ndimage import binary_closing
+
+    processed_mask = binary_closing(mask, structure=np.ones(structure, dtype=bool))
 
     return processed_mask
 
@@ -202,39 +208,38 @@ def remove_trachea(largest_masks, get_largest_regions, create_masks):
         create_masks (function): Function to create masks.
 
     Returns:
-        numpy array: 3D array of masks with trachea removed.
+        numpy array: 3D boolean array of masks with trachea removed.
     '''
-    # Find bounding boxes for each region in the 3D mask
-    labeled_mask_slices = np.array([label_regions(largest_masks[idx, :, :])[0] for idx in range(largest_masks.shape[0])])
-    # labeled_mask_slices = np.transpose(labeled_mask_slices, (1, 2, 0))
+    largest_regions_masks = np.zeros(largest_masks.shape, dtype=bool)
 
-    largest_regions_slices = [
-        get_largest_regions(labeled_mask_slices[idx, :, :], num_regions=3)
-        for idx in range(labeled_mask_slices.shape[0])
-    ]
+    # the slices are labelled one at a time, only the labels of the current slice are kept in memory
+    for idx in range(largest_masks.shape[0]):
+        labeled_mask_slice = label_regions(largest_masks[idx, :, :])[0]
+        region = get_largest_regions(labeled_mask_slice, num_regions=3)
 
-    largest_regions_masks = [
         # we filter the trachea by checking the difference between the major and minor axis length when there is only 1 region
-        create_masks(labeled_mask_slices[idx, :, :], region)[0] if (len(region) == 1 and (abs(region[0].axis_major_length - region[0].axis_minor_length) > 30))
+        if len(region) == 1 and (abs(region[0].axis_major_length - region[0].axis_minor_length) > 30):
+            largest_regions_masks[idx] = create_masks(labeled_mask_slice, region)[0]
 
         # this handles the very first few slices with trachea that has a very small difference between the major and minor axis length
-        else np.zeros_like(labeled_mask_slices[idx, :, :]) if (len(region) == 1 and (abs(region[0].axis_major_length - region[0].axis_minor_length) < 30)) 
-        
+        elif len(region) == 1:
+            continue
+
         # remove the trachea if there are 3 regions, it will be the 3rd region as we sort by area (highest to lowest)
-        else create_masks(labeled_mask_slices[idx, :, :], region)[0] + create_masks(labeled_mask_slices[idx, :, :], region)[1] if len(region) == 3 
+        elif len(region) == 3:
+            first, second = create_masks(labeled_mask_slice, region[:2])
+            largest_regions_masks[idx] = first | second
 
         # when there are only 2 regions, we check the difference in the area (area of the first region has to be atleast 50 more than the second region) to indicate that it is a lung not a trachea
         # also check if the minor axis of the second region (trachea) is less than 100
         # this condition happens when both lungs are touching each other as a region, and trachea as another region
-        else create_masks(labeled_mask_slices[idx, :, :], region)[0] if len(region) == 2 and (getattr(region[0], 'area') - getattr(region[1], 'area') > 50) and (region[1].axis_minor_length < 100) 
+        elif len(region) == 2 and (getattr(region[0], 'area') - getattr(region[1], 'area') > 50) and (region[1].axis_minor_length < 100):
+            largest_regions_masks[idx] = create_masks(labeled_mask_slice, region[:1])[0]
 
         # when there are only 2 regions, we combine them. This is after the previous condition is met (when only 2 lungs are detected)
-        else create_masks(labeled_mask_slices[idx, :, :], region)[0] + create_masks(labeled_mask_slices[idx, :, :], region)[1] if len(region) == 2 
-
-        else np.zeros_like(labeled_mask_slices[idx, :, :])
-        for idx, region in enumerate(largest_regions_slices)
-    ]
-    # largest_regions_masks = np.transpose(largest_regions_masks, (1, 2, 0))
+        elif len(region) == 2:
+            first, second = create_masks(labeled_mask_slice, region)
+            largest_regions_masks[idx] = first | second
 
     return largest_regions_masks
 
@@ -264,8 +269,8 @@ def segment_lungs_and_remove_trachea(volume, threshold=700, structure=(7, 7, 5),
     # Get the largest three regions (two lungs and trachea)
     largest_regions = get_largest_regions(labeled_mask, num_regions=3)
 
-    # Create masks for the largest three regions
-    largest_masks = create_masks(labeled_mask, largest_regions)[1]
+    # Create the mask of the second largest region only (the lungs and the trachea)
+    largest_masks = create_masks(labeled_mask, largest_regions[1:2])[0]
 
     # fill holes of the largest mask
     if fill_holes_before_trachea_removal:
@@ -277,7 +282,8 @@ def segment_lungs_and_remove_trachea(volume, threshold=700, structure=(7, 7, 5),
     # Exclude the trachea by subtracting it from the processed mask
     processed_mask_without_trachea = fill_holes_and_erode(largest_masks_without_trachea, structure=structure)
 
-    return initial_mask, labeled_mask, largest_masks, processed_mask_without_trachea.astype(np.uint8)
+    # the boolean mask is viewed as uint8 (0 and 1), without a copy
+    return initial_mask, labeled_mask, largest_masks, processed_mask_without_trachea.view(np.uint8)
 
 def segment_body(image, threshold=700):
     '''
@@ -298,71 +304,13 @@ def segment_body(image, threshold=700):
     mask = create_mask(image, threshold=threshold)
     labeled_mask, _ = label_regions(mask)
     largest_regions = get_largest_regions(labeled_mask, num_regions=3)
-    largest_masks = create_masks(labeled_mask, largest_regions)[0]
-
-    # to have zeros and ones instead of binary false and true
-    largest_masks = largest_masks.astype(np.int8)
-
-    body_segmented = np.zeros_like(image)
-    body_segmented[largest_masks == 0] = image[largest_masks == 0]
-
-    return mask, labeled_mask, largest_masks, body_segmented
-
-
-def display_two_volumes(volume1, volume2, title1, title2, slice=70):
-    '''
-    Display two volumes side by side.
-
-    Args:
-        volume1 (numpy array): first volume to be displayed
-        volume2 (numpy array): second volume to be displayed
-        title1 (str): title of the first volume
-        title2 (str): title of the second volume
-        slice (int): slice to be displayed
-
-    Returns:
-        None
-    '''
-    plt.figure(figsize=(9, 6))
+    largest_masks = create_masks(labeled_mask, largest_regions[:1])[0]
 
-    plt.subplot(1, 2, 1)
-    plt.imshow(volume1[slice, :, :], cmap='gray') 
-    plt.title(title1)
-    plt.axis('off')
+    # the image outside the largest region, in a single allocation
+    body_segmented = np.where(largest_masks, image.dtype.type(0), image)
 
-
-    plt.subplot(1, 2, 2)
-    plt.imshow(volume2[slice, :, :], cmap='gray') 
-    plt.title(title2)
-    plt.axis('off')
-
-    plt.show()
-
-def display_volumes(*volumes, **titles_and_slices):
-    '''
-    Display multiple volumes side by side.
-
-    Args:
-        volumes (tuple of numpy arrays): volumes to be displayed
-        titles_and_slices (dict): titles and slices for each volume
-        
-    Returns:
-        None
-    '''
-    num_volumes = len(volumes)
-    
-    plt.figure(figsize=(6 * num_volumes, 6))
-
-    for i, volume in enumerate(volumes, start=1):
-        title = titles_and_slices.get(f'title{i}', f'Title {i}')
-        slice_val = titles_and_slices.get(f'slice{i}', 70)
-
-        plt.subplot(1, num_volumes, i)
-        plt.imshow(volume[slice_val, :, :], cmap='gray') #gray
-        plt.title(title)
-        plt.axis('off')
-
-    plt.show()
+    # to have zeros and ones instead of binary false and true, the boolean mask is viewed as uint8 without a copy
+    return mask, labeled_mask, largest_masks.view(np.uint8), body_segmented
 
 
 def min_max_normalization(image, mask = None, max_value=None):
@@ -384,15 +332,21 @@ def min_max_normalization(image, mask = None, max_value=None):
     
     print("Using mask for normalization" if mask is not None else "Not using mask for normalization")
 
-    # Ensure the image is a NumPy array for efficient calculations
-    image = np.array(image)
+    # Ensure the image is a NumPy array for efficient calculations, without copying it
+    image = np.asarray(image)
+
+    # Calculate the minimum and maximum pixel values, the masked voxels are selected once
+    values = image[mask == 1] if mask is not None else image
+    min_value, max_actual = np.min(values), np.max(values)
+    del values
+
+    # Perform min-max normalization, in place on a single float64 volume
+    normalized_image = np.subtract(image, min_value, dtype=np.float64)
+    normalized_image /= (max_actual - min_value)
+    normalized_image *= max_value
+    np.clip(normalized_image, 0, max_value, out=normalized_image)
 
-    # Calculate the minimum and maximum pixel values
-    min_value = np.min(image[mask == 1]) if mask is not None else np.min(image)
-    max_actual = np.max(image[mask == 1]) if mask is not None else np.max(image)
-    
-    # Perform min-max normalization
-    normalized_image = (image - min_value) / (max_actual - min_value) * max_value
-    normalized_image = np.clip(normalized_image, 0, max_value)
-    
     return normalized_image.astype(image.dtype)
+
+
+__getattr__ = moved_attributes(__name__, '.visualization', ('display_volumes', 'display_two_volumes'))
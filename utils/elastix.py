@@ -1,13 +1,23 @@
 import subprocess
 import os
+import re
+import json
+import hashlib
+from glob import glob
 
+from .storage import open_output
 
-def excute_cmd(command):
+# name of the file that records the parameter files an experiment was created with
+RUN_MANIFEST_FILENAME = 'parameters.json'
+
+
+def excute_cmd(command, check=False):
     '''
     Execute a command and check for success.
 
     Args:
         command ('str'): Command to execute.
+        check ('bool'): If True, raise subprocess.CalledProcessError when the command fails.
     
     Returns:
         result ('str'): Output of the command if successful.
@@ -23,6 +33,8 @@ def excute_cmd(command):
     else:
         print(f"Command failed with an error: {command}")
         print(result.stderr)
+        if check:
+            raise subprocess.CalledProcessError(result.returncode, command, output=result.stdout, stderr=result.stderr)
         return result.stderr
 
 # Perform registration and label propagation
@@ -33,7 +45,8 @@ def register_elastix(fixed_path,
                     create_dir_callback, 
                     excute_cmd_callback,
                     fMask = None,
-                    mMask = None):
+                    mMask = None,
+                    initial_transform = None):
     '''
     Perform image registration using elastix.
 
@@ -46,9 +59,10 @@ def register_elastix(fixed_path,
         excute_cmd_callback ('function'): Callback function to execute commands.
         fMask ('str'): Optional path to a mask file.
         mMask ('str'): Optional path to a mask file.
+        initial_transform ('str'): Optional TransformParameters file passed to elastix as the initial transform (-t0).
 
     Returns:
-        None
+        result: Whatever excute_cmd_callback returns (e.g. a task to await with utils.executor.AsyncExecutor.schedule).
     '''
     # Get the names of the fixed and moving images for the output directory, names without the file extensions
     reg_fixed_name  = fixed_path.replace("\\", "/").split("/")[-1].split(".")[0] # \\
@@ -67,10 +81,14 @@ def register_elastix(fixed_path,
         command_line = f'elastix -f "{fixed_path}" -m "{moving_path}" -fMask {fMask} -mMask {mMask} {reg_params} -out "{output_dir}"'
     else:
         command_line = f'elastix -f "{fixed_path}" -m "{moving_path}" {reg_params} -out "{output_dir}"'
+
+    # continue from a finished transform instead of registering from scratch
+    if initial_transform:
+        command_line = command_line.replace(' -out ', f' -t0 "{initial_transform}" -out ')
     print("Excuting command: ", command_line)
 
     # call elastix command
-    excute_cmd_callback(command_line)
+    return excute_cmd_callback(command_line)
 
 def label_propagation_transformix(
     fixed_path, 
@@ -93,7 +111,7 @@ def label_propagation_transformix(
         excute_cmd_callback ('function'): Callback function to execute commands.
 
     Returns:
-        None
+        result: Whatever excute_cmd_callback returns.
     '''
     replace_text_in_file_callback(
         transform_path, 
@@ -114,7 +132,7 @@ def label_propagation_transformix(
     command_line = f'transformix -in "{input_label}" -tp "{transform_path}"  -out "{output_dir}"'
     
     # run transformix on all combinations
-    excute_cmd_callback(command_line)
+    return excute_cmd_callback(command_line)
 
 def control_points_transformix(
     fixed_path, 
@@ -126,6 +144,23 @@ def control_points_transformix(
     create_dir_callback, 
     excute_cmd_callback
 ):
+    '''
+    Transform the control points (e.g. the inhale keypoints) using transformix.
+
+    Args:
+        fixed_path ('str'): Path to the fixed image.
+        moving_path ('str'): Path to the moving image.
+        reg_params_key ('str'): Key to identify the registration parameters output folder.
+        input_points ('str'): Path to the input points file.
+        transform_path ('str'): Path to the transformation parameters.
+        replace_text_in_file_callback ('function'): Callback function to replace text in a file.
+        create_dir_callback ('function'): Callback function to create directories.
+        excute_cmd_callback ('function'): Callback function to execute commands.
+
+    Returns:
+        result: Whatever excute_cmd_callback returns (e.g. a task to await with utils.executor.AsyncExecutor.schedule),
+            the points are written to output/<reg_params_key>/points/output_<fixed>/<moving>.
+    '''
     replace_text_in_file_callback(
         transform_path, 
         search_text = '(FinalBSplineInterpolationOrder 3)', 
@@ -150,7 +185,207 @@ def control_points_transformix(
     command_line = f'transformix -def "{input_points}" -tp "{transform_path}"  -out "{output_dir}"'
 
     # run transformix on all combinations
-    excute_cmd_callback(command_line)
+    return excute_cmd_callback(command_line)
+
+
+def read_parameter_file(file_path):
+    '''
+    Read an elastix parameter (or TransformParameters) file into a dictionary.
+
+    Args:
+        file_path ('str'): Path to the parameter file.
+
+    Returns:
+        parameters ('dict'): Parameter name -> list of values. Quoted values are returned as strings
+            and unquoted values as int or float.
+    '''
+    with open_output(file_path, 'r') as file:
+        return parse_parameter_text(file.read())
+
+def parse_parameter_text(text):
+    '''
+    Parse the content of an elastix parameter file, ignoring comments and formatting.
+
+    Args:
+        text ('str'): Content of the parameter file.
+
+    Returns:
+        parameters ('dict'): Parameter name -> list of values.
+    '''
+    parameters = {}
+
+    for line in text.splitlines():
+        # remove the comments and keep only the (Key value ...) entries
+        line = line.split('//')[0].strip()
+        if not (line.startswith('(') and line.endswith(')')):
+            continue
+
+        tokens = re.findall(r'"[^"]*"|[^\s"]+', line[1:-1])
+        if not tokens:
+            continue
+
+        values = []
+        for token in tokens[1:]:
+            if token.startswith('"'):
+                values.append(token.strip('"'))
+            else:
+                try:
+                    values.append(int(token))
+                except ValueError:
+                    try:
+                        values.append(float(token))
+                    except ValueError:
+                        values.append(token)
+
+        parameters[tokens[0]] = values
+
+    return parameters
+
+def format_parameter_text(parameters):
+    '''
+    Format a parameters dictionary as the content of an elastix parameter file.
+
+    Args:
+        parameters ('dict'): Parameter name -> list of values (or a single value).
+
+    Returns:
+        text ('str'): Content of the parameter file.
+    '''
+    lines = []
+    for key, values in parameters.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        formatted = [f'"{value}"' if isinstance(value, str) else repr(value) for value in values]
+        lines.append(f'({key} {" ".join(formatted)})')
+
+    return '\n'.join(lines) + '\n'
+
+def write_parameter_file(parameters, file_path):
+    '''
+    Write a parameters dictionary to an elastix parameter file.
+
+    Args:
+        parameters ('dict'): Parameter name -> list of values.
+        file_path ('str'): Path to the output parameter file.
+
+    Returns:
+        None
+    '''
+    with open(file_path, 'w') as file:
+        file.write(format_parameter_text(parameters))
+
+def parameters_fingerprint(file_path):
+    '''
+    Compute a fingerprint of a parameter file that ignores comments, formatting and entry order, so two
+    copies of the same parameters in different folders have the same fingerprint.
+
+    Args:
+        file_path ('str'): Path to the parameter file.
+
+    Returns:
+        fingerprint ('str'): Hex digest of the normalized parameters.
+    '''
+    parameters = read_parameter_file(file_path)
+    normalized = json.dumps(sorted(parameters.items()), separators=(',', ':'))
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+def write_run_manifest(exp_output, parameter_files, dataset_path, use_masks, elastix_version=None, runs=None, initial_transform_dir=None):
+    '''
+    Record the parameter files (in order) an experiment was created with, used to find warm starts.
+
+    Args:
+        exp_output ('str'): Experiment output directory (<output>/<experiment>/<reg_params_key>).
+        parameter_files ('list'): Ordered list of the parameter files passed to elastix.
+        dataset_path ('str'): Dataset split used for the registration.
+        use_masks ('bool'): If the lung masks were used during the registration.
+        elastix_version ('str'): Version of the elastix executable, see utils.cache.elastix_version.
+        runs ('dict'): Registration (<fixed_name>/<moving_name>) -> TransformParameters file holding the transform
+            after every parameter file. A warm started registration renumbers its files from the first parameter
+            file it runs, and its reused stages point to the files of the earlier experiment.
+        initial_transform_dir ('str'): Optional pre-alignment (output of prealign.py) the registrations start from.
+
+    Returns:
+        manifest ('dict'): The recorded manifest.
+    '''
+    manifest = {
+        'dataset_path': dataset_path.replace('\\', '/').rstrip('/'),
+        'use_masks': bool(use_masks),
+        'elastix': elastix_version,
+        'initial_transform_dir': os.path.normpath(initial_transform_dir).replace('\\', '/') if initial_transform_dir else None,
+        'parameters': [
+            {'path': path.replace('\\', '/'), 'fingerprint': parameters_fingerprint(path)} for path in parameter_files],
+        'runs': runs or {},
+    }
+
+    with open(os.path.join(exp_output, RUN_MANIFEST_FILENAME), 'w') as json_file:
+        json.dump(manifest, json_file, indent=4)
+
+    return manifest
+
+def stage_transforms(elastix_output_dir, stages, reused=None):
+    '''
+    TransformParameters file holding the transform after every parameter file of a registration.
+
+    Args:
+        elastix_output_dir ('str'): elastix output directory of the registration.
+        stages ('int'): Number of parameter files of the experiment.
+        reused ('list'): Files of the first stages taken from a warm start, the registration runs the others
+            and numbers its files from 0.
+
+    Returns:
+        transforms ('list'): One path per parameter file.
+    '''
+    reused = list(reused or [])
+    return reused + [f'{elastix_output_dir}/TransformParameters.{index}.txt' for index in range(stages - len(reused))]
+
+def find_warm_start(output_path, manifest, exclude=None):
+    '''
+    Find the earlier experiment that shares the longest prefix of parameter files with a new experiment,
+    registered on the same dataset, with the same masks setting, pre-alignment and elastix version. Among the
+    experiments sharing as many parameter files, the one with the most recorded registrations is used, then
+    the first one by path.
+
+    Args:
+        output_path ('str'): Root dir of the experiments outputs (e.g. output).
+        manifest ('dict'): Manifest of the new experiment, as returned by write_run_manifest.
+        exclude ('str'): Optional experiment output directory to skip (the new experiment itself).
+
+    Returns:
+        warm_start ('tuple'): (experiment output directory, number of shared parameter files, registration ->
+            TransformParameters files of the shared parameter files), or None if no earlier experiment shares at
+            least the first parameter file.
+    '''
+    fingerprints = [parameter['fingerprint'] for parameter in manifest['parameters']]
+    candidates = []
+
+    for manifest_path in sorted(glob(os.path.join(output_path, '*', '*', RUN_MANIFEST_FILENAME))):
+        exp_output = os.path.dirname(manifest_path).replace('\\', '/')
+        if exclude and os.path.normpath(exp_output) == os.path.normpath(exclude):
+            continue
+
+        try:
+            with open(manifest_path, 'r') as json_file:
+                candidate = json.load(json_file)
+        except (ValueError, OSError):
+            continue
+
+        if any(candidate.get(name) != manifest[name] for name in ['dataset_path', 'use_masks', 'elastix', 'initial_transform_dir']):
+            continue
+
+        # length of the shared prefix of parameter files
+        shared = 0
+        for fingerprint, parameter in zip(fingerprints, candidate.get('parameters', [])):
+            if fingerprint != parameter['fingerprint']:
+                break
+            shared += 1
+
+        # the experiments created before the stages were recorded can not be mapped to their files
+        runs = {run: transforms[:shared] for run, transforms in candidate.get('runs', {}).items() if len(transforms) >= shared}
+        if shared > 0 and runs:
+            candidates.append((-shared, -len(runs), exp_output, runs))
 
-    return output_dir
+    if not candidates:
+        return None
 
+    shared, _, exp_output, runs = min(candidates, key=lambda candidate: candidate[:3])
+    return exp_output, -shared, runs
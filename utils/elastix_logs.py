@@ -0,0 +1,266 @@
+import re
+import numpy as np
+
+from .catalog import scan_tree
+from .storage import expand_compacted, open_output
+from .monitor import ITERATION_INFO_PATTERN, parse_iteration_info_header, parse_iteration_info_row
+
+# elastix.log lines, the spelling changed between elastix versions (initialisation/initialization)
+PARAMETER_FILE_PATTERN = re.compile(r'Running elastix with parameter file (\d+)')
+RESOLUTION_TIME_PATTERN = re.compile(r'Time spent in resolution (\d+) \(ITK initiali[sz]ation and iterating\):\s*([\d.]+)\s*s')
+TOTAL_TIME_PATTERN = re.compile(r'Total time elapsed:\s*(.+)')
+DURATION_PATTERN = re.compile(r'([\d.]+)\s*(h|m|s|ms)\b')
+
+# fraction of the metric improvement of a resolution used to report how many iterations were needed
+IMPROVEMENT_FRACTION = 0.95
+
+
+def parse_duration(text):
+    '''
+    Parse a duration written by elastix, e.g. "1m 23.4s", "83.4s." or "120 ms".
+
+    Args:
+        text ('str'): Duration text.
+
+    Returns:
+        seconds ('float'): Duration in seconds, NaN if the text has no duration.
+    '''
+    factors = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    matches = DURATION_PATTERN.findall(text)
+    if not matches:
+        return np.nan
+    return sum(float(value) * factors[unit] for value, unit in matches)
+
+def read_iteration_info(file_path):
+    '''
+    Read an IterationInfo.<level>.R<resolution>.txt file into columns.
+
+    Args:
+        file_path ('str'): Path to the IterationInfo file.
+
+    Returns:
+        columns ('dict'): Column name (ItNr, Metric, StepSize, Time[ms], ...) -> numpy array.
+    '''
+    with open_output(file_path, 'r', errors='replace') as file:
+        lines = file.read().splitlines()
+
+    if not lines:
+        return {}
+
+    names = parse_iteration_info_header(lines[0])
+    rows = [row for row in (parse_iteration_info_row(line, names) for line in lines[1:]) if row is not None]
+
+    return {name: np.array([row[name] for row in rows], dtype=np.float64) for name in names}
+
+def parse_elastix_log(file_path):
+    '''
+    Get the resolution timings and the total runtime from an elastix.log file.
+
+    Args:
+        file_path ('str'): Path to the elastix.log file.
+
+    Returns:
+        log ('dict'): resolution_times ({(level, resolution): seconds}) and total_time (seconds, NaN if the
+            run did not finish).
+    '''
+    level = 0
+    resolution_times = {}
+    total_time = np.nan
+
+    with open_output(file_path, 'r', errors='replace') as file:
+        for line in file:
+            match = PARAMETER_FILE_PATTERN.search(line)
+            if match:
+                level = int(match.group(1))
+                continue
+
+            match = RESOLUTION_TIME_PATTERN.search(line)
+            if match:
+                resolution_times[(level, int(match.group(1)))] = float(match.group(2))
+                continue
+
+            match = TOTAL_TIME_PATTERN.search(line)
+            if match:
+                total_time = parse_duration(match.group(1))
+
+    return {'resolution_times': resolution_times, 'total_time': total_time}
+
+def _iterations_to_fraction(metric, fraction):
+    '''
+    Number of iterations needed to reach a fraction of the total (smoothed) metric improvement.
+    '''
+    if len(metric) < 2 or not np.all(np.isfinite(metric)):
+        return len(metric)
+
+    window = max(1, min(25, len(metric) // 10))
+    smoothed = np.convolve(metric, np.ones(window) / window, mode='valid')
+    best_so_far = np.minimum.accumulate(smoothed)
+    total_gain = smoothed[0] - best_so_far[-1]
+
+    if total_gain <= 0:
+        return 0
+    # the smoothed values are centered on the middle of their window
+    return int(np.argmax(smoothed[0] - best_so_far >= fraction * total_gain)) + window // 2
+
+def collect_runs(output_path, experiments=None):
+    '''
+    Parse every elastix.log and IterationInfo file of an experiments output tree into columnar arrays.
+
+    Args:
+        output_path ('str'): Root dir of the experiments outputs (e.g. output).
+        experiments ('list'): Optional experiment names to restrict the scan to.
+
+    Returns:
+        runs ('dict'): One entry per elastix run: experiment, reg_params_key, fixed, moving, total_time.
+        resolutions ('dict'): One entry per run resolution: run (index into runs), level, resolution,
+            iterations, iteration_time (sum of Time[ms], in s), log_time (from elastix.log, in s),
+            metric_start, metric_end, iterations_to_95.
+        iterations ('dict'): One entry per iteration: run, level, resolution, iteration, metric, step_size, time_ms.
+    '''
+    output_path = output_path.replace('\\', '/').rstrip('/')
+    roots = [output_path] if experiments is None else [f'{output_path}/{experiment}' for experiment in experiments]
+
+    # group the files by run directory, <experiment>/<key>/images/output_<fixed>/<moving>/
+    run_files = {}
+    for root in roots:
+        for relative in expand_compacted(root, scan_tree(root, cache_dir=output_path)):
+            path = f'{root}/{relative}'
+            parts = path[len(output_path) + 1:].split('/')
+            if len(parts) != 6 or parts[2] != 'images':
+                continue
+            if parts[-1] == 'elastix.log' or ITERATION_INFO_PATTERN.match(parts[-1]):
+                run_files.setdefault(tuple(parts[:5]), []).append(path)
+
+    runs = {name: [] for name in ['experiment', 'reg_params_key', 'fixed', 'moving', 'total_time']}
+    resolutions = {name: [] for name in ['run', 'level', 'resolution', 'iterations', 'iteration_time', 'log_time',
+                                         'metric_start', 'metric_end', 'iterations_to_95']}
+    iterations = {name: [] for name in ['run', 'level', 'resolution', 'iteration', 'metric', 'step_size', 'time_ms']}
+
+    for run_index, (run_key, paths) in enumerate(sorted(run_files.items())):
+        experiment, reg_params_key, _, fixed, moving = run_key
+        log_paths = [path for path in paths if path.endswith('elastix.log')]
+        log = parse_elastix_log(log_paths[0]) if log_paths else {'resolution_times': {}, 'total_time': np.nan}
+
+        runs['experiment'].append(experiment)
+        runs['reg_params_key'].append(reg_params_key)
+        runs['fixed'].append(fixed[len('output_'):])
+        runs['moving'].append(moving)
+        runs['total_time'].append(log['total_time'])
+
+        info_paths = [path for path in paths if not path.endswith('elastix.log')]
+        for path in sorted(info_paths, key=lambda path: tuple(int(value) for value in ITERATION_INFO_PATTERN.search(path).groups())):
+            match = ITERATION_INFO_PATTERN.search(path)
+            level, resolution = int(match.group('level')), int(match.group('resolution'))
+            columns = read_iteration_info(path)
+            count = len(columns.get('Metric', []))
+            if count == 0:
+                continue
+
+            metric = columns['Metric']
+            time_ms = columns.get('Time[ms]', np.full(count, np.nan))
+
+            resolutions['run'].append(run_index)
+            resolutions['level'].append(level)
+            resolutions['resolution'].append(resolution)
+            resolutions['iterations'].append(count)
+            resolutions['iteration_time'].append(np.nansum(time_ms) / 1000.0)
+            resolutions['log_time'].append(log['resolution_times'].get((level, resolution), np.nan))
+            resolutions['metric_start'].append(metric[0])
+            resolutions['metric_end'].append(metric[-1])
+            resolutions['iterations_to_95'].append(_iterations_to_fraction(metric, IMPROVEMENT_FRACTION))
+
+            iterations['run'].append(np.full(count, run_index))
+            iterations['level'].append(np.full(count, level))
+            iterations['resolution'].append(np.full(count, resolution))
+            iterations['iteration'].append(columns.get('ItNr', np.arange(count)))
+            iterations['metric'].append(metric)
+            iterations['step_size'].append(columns.get('StepSize', np.full(count, np.nan)))
+            iterations['time_ms'].append(time_ms)
+
+    runs = {name: np.array(values) for name, values in runs.items()}
+    resolutions = {name: np.array(values) for name, values in resolutions.items()}
+    iterations = {
+        name: np.concatenate(values) if values else np.array([])
+        for name, values in iterations.items()}
+
+    return runs, resolutions, iterations
+
+def aggregate_resolutions(runs, resolutions):
+    '''
+    Aggregate the resolution statistics over the subjects of every experiment configuration.
+
+    Args:
+        runs ('dict'): Runs columns from collect_runs.
+        resolutions ('dict'): Resolutions columns from collect_runs.
+
+    Returns:
+        summary ('dict'): One entry per (experiment, reg_params_key, level, resolution) with the number of
+            subjects, the mean iterations, mean time (s), mean metric gain, mean gain per second and mean
+            iterations needed for 95% of the gain.
+    '''
+    if len(resolutions['run']) == 0:
+        return {}
+
+    run = resolutions['run']
+    keys = np.stack([
+        runs['experiment'][run], runs['reg_params_key'][run],
+        resolutions['level'].astype(str), resolutions['resolution'].astype(str)], axis=1)
+    unique_keys, group = np.unique(keys, axis=0, return_inverse=True)
+    group = group.ravel()
+    counts = np.bincount(group)
+
+    # prefer the elastix.log timings and fall back to the sum of the iteration times
+    time = np.where(np.isfinite(resolutions['log_time']), resolutions['log_time'], resolutions['iteration_time'])
+    gain = resolutions['metric_start'] - resolutions['metric_end']
+
+    def mean(values):
+        return np.bincount(group, weights=values) / counts
+
+    return {
+        'experiment': unique_keys[:, 0],
+        'reg_params_key': unique_keys[:, 1],
+        'level': unique_keys[:, 2].astype(int),
+        'resolution': unique_keys[:, 3].astype(int),
+        'subjects': counts,
+        'iterations': mean(resolutions['iterations']),
+        'time': mean(time),
+        'metric_gain': mean(gain),
+        'gain_per_second': mean(gain / np.maximum(time, 1e-9)),
+        'iterations_to_95': mean(resolutions['iterations_to_95']),
+    }
+
+def aggregate_runs(runs):
+    '''
+    Aggregate the total runtime over the subjects of every experiment configuration. The unfinished runs and
+    the logs without a total time are left out of the times.
+
+    Args:
+        runs ('dict'): Runs columns from collect_runs.
+
+    Returns:
+        summary ('dict'): One entry per (experiment, reg_params_key) with the number of subjects, the number of
+            runs with a total time and the mean, median and max total runtime (s), nan without such runs.
+    '''
+    if len(runs['experiment']) == 0:
+        return {}
+
+    keys = np.stack([runs['experiment'], runs['reg_params_key']], axis=1)
+    unique_keys, group = np.unique(keys, axis=0, return_inverse=True)
+    group = group.ravel()
+    total_time = np.asarray(runs['total_time'], dtype=float)
+    valid_runs = np.bincount(group, weights=np.isfinite(total_time), minlength=len(unique_keys)).astype(int)
+
+    mean_time, median_time, max_time = (np.full(len(unique_keys), np.nan) for _ in range(3))
+    for idx in np.flatnonzero(valid_runs):
+        times = total_time[group == idx]
+        mean_time[idx], median_time[idx], max_time[idx] = np.nanmean(times), np.nanmedian(times), np.nanmax(times)
+
+    return {
+        'experiment': unique_keys[:, 0],
+        'reg_params_key': unique_keys[:, 1],
+        'subjects': np.bincount(group),
+        'valid_runs': valid_runs,
+        'mean_time': mean_time,
+        'median_time': median_time,
+        'max_time': max_time,
+    }
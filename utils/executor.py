@@ -0,0 +1,252 @@
+import os
+import re
+import time
+import asyncio
+import subprocess
+
+from .monitor import kill_process_tree
+
+# seconds between two samples of the memory used by a running command
+MEMORY_SAMPLING_INTERVAL = 0.5
+
+
+def _process_tree_rss(pid):
+    '''
+    Resident memory (bytes) of a process and all its children, None if psutil is not installed.
+    '''
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0
+
+    rss = 0
+    for child in processes:
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+async def _sample_peak_memory(pid, peak):
+    '''
+    Keep the peak resident memory of a process tree in peak['bytes'] until cancelled.
+    '''
+    while True:
+        rss = _process_tree_rss(pid)
+        if rss is None:
+            return
+        peak['bytes'] = max(peak['bytes'] or 0, rss)
+        await asyncio.sleep(MEMORY_SAMPLING_INTERVAL)
+
+async def run_command(command, log_path=None, timeout=None, semaphore=None, cwd=None):
+    '''
+    Run a command asynchronously, streaming its output to a log file instead of keeping it in memory.
+
+    Args:
+        command ('str' or 'list'): Command line (run through the shell, as excute_cmd does) or list of arguments (run directly).
+        log_path ('str'): Optional file the stdout and stderr of the command are written to.
+        timeout ('float'): Optional time limit in seconds, the command (and its children) is killed when it is reached.
+        semaphore ('asyncio.Semaphore'): Optional semaphore limiting the number of commands running at once.
+        cwd ('str'): Optional working directory.
+
+    Returns:
+        result ('dict'): command, returncode, duration (s), peak_memory (bytes, None without psutil),
+            timed_out and log_path.
+    '''
+    if semaphore is not None:
+        async with semaphore:
+            return await run_command(command, log_path=log_path, timeout=timeout, cwd=cwd)
+
+    log_file = open(log_path, 'w') if log_path else None
+    output = log_file if log_file else subprocess.DEVNULL
+    start_time = time.time()
+    timed_out = False
+
+    try:
+        if isinstance(command, str):
+            process = await asyncio.create_subprocess_shell(command, stdout=output, stderr=subprocess.STDOUT, cwd=cwd)
+        else:
+            process = await asyncio.create_subprocess_exec(*command, stdout=output, stderr=subprocess.STDOUT, cwd=cwd)
+
+        peak = {'bytes': None}
+        sampler = asyncio.ensure_future(_sample_peak_memory(process.pid, peak))
+
+        try:
+            await asyncio.wait_for(process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            kill_process_tree(process)
+            await process.wait()
+        except asyncio.CancelledError:
+            # do not leave the command running when the caller is cancelled
+            kill_process_tree(process)
+            await process.wait()
+            raise
+        finally:
+            sampler.cancel()
+    finally:
+        if log_file:
+            log_file.close()
+
+    return {
+        'command': command,
+        'returncode': process.returncode,
+        'duration': time.time() - start_time,
+        'peak_memory': peak['bytes'],
+        'timed_out': timed_out,
+        'log_path': log_path,
+    }
+
+class AsyncExecutor:
+    '''
+    Run many commands from a single event loop, with at most max_concurrency of them at once.
+
+    The schedule method can be passed as the excute_cmd_callback of register_elastix,
+    label_propagation_transformix and control_points_transformix from a coroutine. The registration
+    wrappers return the scheduled task so a subject coroutine can await its registration before the
+    transformix step, while other subjects keep running.
+    '''
+
+    def __init__(self, max_concurrency=os.cpu_count(), timeout=None, log_dir=None):
+        '''
+        Args:
+            max_concurrency ('int'): Maximum number of commands running at once.
+            timeout ('float'): Optional time limit in seconds for every command.
+            log_dir ('str'): Optional dir the output of every command is written to, one log file per command.
+        '''
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.log_dir = log_dir
+        self.tasks = []
+        self._semaphore = None
+        self._counter = 0
+
+    def _log_path(self, command):
+        if not self.log_dir:
+            return None
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._counter += 1
+        executable = command if isinstance(command, str) else command[0]
+        executable = re.sub(r'[^\w.-]', '_', executable.strip().split(' ')[0].replace('\\', '/').split('/')[-1])
+        return os.path.join(self.log_dir, f'{self._counter:05d}_{executable}.log')
+
+    async def run(self, command, log_path=None, timeout=None):
+        '''
+        Run a single command, waiting for a free slot first.
+
+        Args:
+            command ('str' or 'list'): Command to run.
+            log_path ('str'): Optional log file, a file in log_dir is used by default.
+            timeout ('float'): Optional time limit, the executor timeout is used by default.
+
+        Returns:
+            result ('dict'): See run_command.
+        '''
+        # the semaphore has to be created inside the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        return await run_command(
+            command,
+            log_path=log_path or self._log_path(command),
+            timeout=timeout if timeout is not None else self.timeout,
+            semaphore=self._semaphore)
+
+    def schedule(self, command):
+        '''
+        Schedule a command on the running event loop without waiting for it.
+
+        Args:
+            command ('str' or 'list'): Command to run.
+
+        Returns:
+            task ('asyncio.Task'): Task returning the run_command result.
+        '''
+        task = asyncio.ensure_future(self.run(command))
+        self.tasks.append(task)
+        return task
+
+    async def gather(self):
+        '''
+        Wait for all the scheduled commands.
+
+        Returns:
+            results ('list'): run_command results, in scheduling order.
+        '''
+        results = await asyncio.gather(*self.tasks)
+        self.tasks = []
+        return results
+
+def run_commands(commands, max_concurrency=os.cpu_count(), timeout=None, log_dir=None):
+    '''
+    Run a list of independent commands concurrently and wait for all of them.
+
+    Args:
+        commands ('list'): Commands to run.
+        max_concurrency ('int'): Maximum number of commands running at once.
+        timeout ('float'): Optional time limit in seconds for every command.
+        log_dir ('str'): Optional dir the output of every command is written to.
+
+    Returns:
+        results ('list'): run_command results, in the order of the commands.
+    '''
+    executor = AsyncExecutor(max_concurrency=max_concurrency, timeout=timeout, log_dir=log_dir)
+
+    async def main():
+        return await asyncio.gather(*[executor.run(command) for command in commands])
+
+    return asyncio.run(main())
+
+def register_subjects(subjects, reg_params, reg_params_key, max_concurrency=os.cpu_count(), timeout=None, log_dir=None):
+    '''
+    Register many subjects from a single event loop and transform their inhale keypoints, every subject
+    moves on to transformix as soon as its own registration finishes.
+
+    Args:
+        subjects ('list'): One dict per subject with fixed_path, moving_path and input_points, and optionally
+            fMask, mMask, initial_transform and transform_idx (index of the final TransformParameters file, 0 by default).
+        reg_params ('str'): Registration parameters for elastix (-p flags).
+        reg_params_key ('str'): Key to identify the registration parameters output folder.
+        max_concurrency ('int'): Maximum number of elastix/transformix commands running at once.
+        timeout ('float'): Optional time limit in seconds for every command.
+        log_dir ('str'): Optional dir the output of every command is written to.
+
+    Returns:
+        results ('list'): One dict per subject with the registration and transformix run_command results
+            (transformix is None when the registration failed).
+    '''
+    from .elastix import register_elastix, control_points_transformix
+    from .filemanager import create_directory_if_not_exists, replace_text_in_file
+
+    executor = AsyncExecutor(max_concurrency=max_concurrency, timeout=timeout, log_dir=log_dir)
+
+    async def process(subject):
+        registration = await register_elastix(
+            subject['fixed_path'], subject['moving_path'], reg_params, reg_params_key,
+            create_directory_if_not_exists, executor.schedule,
+            fMask=subject.get('fMask'), mMask=subject.get('mMask'),
+            initial_transform=subject.get('initial_transform'))
+
+        if registration['returncode'] != 0:
+            return {'registration': registration, 'transformix': None}
+
+        reg_fixed_name  = subject['fixed_path'].replace("\\", "/").split("/")[-1].split(".")[0]
+        reg_moving_name = subject['moving_path'].replace("\\", "/").split("/")[-1].split(".")[0]
+        transform_path = f"output/{reg_params_key}/images/output_{reg_fixed_name}/{reg_moving_name}/TransformParameters.{subject.get('transform_idx', 0)}.txt"
+
+        transformix = await control_points_transformix(
+            subject['fixed_path'], subject['moving_path'], reg_params_key, subject['input_points'], transform_path,
+            replace_text_in_file, create_directory_if_not_exists, executor.schedule)
+        return {'registration': registration, 'transformix': transformix}
+
+    async def main():
+        return await asyncio.gather(*[process(subject) for subject in subjects])
+
+    return asyncio.run(main())
@@ -1,6 +1,5 @@
 import os
 import sys
-import pandas as pd
 from glob import glob
 from .logger import logger
 import re
@@ -1,9 +1,12 @@
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import nibabel as nib
-import os
-from matplotlib.colors import LinearSegmentedColormap
+import re
+from itertools import islice
+
+from .storage import open_output
+from .lazy import moved_attributes
+
+# number of points read, converted or compared at once, bounds the memory for dense correspondences
+POINTS_CHUNK_SIZE = 100000
 
 def write_landmarks_to_list(landmarks, file_path):
     '''
@@ -36,78 +39,123 @@ def get_landmarks_from_txt(transformed_file_path, search_key='OutputIndexFixed')
     Returns:
         landmarks_list ('list'): List of transformed landmarks.
     '''
+    return [row for chunk in iter_landmarks_from_txt(transformed_file_path, search_key=search_key) for row in chunk.tolist()]
+
+def iter_landmarks_from_txt(transformed_file_path, search_key='OutputIndexFixed', chunk_size=POINTS_CHUNK_SIZE):
+    '''
+    Read the landmarks of a transformix outputpoints.txt file chunk by chunk, so the memory does not grow
+    with the number of points.
+
+    Args:
+        transformed_file_path ('str'): Path to the transformed text file.
+        search_key ('str'): Column where the landmarks are stored, 'OutputIndexFixed' or 'InputIndex'.
+        chunk_size ('int'): Number of points per chunk.
+
+    Returns:
+        chunks ('generator'): Integer landmarks arrays (n, 3), at most chunk_size rows each.
+    '''
     # validate the search key
     assert search_key in ['OutputIndexFixed', 'InputIndex'], "The search_key must be either 'OutputIndexFixed' or 'InputIndex'."
 
-    # Define the column names based on the data in the text file
-    columns = [
-        'Point', 'InputIndex', 'InputPoint',
-        'OutputIndexFixed', 'OutputPoint', 'Deformation'
-    ]
-
-    # Read the text file into a pandas DataFrame
-    df = pd.read_csv(transformed_file_path, sep='\t;', comment=';', header=None, names=columns, engine='python')
-
-    # select the required column
-    df_col = df[search_key]
-    
-    # convert the column values to a list of lists
-    landmarks_list = [list(map(int, df_col[idx].split(' ')[-4:-1])) for idx in range(len(df_col))]
-
-    return landmarks_list
-
-def visualize_landmarks(slice_index=70, subject='copd1', split='train'):
-    '''
-    Visualize the landmarks on the reference image or a mask.
-    '''
-    # Define the paths
-    landmarks_path = os.path.join(os.getcwd(),f'../dataset/{split}/{subject}/{subject}_300_iBH_xyz_r1.txt')
-    reference_image_path = os.path.join(os.getcwd(),f'../dataset/{split}/{subject}/{subject}_iBHCT.nii.gz') # _lung
-    reference_mask_path = os.path.join(os.getcwd(),f'../dataset/{split}/{subject}/{subject}_iBHCT_lung.nii.gz') # _lung
-    # reference_mask_path = os.path.join(os.getcwd(),f'../dataset/segmentation_trails/mask1/train/{subject}_eBHCT_lung.nii.gz') # _lung
-
-    # -1 to match the MATLAB visualizer indexing result
-    slice_index = slice_index - 1
-
-    # Load the reference image
-    nii_image = nib.load(reference_image_path)
-    reference_image = nii_image.get_fdata()
-
-    # Load the reference mask
-    nii_mask = nib.load(reference_mask_path)
-    reference_mask = nii_mask.get_fdata()
-
-    # transpose the axis to rotate for visualization
-    reference_image = reference_image.transpose(2, 1, 0)
-    reference_mask = reference_mask.transpose(2, 1, 0)
-    
-    # Load 3D landmarks from the file
-    landmarks_data = np.loadtxt(landmarks_path, skiprows=2)
-    slice_landmarsk = np.array([inner_list for inner_list in landmarks_data if inner_list[2] == slice_index+1])
-    
-    # Create a red-green colormap with opacity
-    cmap = LinearSegmentedColormap.from_list('red_green', ['red', 'green'], N=256)
-    
-    # Visualize a specific slice
-    plt.figure(figsize=(8, 8))
-    plt.imshow(reference_image[slice_index, :, :], cmap='gray')
-
-    # Overlay the mask with color on the landmarks
-    mask_overlay = np.ma.masked_where(reference_mask[slice_index, :, :] == 0, reference_mask[slice_index, :, :])
-    plt.imshow(mask_overlay, cmap=cmap, alpha=0.5)
-
-    if len(slice_landmarsk) > 0:
-            
-        # Extract x, y, z coordinates
-        x_coords = slice_landmarsk[:, 0].astype(int)
-        y_coords = slice_landmarsk[:, 1].astype(int)
-        z_coords = slice_landmarsk[:, 2].astype(int)
-
-        # Plot landmarks on the current slice
-        plt.scatter(x_coords, y_coords, c='b', marker='+', label=f'{landmarks_path.split("/")[-1].split(".txt")[0]} landmarks')
-
-    plt.legend()
-    plt.axis('off')
-    # plt.title(f"Slice {slice_index+1}")
-    plt.show()
+    # every line is: Point <idx> ; InputIndex = [ x y z ] ; InputPoint = [ ... ] ; OutputIndexFixed = [ x y z ] ; ...
+    pattern = re.compile(search_key + r'\s*=\s*\[([^\]]*)\]')
+
+    with open_output(transformed_file_path, 'r') as file:
+        while True:
+            lines = list(islice(file, chunk_size))
+            if not lines:
+                break
+            values = [match.group(1).split() for match in map(pattern.search, lines) if match]
+            if values:
+                yield np.array(values, dtype=np.float64).astype(np.int64)
+
+def write_transformix_landmarks(transformed_file_path, file_path, search_key='OutputIndexFixed', chunk_size=POINTS_CHUNK_SIZE):
+    '''
+    Extract the landmarks of a transformix outputpoints.txt file to a text file (one landmark per line, tab
+    separated, as write_landmarks_to_list), chunk by chunk.
+
+    Args:
+        transformed_file_path ('str'): Path to the transformed text file.
+        file_path ('str'): Path to the output text file.
+        search_key ('str'): Column where the landmarks are stored, 'OutputIndexFixed' or 'InputIndex'.
+        chunk_size ('int'): Number of points per chunk.
+
+    Returns:
+        count ('int'): Number of landmarks written.
+    '''
+    count = 0
+    with open(file_path, 'w') as file:
+        for chunk in iter_landmarks_from_txt(transformed_file_path, search_key=search_key, chunk_size=chunk_size):
+            np.savetxt(file, chunk, fmt='%d', delimiter='\t')
+            count += len(chunk)
+
+    return count
+
+def has_transformix_header(file_path):
+    '''
+    Check if a keypoints file starts with the transformix header (index/point and the number of points).
+
+    Args:
+        file_path ('str'): Path to the keypoints text file.
+
+    Returns:
+        header ('bool'): True if the file has the header.
+    '''
+    with open_output(file_path, 'r') as file:
+        return file.readline().strip() in ('index', 'point')
+
+def iter_keypoints(file_path, chunk_size=POINTS_CHUNK_SIZE):
+    '''
+    Read a keypoints file chunk by chunk, with or without the transformix header added by
+    prepare_keypoints_transformix.py.
+
+    Args:
+        file_path ('str'): Path to the keypoints text file.
+        chunk_size ('int'): Number of points per chunk.
+
+    Returns:
+        chunks ('generator'): Keypoints arrays (n, 3), chunk_size rows each but the last one. The blank lines are
+            skipped before chunking, so the chunks of two files with the same number of keypoints stay aligned.
+    '''
+    with open_output(file_path, 'r') as file:
+        if has_transformix_header(file_path):
+            next(file), next(file)
+
+        lines = (line for line in file if line.strip())
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+            yield np.atleast_2d(np.loadtxt(chunk, dtype=np.float64))
+
+def count_keypoints(file_path):
+    '''
+    Count the keypoints of a keypoints file without loading them.
+
+    Args:
+        file_path ('str'): Path to the keypoints text file.
+
+    Returns:
+        count ('int'): Number of keypoints.
+    '''
+    with open_output(file_path, 'r') as file:
+        count = sum(1 for line in file if line.strip())
+
+    return count - 2 if has_transformix_header(file_path) else count
+
+def read_keypoints(file_path):
+    '''
+    Read a keypoints file, with or without the transformix header (index/point and the number of points)
+    added by prepare_keypoints_transformix.py.
+
+    Args:
+        file_path ('str'): Path to the keypoints text file.
+
+    Returns:
+        keypoints ('np.array'): Keypoints (N, 3).
+    '''
+    chunks = list(iter_keypoints(file_path))
+    return np.concatenate(chunks) if chunks else np.empty((0, 3))
+
 
+__getattr__ = moved_attributes(__name__, '.visualization', ('visualize_landmarks',))
@@ -0,0 +1,22 @@
+import importlib
+
+
+def moved_attributes(module_name, target, names):
+    '''
+    Build the module __getattr__ of helpers that moved to another module. They are imported on first use, so
+    importing the old module does not load the heavy packages of the new one (e.g. matplotlib).
+
+    Args:
+        module_name ('str'): Name of the module the helpers moved from (its __name__).
+        target ('str'): Module the helpers moved to, relative to the package (e.g. '.visualization').
+        names ('tuple'): Names of the moved helpers.
+
+    Returns:
+        getattr ('function'): Module level __getattr__.
+    '''
+    def __getattr__(name):
+        if name in names:
+            return getattr(importlib.import_module(target, module_name.rpartition('.')[0]), name)
+        raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+    return __getattr__
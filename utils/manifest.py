@@ -0,0 +1,92 @@
+import os
+import json
+
+from .cache import file_digest
+from .storage import output_signature
+
+# manifest of the evaluated point files, written in the points folder of every experiment
+EVALUATION_MANIFEST_FILENAME = 'evaluation_manifest.json'
+
+
+def file_signature(file_path, previous=None):
+    '''
+    Get the signature (path, size, mtime and sha256) of a file. The content is only hashed again when the
+    size or the modification time differ from the previous signature.
+
+    Args:
+        file_path ('str'): Path to the file.
+        previous ('dict'): Optional earlier signature of the same file.
+
+    Returns:
+        signature ('dict'): path, size, mtime_ns and sha256.
+    '''
+    # the files of compacted runs keep the signature they had, their sha256 is in the index
+    stored = output_signature(file_path)
+    signature = {'path': file_path.replace('\\', '/'), 'size': stored['size'], 'mtime_ns': stored['mtime_ns']}
+
+    if previous and previous.get('size') == signature['size'] and previous.get('mtime_ns') == signature['mtime_ns']:
+        signature['sha256'] = previous['sha256']
+    else:
+        signature['sha256'] = stored['sha256'] or file_digest(file_path)
+
+    return signature
+
+def load_manifest(manifest_path):
+    '''
+    Load a manifest of processed files.
+
+    Args:
+        manifest_path ('str'): Path to the manifest json file.
+
+    Returns:
+        manifest ('dict'): Path -> entry, empty if the manifest does not exist.
+    '''
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as json_file:
+        return json.load(json_file)
+
+def save_manifest(manifest_path, manifest):
+    '''
+    Save a manifest of processed files atomically.
+
+    Args:
+        manifest_path ('str'): Path to the manifest json file.
+        manifest ('dict'): Path -> entry.
+
+    Returns:
+        None
+    '''
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(manifest, json_file, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+def get_inputs_signature(manifest, key, input_paths, settings=None):
+    '''
+    Get the signatures of the inputs of a processed item and check them against its manifest entry.
+
+    Args:
+        manifest ('dict'): Manifest from load_manifest.
+        key ('str'): Key of the item in the manifest (e.g. the path of its main input).
+        input_paths ('list'): Files the result of the item depends on.
+        settings ('dict'): Optional other values the result depends on (e.g. the voxel size).
+
+    Returns:
+        signatures ('dict'): The new signatures of the inputs, and the settings.
+        changed ('bool'): True if the item is new or one of its inputs changed.
+    '''
+    previous = manifest.get(key, {})
+    previous_inputs = previous.get('inputs', {})
+
+    inputs = {path: file_signature(path, previous_inputs.get(path)) for path in input_paths if path}
+    signatures = {'inputs': inputs, 'settings': settings or {}}
+
+    changed = (
+        'result' not in previous
+        or previous.get('settings', {}) != signatures['settings']
+        or set(previous_inputs) != set(inputs)
+        or any(previous_inputs[path]['sha256'] != signature['sha256'] for path, signature in inputs.items()))
+
+    return signatures, changed
@@ -0,0 +1,109 @@
+import numpy as np
+
+from .dataset import create_mask, label_regions, get_largest_regions, create_masks, remove_trachea
+
+
+def parse_structure(text):
+    '''
+    Parse a closing structure given as text, e.g. '7x7x5' -> (7, 7, 5), in array order (slice, H, W)
+    as segment.py uses it.
+    '''
+    return tuple(int(value) for value in text.lower().split('x'))
+
+def _padded_box(mask, padding):
+    # slices of the bounding box of the mask, grown by padding voxels (per axis) and clipped to the volume
+    box = []
+    for axis, pad in enumerate(padding):
+        profile = np.flatnonzero(mask.any(axis=tuple(other for other in range(mask.ndim) if other != axis)))
+        box.append(slice(max(profile[0] - pad, 0), min(profile[-1] + 1 + pad, mask.shape[axis])))
+    return tuple(box)
+
+def close_mask(mask, structure):
+    '''
+    Binary closing of a mask with a box structuring element, as fill_holes_and_erode of utils.dataset, computed
+    on the bounding box of the mask only (grown so the result is the same as on the full volume).
+
+    Args:
+        mask ('np.array'): Binary mask (slice, H, W).
+        structure ('tuple'): Size of the structuring element (slice, H, W).
+
+    Returns:
+        closed ('np.array'): Closed mask, bool.
+    '''
+    from scipy.ndimage import binary_closing
+
+    closed = np.zeros(mask.shape, dtype=bool)
+    if not mask.any():
+        return closed
+
+    box = _padded_box(mask, [2 * size for size in structure])
+    closed[box] = binary_closing(mask[box], structure=np.ones(structure, dtype=bool))
+    return closed
+
+def signed_distance(mask, spacing, max_distance):
+    '''
+    Signed euclidean distance (mm) to the boundary of a mask, positive inside. Computed once per mask, every
+    erosion (distance > k) and dilation (distance >= -k) of the mask by k mm is then a threshold of it.
+
+    Args:
+        mask ('np.array'): Binary mask (slice, H, W).
+        spacing ('tuple'): Voxel size (slice, H, W), in mm.
+        max_distance ('float'): Largest dilation that will be thresholded, the distances are only computed
+            in the bounding box of the mask grown by it.
+
+    Returns:
+        distance ('np.array'): Signed distance (slice, H, W), -inf far outside of the mask.
+    '''
+    from scipy.ndimage import distance_transform_edt
+
+    distance = np.full(mask.shape, -np.inf)
+    if not mask.any():
+        return distance
+
+    box = _padded_box(mask, [int(np.ceil(max_distance / size)) + 1 for size in spacing])
+    inside = mask[box].astype(bool)
+    distance[box] = np.where(inside, distance_transform_edt(inside, sampling=spacing), -distance_transform_edt(~inside, sampling=spacing))
+    return distance
+
+def lung_mask_variants(volume, spacing, threshold=700, structures=((7, 7, 7),), margins=(), fill_holes_before_trachea_removal=False):
+    '''
+    Generate a family of lung masks from a single segmentation pass: the volume is thresholded and labelled
+    once, the trachea is removed once, and a single signed distance transform of every (closed) mask gives
+    all its eroded and dilated versions.
+
+    The variants are named <trachea|notrachea>-<raw|closed7x7x7>[-<eroded|dilated>Kmm], notrachea-closed7x7x7
+    is the mask of segment.py.
+
+    Args:
+        volume ('np.array'): CT volume (slice, H, W).
+        spacing ('tuple'): Voxel size (slice, H, W), in mm.
+        threshold ('int'): Threshold of the initial mask.
+        structures ('list'): Closing structuring elements (slice, H, W).
+        margins ('list'): Margins in mm, negative values erode the masks and positive values dilate them.
+        fill_holes_before_trachea_removal ('bool'): Close the lungs with twice the first structure before removing
+            the trachea, as segment.py does for copd2.
+
+    Returns:
+        variants ('generator'): (name, mask) pairs, masks are uint8 (slice, H, W).
+    '''
+    # the only connected component labelling of the volume
+    labeled_mask, _ = label_regions(create_mask(volume, threshold=threshold))
+    lungs = create_masks(labeled_mask, get_largest_regions(labeled_mask, num_regions=3))[1]
+    del labeled_mask
+
+    trachea_input = close_mask(lungs, tuple(2 * size for size in structures[0])) if fill_holes_before_trachea_removal and structures else lungs
+    bases = {'trachea': lungs, 'notrachea': remove_trachea(trachea_input, get_largest_regions, create_masks)}
+
+    max_distance = max([abs(margin) for margin in margins] + [0])
+    for trachea, base in bases.items():
+        for structure in [None] + list(structures):
+            mask = base if structure is None else close_mask(base, structure)
+            name = f"{trachea}-{'raw' if structure is None else 'closed' + 'x'.join(map(str, structure))}"
+            yield name, mask.astype(np.uint8)
+
+            if margins:
+                distance = signed_distance(mask, spacing, max_distance)
+                for margin in margins:
+                    # eroding by k keeps the voxels deeper than k, dilating by k adds the ones closer than k
+                    variant = distance > -margin if margin < 0 else distance >= -margin
+                    yield f"{name}-{'eroded' if margin < 0 else 'dilated'}{abs(margin):g}mm", variant.astype(np.uint8)
@@ -1,101 +1,37 @@
 import numpy as np
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-from glob import glob
+from .lazy import moved_attributes
 
-def plot_boxplot(experiment_name, output_dir, exclude=[], title="Boxplot"):
-    '''
-    Plot boxplot for the given data.
+def compute_landmark_TRE(pts_exhale_file, pts_inhale_file, voxel_size, chunk_size=None):
+    """
+    Computes the Target Registration Error (TRE) of every keypoint, the 3D Euclidean distance between the keypoints
+    in the reference image and the transformed keypoints.
 
     Args:
-        experiment_name (str): Name of the experiment.
-        output_dir (str): Path to the output directory.
-        exclude (list): List of columns to exclude from the boxplot.
-        title (str): Title of the plot.
-
-    Note:
-        The dataframe holds the data in columns. Each column represents an experiment (single box plot) that we want to plot.
-        We add the data to specific column of the experiment in the datafraame.
-
-        Each row in the dataframe represents the result obtained from each subject in the experiment.
-
-        >> df.head()
-        >>          Par0003.affine  Par0003.bs-R1-fg  Par0003.bs-R6-ug  experiment_name
-        >> copd1    10.62             26.25              1.34            ..
-        >> copd2    10.07             21.45              2.68            ..
-        >> copd3    03.57             12.04              1.27            ..
-        >> copd4    07.48             29.45              1.53            ..
-
-        If we describe the dataframe, we get the following:
-
-        >> stats = df.describe()
-        >> stats
-        >>       Par0003.affine  Par0003.bs-R1-fg  Par0003.bs-R6-ug
-        >> count  4.000000        4.000000          4.000000
-        >> mean   7.935000        22.795000         1.705000
-        >> std    3.417692        7.221071          0.700713
-        >> min    3.570000        12.040000         1.270000
-        >> 25%    6.345000        19.522500         1.330000
-        >> 50%    8.775000        23.850000         1.435000
-        >> 75%    10.365000       27.122500         2.060000
-        >> max    10.620000       29.450000         2.680000
+        pts_exhale_file (str): path to the file containing the coordinates of the moving points
+        pts_inhale_file (str): path to the file containing the coordinates of the fixed points
+        voxel_size (tuple): voxel size in mm
+        chunk_size (int): number of keypoints compared at once, POINTS_CHUNK_SIZE by default
 
     Returns:
-        None. The function generates and displays the box plot.
-    '''
-
-    # Get the data
-    columns = os.listdir(f'../output/{experiment_name}/')
-    TRE_sample_results = [path.replace('\\', '/') for path in glob(os.path.join(output_dir, experiment_name, "***", "points", "TRE_sample_results.csv"), recursive=True)]
-
-    # Remove the excluded columns
-    for column in exclude:
-        if column in columns:
-            columns.remove(column)
-
-        TRE_sample_results = [item for item in TRE_sample_results if column not in item]
-
-    # debugging
-    # columns = columns[:5]
-    # TRE_sample_results = TRE_sample_results[:5]
-    # print(columns)
-    # print(TRE_sample_results)
-
-    # assert len(columns) == len(TRE_sample_results)
-    assert  len(columns) == len(TRE_sample_results), f"Number of columns ({len(columns)}) does not match number of results ({len(TRE_sample_results)})"
-
-    # Create a dataframe
-    df = pd.DataFrame(columns=columns)
-
-    for i, path in enumerate(TRE_sample_results):
-        # Read the csv file
-        data = pd.read_csv(path, index_col=0)
-
-        # Add the data to the dataframe
-        columns[i] = columns[i] + f" ({data['TRE_mean'].mean():.3f})"
-        df[columns[i]] = data['TRE_mean']
-        
-    # Plot the boxplot
-    boxplot = df.boxplot(column=columns, rot=90)
-
-    # Get the lowest values for each column
-    lowest_values = df.mean()
-
-    # Get the column with the overall lowest minimum value
-    lowest_column = lowest_values.idxmin()
+        TRE (np.array): TRE of every keypoint in mm
+    """
+    from itertools import zip_longest
+    from .landmarks import iter_keypoints, POINTS_CHUNK_SIZE
 
-    # Highlight the entire boxplot for the column with the lowest minimum value in red
-    position = columns.index(lowest_column) + 1
+    chunk_size = chunk_size or POINTS_CHUNK_SIZE
 
-    # 7 is the number of data that represents a single boxplot (divide len(boxplot.get_lines())//len(columns) to get the number of data per boxplot)
-    boxplot.get_lines()[position * 7 - 7].set(color='red', linewidth=3) 
+    # both files are read chunk by chunk, dense correspondences are never fully loaded
+    TRE = []
+    for pts_exhale, pts_inhale in zip_longest(iter_keypoints(pts_exhale_file, chunk_size), iter_keypoints(pts_inhale_file, chunk_size)):
+        # Check if the number of points in both files is the same
+        if pts_exhale is None or pts_inhale is None or len(pts_inhale) != len(pts_exhale):
+            raise ValueError("The number of points in the fixed and moving files must be the same.")
 
-    # Set plot title
-    plt.title(title)
+        # Compute the TRE - square root of the sum of the squared elements
+        TRE.append(np.linalg.norm((pts_inhale - pts_exhale) * voxel_size, axis=1))
 
-    # Show the plot
-    plt.show()
+    return np.concatenate(TRE) if TRE else np.empty(0)
 
 def compute_TRE(pts_exhale_file, pts_inhale_file, voxel_size):
     """
@@ -111,15 +47,96 @@ def compute_TRE(pts_exhale_file, pts_inhale_file, voxel_size):
         mean_TRE (float): mean TRE in mm
         std_TRE (float): standard deviation of the TRE in mm
     """
-    # load the files if paths are provided
-    pts_inhale = np.loadtxt(pts_inhale_file)
-    pts_exhale = np.loadtxt(pts_exhale_file)
+    TRE = compute_landmark_TRE(pts_exhale_file, pts_inhale_file, voxel_size)
+
+    return np.round(np.mean(TRE),2), np.round(np.std(TRE),2)
+
+def _bounding_box(*masks, margin=1):
+    '''
+    Slices of the bounding box of the union of the masks, grown by a margin and clipped to the volume.
+    '''
+    union = np.logical_or.reduce(masks)
+    coordinates = np.nonzero(union)
+    if len(coordinates[0]) == 0:
+        return None
+    return tuple(
+        slice(max(0, axis.min() - margin), min(size, axis.max() + margin + 1))
+        for axis, size in zip(coordinates, union.shape))
+
+def _surface(mask):
+    '''
+    Boundary voxels of a binary mask, the voxels of the mask with a neighbour outside of it.
+    '''
+    from scipy.ndimage import binary_erosion
+    return mask & ~binary_erosion(mask, border_value=0)
+
+def compute_overlap_metrics(fixed_mask, warped_mask, spacing, percentile=95):
+    '''
+    Compare a warped (propagated) mask with the fixed mask using the Dice coefficient, the percentile
+    Hausdorff distance and the mean symmetric surface distance. The distance transforms are computed on
+    the bounding box of the two masks only, grown by a voxel so the surfaces are not cut.
+
+    Args:
+        fixed_mask ('np.array'): Fixed (reference) mask, any non zero voxel is inside.
+        warped_mask ('np.array'): Warped mask on the same grid.
+        spacing ('tuple'): Voxel size in mm, in the axes order of the arrays.
+        percentile ('float'): Percentile of the surface distances used as Hausdorff distance.
+
+    Returns:
+        metrics ('dict'): dice, hd95 (mm) and msd (mm), NaN when one of the masks is empty.
+    '''
+    from scipy.ndimage import distance_transform_edt
+
+    fixed_mask = np.asarray(fixed_mask) > 0
+    warped_mask = np.asarray(warped_mask) > 0
+
+    fixed_count, warped_count = fixed_mask.sum(), warped_mask.sum()
+    intersection = np.logical_and(fixed_mask, warped_mask).sum()
+    dice = 2.0 * intersection / (fixed_count + warped_count) if fixed_count + warped_count else np.nan
+
+    if fixed_count == 0 or warped_count == 0:
+        return {'dice': float(dice), 'hd95': np.nan, 'msd': np.nan}
+
+    box = _bounding_box(fixed_mask, warped_mask)
+    fixed_surface = _surface(fixed_mask[box])
+    warped_surface = _surface(warped_mask[box])
+
+    # distance of every voxel to the closest surface voxel of the other mask
+    fixed_distance = distance_transform_edt(~fixed_surface, sampling=spacing)
+    warped_distance = distance_transform_edt(~warped_surface, sampling=spacing)
+    distances = np.concatenate([warped_distance[fixed_surface], fixed_distance[warped_surface]])
+
+    return {'dice': float(dice), 'hd95': float(np.percentile(distances, percentile)), 'msd': float(distances.mean())}
+
+def _overlap_metrics_from_files(fixed_mask_path, warped_mask_path):
+    import SimpleITK as sitk
+
+    fixed = sitk.ReadImage(fixed_mask_path)
+    warped = sitk.ReadImage(warped_mask_path)
+
+    # the arrays are (z, y, x), so is the spacing
+    return compute_overlap_metrics(
+        sitk.GetArrayViewFromImage(fixed), sitk.GetArrayViewFromImage(warped), fixed.GetSpacing()[::-1])
+
+def compute_overlap_metrics_batch(pairs, num_workers=os.cpu_count()):
+    '''
+    Compute the overlap metrics of many (fixed mask, warped mask) file pairs, e.g. all the subjects of all
+    the configurations of a sweep, in parallel processes.
+
+    Args:
+        pairs ('list'): (fixed_mask_path, warped_mask_path) tuples.
+        num_workers ('int'): Number of processes.
+
+    Returns:
+        metrics ('list'): compute_overlap_metrics results, in the order of the pairs.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    if num_workers <= 1 or len(pairs) <= 1:
+        return [_overlap_metrics_from_files(*pair) for pair in pairs]
 
-    # Check if the number of points in both files is the same
-    if len(pts_inhale) != len(pts_exhale):
-        raise ValueError("The number of points in the fixed and moving files must be the same.")
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(_overlap_metrics_from_files, *zip(*pairs)))
 
-    # Compute the TRE - square root of the sum of the squared elements
-    TRE = np.linalg.norm((pts_inhale - pts_exhale) * voxel_size, axis=1)
 
-    return np.round(np.mean(TRE),2), np.round(np.std(TRE),2)
\ No newline at end of file
+__getattr__ = moved_attributes(__name__, '.visualization', ('plot_boxplot',))
@@ -0,0 +1,363 @@
+import os
+import re
+import math
+import time
+import subprocess
+from glob import glob
+from itertools import accumulate
+
+# default early stopping rule, every check can be disabled by setting it to None
+DEFAULT_STOPPING_RULE = {
+    # stop as soon as the metric or the step size is NaN/inf
+    'stop_on_nan': True,
+    # iterations of a resolution before the divergence and plateau checks start
+    'min_iterations': 50,
+    # number of iterations averaged to smooth the stochastic metric
+    'window': 25,
+    # stop when the smoothed metric rises above the best smoothed metric by this fraction of |best|
+    'divergence_tolerance': 0.5,
+    # stop when the smoothed metric improved less than plateau_tolerance * |metric| over this many iterations
+    'plateau_iterations': None,
+    'plateau_tolerance': 1e-4,
+}
+
+# IterationInfo.<parameter file index>.R<resolution>.txt
+# note left in the output directory of a registration stopped by the stopping rule
+EARLY_STOPPING_FILENAME = 'early_stopping.txt'
+
+ITERATION_INFO_PATTERN = re.compile(r'IterationInfo\.(?P<level>\d+)\.R(?P<resolution>\d+)\.txt$')
+
+
+def parse_value(text):
+    '''
+    Parse a numeric value written by elastix, including the platform specific NaN spellings
+    (nan, -nan(ind), 1.#QNAN, ...).
+
+    Args:
+        text ('str'): Value as written in the file.
+
+    Returns:
+        value ('float'): Parsed value.
+    '''
+    try:
+        return float(text)
+    except ValueError:
+        lowered = text.lower()
+        if 'nan' in lowered or 'ind' in lowered:
+            return math.nan
+        if 'inf' in lowered:
+            return -math.inf if lowered.startswith('-') else math.inf
+        raise
+
+def parse_iteration_info_header(line):
+    '''
+    Get the column names of an IterationInfo file from its header line,
+    e.g. "1:ItNr  2:Metric  3a:Time  3b:StepSize  4:||Gradient||  Time[ms]".
+
+    Args:
+        line ('str'): Header line.
+
+    Returns:
+        columns ('list'): Column names without the numbering (ItNr, Metric, StepSize, ...).
+    '''
+    return [column.strip().split(':', 1)[-1] for column in line.strip().split('\t') if column.strip()]
+
+def parse_iteration_info_row(line, columns):
+    '''
+    Parse a single row of an IterationInfo file.
+
+    Args:
+        line ('str'): Row line.
+        columns ('list'): Column names from parse_iteration_info_header.
+
+    Returns:
+        row ('dict'): Column name -> value, None if the line is not a complete row.
+    '''
+    values = line.strip().split('\t')
+    if len(values) != len(columns):
+        return None
+
+    try:
+        return {column: parse_value(value) for column, value in zip(columns, values)}
+    except ValueError:
+        return None
+
+def read_new_lines(file_path, offset):
+    '''
+    Read the complete lines appended to a file since a given byte offset. An incomplete last line
+    (still being written) is left for the next read.
+
+    Args:
+        file_path ('str'): Path to the file.
+        offset ('int'): Byte offset of the previous read.
+
+    Returns:
+        lines ('list'): New complete lines.
+        offset ('int'): Byte offset to use for the next read.
+    '''
+    try:
+        with open(file_path, 'rb') as file:
+            file.seek(offset)
+            data = file.read()
+    except FileNotFoundError:
+        return [], offset
+
+    end = data.rfind(b'\n')
+    if end < 0:
+        return [], offset
+
+    lines = data[:end].decode(errors='replace').splitlines()
+    return lines, offset + end + 1
+
+def check_stopping_rule(metrics, step_sizes=None, rule=None):
+    '''
+    Check the metric values of the current resolution against an early stopping rule.
+
+    Args:
+        metrics ('list'): Metric values of the current resolution, in iteration order.
+        step_sizes ('list'): Optional step sizes of the current resolution.
+        rule ('dict'): Early stopping rule, missing entries are taken from DEFAULT_STOPPING_RULE.
+
+    Returns:
+        reason ('str'): Why the run should be stopped, None if it should continue.
+    '''
+    rule = {**DEFAULT_STOPPING_RULE, **(rule or {})}
+
+    if not metrics:
+        return None
+
+    if rule['stop_on_nan']:
+        if not math.isfinite(metrics[-1]):
+            return f"metric is {metrics[-1]} at iteration {len(metrics) - 1}"
+        if step_sizes and not math.isfinite(step_sizes[-1]):
+            return f"step size is {step_sizes[-1]} at iteration {len(step_sizes) - 1}"
+
+    window = rule['window']
+    if len(metrics) < max(rule['min_iterations'], window):
+        return None
+
+    # smoothed metric over a sliding window, elastix minimizes the metric
+    cumulative = [0.0, *accumulate(metrics)]
+    smoothed = [(cumulative[idx] - cumulative[idx - window]) / window for idx in range(window, len(cumulative))]
+    current, best = smoothed[-1], min(smoothed)
+
+    if rule['divergence_tolerance'] is not None and current - best > rule['divergence_tolerance'] * max(abs(best), 1e-12):
+        return f"metric diverged from {best:.6f} to {current:.6f} (window {window})"
+
+    plateau_iterations = rule['plateau_iterations']
+    if plateau_iterations is not None and len(smoothed) > plateau_iterations:
+        improvement = smoothed[-plateau_iterations - 1] - current
+        if improvement < rule['plateau_tolerance'] * max(abs(current), 1e-12):
+            return f"metric improved by {improvement:.3g} over the last {plateau_iterations} iterations"
+
+    return None
+
+def get_output_dir(command):
+    '''
+    Get the elastix/transformix output directory (-out) from a command line.
+
+    Args:
+        command ('str'): Command line.
+
+    Returns:
+        output_dir ('str'): Output directory, None if the command has no -out argument.
+    '''
+    match = re.search(r'-out\s+(?:"([^"]+)"|(\S+))', command)
+    return (match.group(1) or match.group(2)) if match else None
+
+def kill_process_tree(process):
+    '''
+    Kill a process started with shell=True together with its children (the shell would otherwise
+    leave elastix running).
+
+    Args:
+        process ('subprocess.Popen'): Process to kill.
+
+    Returns:
+        None
+    '''
+    try:
+        import psutil
+        children = psutil.Process(process.pid).children(recursive=True)
+    except Exception:
+        children = []
+
+    for child in children:
+        try:
+            child.kill()
+        except Exception:
+            pass
+    process.kill()
+
+def run_monitored(command, output_dir=None, rule=None, poll_interval=1.0, callback=None):
+    '''
+    Run an elastix command while tailing the IterationInfo.*.txt and elastix.log files of its output
+    directory, and kill it when the early stopping rule is met.
+
+    Args:
+        command ('str'): Elastix command line.
+        output_dir ('str'): Elastix output directory, taken from the -out argument if not given.
+        rule ('dict'): Early stopping rule, see DEFAULT_STOPPING_RULE.
+        poll_interval ('float'): Seconds between two reads of the output files.
+        callback ('function'): Optional function called as callback(event, source, data) for every new
+            IterationInfo row (event 'iteration', data is the row dict) and elastix.log line (event 'log').
+
+    Returns:
+        result ('dict'): returncode, stopped (bool), reason, iterations (per IterationInfo file) and duration.
+    '''
+    output_dir = output_dir or get_output_dir(command)
+    log_path = os.path.join(output_dir, 'elastix.log') if output_dir else None
+
+    # files of a previous run in the same directory are not part of this run
+    start_time = time.time()
+    offsets, columns, metrics, step_sizes = {}, {}, {}, {}
+    reason = None
+
+    # the command output is also written by elastix to elastix.log, so it is not buffered here
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True)
+
+    while True:
+        finished = process.poll() is not None
+
+        if output_dir:
+            paths = sorted(glob(os.path.join(output_dir, 'IterationInfo.*.txt')))
+            for path in paths:
+                if path not in offsets:
+                    if os.path.getmtime(path) < start_time - 1:
+                        continue
+                    offsets[path], metrics[path], step_sizes[path] = 0, [], []
+
+                lines, offsets[path] = read_new_lines(path, offsets[path])
+                for line in lines:
+                    if path not in columns:
+                        columns[path] = parse_iteration_info_header(line)
+                        continue
+
+                    row = parse_iteration_info_row(line, columns[path])
+                    if row is None:
+                        continue
+
+                    metrics[path].append(row.get('Metric', math.nan))
+                    if 'StepSize' in row:
+                        step_sizes[path].append(row['StepSize'])
+                    if callback:
+                        callback('iteration', path, row)
+
+                if reason is None and metrics[path]:
+                    reason = check_stopping_rule(metrics[path], step_sizes[path], rule)
+                    if reason:
+                        reason = f"{os.path.basename(path)}: {reason}"
+
+            if callback and log_path and os.path.exists(log_path) and os.path.getmtime(log_path) >= start_time - 1:
+                lines, offsets[log_path] = read_new_lines(log_path, offsets.get(log_path, 0))
+                for line in lines:
+                    callback('log', log_path, line)
+
+        if reason and not finished:
+            kill_process_tree(process)
+            process.wait()
+
+            # leave a note in the output directory, so the sweep reports can tell why the run is incomplete
+            with open(os.path.join(output_dir, EARLY_STOPPING_FILENAME), 'w') as file:
+                file.write(reason + '\n')
+            break
+
+        if finished:
+            break
+
+        time.sleep(poll_interval)
+
+    return {
+        'returncode': process.returncode,
+        'stopped': reason is not None and process.returncode != 0,
+        'reason': reason,
+        'iterations': {os.path.basename(path): len(values) for path, values in metrics.items()},
+        'duration': time.time() - start_time,
+    }
+
+def print_progress(event, source, data):
+    '''
+    Callback for run_monitored that prints the metric and step size of every iteration.
+
+    Args:
+        event ('str'): 'iteration' or 'log'.
+        source ('str'): Path of the file the event was read from.
+        data: IterationInfo row dict or elastix.log line.
+
+    Returns:
+        None
+    '''
+    if event == 'iteration':
+        print(f"{os.path.basename(source)} it {int(data.get('ItNr', -1))}: metric {data.get('Metric')}, step size {data.get('StepSize')}")
+
+def monitored_excute_cmd(command, rule=None, resume=True):
+    '''
+    Drop-in replacement of utils.elastix.excute_cmd that monitors elastix commands (those with an -out
+    argument and an elastix executable) and runs any other command normally.
+
+    Args:
+        command ('str'): Command to execute.
+        rule ('dict'): Early stopping rule, see DEFAULT_STOPPING_RULE.
+        resume ('bool'): If True, an interrupted registration resumes from its last finished resolution
+            (see utils.checkpoint) and a finished one is not run again.
+
+    Returns:
+        result ('dict'): Result of run_monitored for elastix commands, the output of excute_cmd otherwise.
+    '''
+    executable = command.strip().split(' ')[0].replace('\\', '/').split('/')[-1].lower()
+
+    if executable.startswith('elastix') and get_output_dir(command):
+        from .checkpoint import prepare_resume, finish_resume
+
+        run_command, checkpoint = prepare_resume(command) if resume else (command, None)
+        if run_command is None:
+            print(f"Skipping {command}, the registration already finished.")
+            return {'returncode': 0, 'stopped': False, 'reason': None, 'iterations': {}, 'duration': 0.0}
+        if checkpoint:
+            print(f"Resuming from {checkpoint['checkpoint']}")
+
+        result = run_monitored(run_command, rule=rule, callback=print_progress)
+        if result['stopped']:
+            print(f"Registration stopped early: {result['reason']}")
+        elif checkpoint and result['returncode'] == 0:
+            finish_resume(checkpoint)
+        return result
+
+    from .elastix import excute_cmd
+    return excute_cmd(command)
+
+def run_batch_file(bat_path, rule=None, resume=True):
+    '''
+    Run the commands of an elastix_transformix.bat file created by create_script.py, monitoring the elastix
+    registrations. The transformix command of a registration stopped early is skipped.
+
+    Args:
+        bat_path ('str'): Path to the .bat file.
+        rule ('dict'): Early stopping rule, see DEFAULT_STOPPING_RULE.
+        resume ('bool'): If True, the interrupted registrations resume from their checkpoints.
+
+    Returns:
+        results ('list'): One (command, result) tuple per executed command.
+    '''
+    results = []
+    stopped_outputs = set()
+
+    with open(bat_path, 'r') as file:
+        commands = [line.strip() for line in file]
+
+    for command in commands:
+        if not command or command.startswith(('@echo', 'echo ', 'REM ')):
+            continue
+
+        # transformix -tp refers to the transform of a registration that was stopped
+        transform_match = re.search(r'-tp\s+"([^"]+)"', command)
+        if transform_match and os.path.dirname(transform_match.group(1)) in stopped_outputs:
+            print(f"Skipping {command}, the registration was stopped early.")
+            continue
+
+        result = monitored_excute_cmd(command, rule=rule, resume=resume)
+        if isinstance(result, dict) and result['stopped']:
+            stopped_outputs.add(get_output_dir(command))
+        results.append((command, result))
+
+    return results
@@ -0,0 +1,218 @@
+import os
+import numpy as np
+
+from .elastix import write_parameter_file
+
+# moment based initializations, from the cheapest to the most flexible
+MOMENT_MODES = ['translation', 'scaling', 'affine']
+
+
+def _image_geometry(image):
+    '''
+    Origin, spacing, direction (3, 3) and size of a SimpleITK image as numpy arrays.
+    '''
+    return (np.array(image.GetOrigin()), np.array(image.GetSpacing()),
+            np.array(image.GetDirection()).reshape(3, 3), np.array(image.GetSize()))
+
+def index_to_physical(image, index):
+    '''
+    Map voxel indices (N, 3), x y z, to physical points of an image, p = origin + direction (index * spacing).
+
+    Args:
+        image ('sitk.Image'): Image (or mask) giving the geometry.
+        index ('np.array'): Continuous voxel indices (N, 3).
+
+    Returns:
+        points ('np.array'): Physical points (N, 3).
+    '''
+    origin, spacing, direction, _ = _image_geometry(image)
+    return origin + (np.asarray(index, dtype=np.float64) * spacing) @ direction.T
+
+def physical_to_index(image, points):
+    '''
+    Map physical points (N, 3) to continuous voxel indices of an image, the inverse of index_to_physical.
+
+    Args:
+        image ('sitk.Image'): Image (or mask) giving the geometry.
+        points ('np.array'): Physical points (N, 3).
+
+    Returns:
+        index ('np.array'): Continuous voxel indices (N, 3), x y z.
+    '''
+    origin, spacing, direction, _ = _image_geometry(image)
+    return ((np.asarray(points, dtype=np.float64) - origin) @ np.linalg.inv(direction).T) / spacing
+
+def mask_moments(mask_image, stride=2):
+    '''
+    Centroid and second moments (covariance) of the foreground of a mask, in physical coordinates.
+
+    Args:
+        mask_image ('sitk.Image'): Lung mask, any non zero voxel is foreground.
+        stride ('int'): Only every stride-th voxel along every axis is used, the moments of a lung mask
+            hardly change and the cost drops by stride^3.
+
+    Returns:
+        centroid ('np.array'): Centroid (3,).
+        covariance ('np.array'): Covariance matrix (3, 3).
+    '''
+    import SimpleITK as sitk
+
+    array = sitk.GetArrayViewFromImage(mask_image)[::stride, ::stride, ::stride]
+    z, y, x = np.nonzero(array)
+    if len(x) == 0:
+        raise ValueError("The mask is empty, its moments are not defined")
+
+    points = index_to_physical(mask_image, np.stack([x, y, z], axis=1) * stride)
+    return points.mean(axis=0), np.cov(points, rowvar=False)
+
+def _sqrtm(matrix, inverse=False):
+    # square root of a symmetric positive definite matrix, from its eigen decomposition
+    values, vectors = np.linalg.eigh(matrix)
+    values = np.clip(values, 1e-12, None) ** (-0.5 if inverse else 0.5)
+    return (vectors * values) @ vectors.T
+
+def moment_affine(fixed_mask, moving_mask, mode='scaling', stride=2):
+    '''
+    Initial affine transform from the moments of the lung masks. As elastix, the transform maps the fixed
+    (inhale) space to the moving (exhale) space: x -> matrix (x - center) + center + translation.
+
+    Args:
+        fixed_mask ('sitk.Image'): Fixed lung mask.
+        moving_mask ('sitk.Image'): Moving lung mask.
+        mode ('str'): 'translation' aligns the centroids, 'scaling' also matches the spread of the masks
+            along every axis, 'affine' matches their full covariance (symmetric matrix, no rotation).
+        stride ('int'): Voxel stride of the moments, see mask_moments.
+
+    Returns:
+        transform ('dict'): matrix (3, 3), translation (3,) and center (3,).
+    '''
+    if mode not in MOMENT_MODES:
+        raise ValueError(f"Moment mode {mode} is not one of {MOMENT_MODES}")
+
+    fixed_centroid, fixed_covariance = mask_moments(fixed_mask, stride=stride)
+    moving_centroid, moving_covariance = mask_moments(moving_mask, stride=stride)
+
+    if mode == 'translation':
+        matrix = np.eye(3)
+    elif mode == 'scaling':
+        matrix = np.diag(np.sqrt(np.diag(moving_covariance) / np.diag(fixed_covariance)))
+    else:
+        matrix = _sqrtm(moving_covariance) @ _sqrtm(fixed_covariance, inverse=True)
+
+    # the centroid of the fixed mask lands on the centroid of the moving mask
+    return {'matrix': matrix, 'translation': moving_centroid - fixed_centroid, 'center': fixed_centroid}
+
+def apply_affine(transform, points):
+    '''
+    Map fixed physical points (N, 3) to the moving space with a transform from moment_affine.
+    '''
+    return (np.asarray(points) - transform['center']) @ transform['matrix'].T + transform['center'] + transform['translation']
+
+def refine_affine(fixed_image, moving_image, transform, fixed_mask=None, shrink_factors=(4, 2), iterations=200, mask_margin=10.0, num_threads=os.cpu_count()):
+    '''
+    Refine an initial affine transform with a quick SimpleITK registration (mutual information, regular step
+    gradient descent) on downsampled volumes. The initial transform is kept if the refinement makes the
+    metric worse.
+
+    Args:
+        fixed_image ('sitk.Image'): Fixed volume.
+        moving_image ('sitk.Image'): Moving volume.
+        transform ('dict'): Initial transform from moment_affine.
+        fixed_mask ('sitk.Image'): Optional fixed lung mask, the metric is only sampled inside it, grown by
+            mask_margin so the lung boundaries are part of the samples.
+        shrink_factors ('tuple'): Downsampling factor of every resolution level.
+        iterations ('int'): Maximum number of iterations of every level.
+        mask_margin ('float'): Dilation of the fixed mask, in mm.
+        num_threads ('int'): Number of threads of the registration.
+
+    Returns:
+        transform ('dict'): matrix, translation and center, and the metric before and after.
+    '''
+    import SimpleITK as sitk
+
+    affine = sitk.AffineTransform(3)
+    affine.SetCenter([float(value) for value in transform['center']])
+    affine.SetMatrix([float(value) for value in transform['matrix'].ravel()])
+    affine.SetTranslation([float(value) for value in transform['translation']])
+
+    fixed = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    moving = sitk.Cast(moving_image, sitk.sitkFloat32)
+
+    registration = sitk.ImageRegistrationMethod()
+    registration.SetNumberOfThreads(num_threads)
+    registration.SetMetricAsMattesMutualInformation(numberOfHistogramBins=32)
+    registration.SetMetricSamplingStrategy(registration.RANDOM)
+    registration.SetMetricSamplingPercentage(0.1, seed=1234)
+    registration.SetInterpolator(sitk.sitkLinear)
+    registration.SetOptimizerAsRegularStepGradientDescent(learningRate=2.0, minStep=1e-3, numberOfIterations=iterations, gradientMagnitudeTolerance=1e-8)
+    registration.SetOptimizerScalesFromPhysicalShift()
+    registration.SetShrinkFactorsPerLevel(list(shrink_factors))
+    registration.SetSmoothingSigmasPerLevel([factor / 2 for factor in shrink_factors])
+    registration.SmoothingSigmasAreSpecifiedInPhysicalUnitsOff()
+
+    if fixed_mask is not None:
+        radius = [max(1, int(round(mask_margin / spacing))) for spacing in fixed_mask.GetSpacing()]
+        registration.SetMetricFixedMask(sitk.BinaryDilate(sitk.Cast(fixed_mask > 0, sitk.sitkUInt8), radius))
+
+    # the affine transform is optimized in place, the metric is evaluated before and after
+    registration.SetInitialTransform(affine, inPlace=True)
+    initial_metric = registration.MetricEvaluate(fixed, moving)
+    registration.Execute(fixed, moving)
+    final_metric = registration.MetricEvaluate(fixed, moving)
+
+    result = {'initial_metric': initial_metric, 'final_metric': final_metric, 'iterations': registration.GetOptimizerIteration()}
+    if final_metric > initial_metric:
+        return {**transform, **result}
+
+    return {
+        **result,
+        'matrix': np.array(affine.GetMatrix()).reshape(3, 3),
+        'translation': np.array(affine.GetTranslation()),
+        'center': np.array(affine.GetCenter()),
+    }
+
+def write_elastix_affine(transform, fixed_image, file_path):
+    '''
+    Write an affine transform as an elastix TransformParameters file, usable as an initial transform (-t0)
+    of elastix or by transformix.
+
+    Args:
+        transform ('dict'): matrix, translation and center.
+        fixed_image ('sitk.Image'): Fixed volume (or mask), its grid is the output grid of the transform.
+        file_path ('str'): Path to the TransformParameters file.
+
+    Returns:
+        None
+    '''
+    origin, spacing, direction, size = _image_geometry(fixed_image)
+
+    def floats(values):
+        return [float(value) for value in np.ravel(values)]
+
+    parameters = {
+        'Transform': 'AffineTransform',
+        'NumberOfParameters': 12,
+        'TransformParameters': floats(transform['matrix']) + floats(transform['translation']),
+        'InitialTransformParametersFileName': 'NoInitialTransform',
+        'HowToCombineTransforms': 'Compose',
+        'FixedImageDimension': 3,
+        'MovingImageDimension': 3,
+        'FixedInternalImagePixelType': 'float',
+        'MovingInternalImagePixelType': 'float',
+        'Size': [int(value) for value in size],
+        'Index': [0, 0, 0],
+        'Spacing': floats(spacing),
+        'Origin': floats(origin),
+        # elastix writes the direction cosines column by column
+        'Direction': floats(direction.T),
+        'UseDirectionCosines': 'true',
+        'CenterOfRotationPoint': floats(transform['center']),
+        'ResampleInterpolator': 'FinalBSplineInterpolator',
+        'FinalBSplineInterpolationOrder': 3,
+        'Resampler': 'DefaultResampler',
+        'DefaultPixelValue': 0,
+        'ResultImageFormat': 'nii.gz',
+        'ResultImagePixelType': 'short',
+        'CompressResultImage': 'false',
+    }
+    write_parameter_file(parameters, file_path)
@@ -1,7 +1,6 @@
 import os
 import SimpleITK as sitk
 import numpy as np
-from skimage import exposure
 
 def anisotropic_diffusion_denoise_3d(input_volume, conductance_parameter, time_step, number_of_iterations):
     '''
@@ -90,6 +89,9 @@ def clahe_3d(input_volume, clip_limit=0.1):
     # Determine kernel sizes in each dim relative to image shape
     kernel_size = (size_x // 5, size_y // 5, size_z // 2)
 
+    # skimage is only needed by clahe, it is imported here to keep the other preprocessing variants fast to start
+    from skimage import exposure
+
     # get the image from the input volume
     input_volume_image = sitk.GetArrayFromImage(input_volume)
 
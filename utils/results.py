@@ -0,0 +1,292 @@
+import os
+import re
+import json
+import time
+import sqlite3
+
+from .logger import logger
+
+# default results database, at the root of the experiments outputs
+RESULTS_DB_FILENAME = 'results.sqlite'
+
+# columns identifying the configuration of a result, in every table
+CONFIGURATION_COLUMNS = ['experiment', 'reg_params_key', 'preprocessing', 'use_masks', 'split']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subject_results (
+    experiment TEXT NOT NULL,
+    reg_params_key TEXT NOT NULL,
+    preprocessing TEXT,
+    use_masks INTEGER,
+    split TEXT NOT NULL,
+    sample_name TEXT NOT NULL,
+    tre_mean REAL,
+    tre_std REAL,
+    landmarks INTEGER,
+    runtime REAL,
+    ingested_at REAL,
+    PRIMARY KEY (experiment, reg_params_key, split, sample_name)
+);
+CREATE TABLE IF NOT EXISTS landmark_results (
+    experiment TEXT NOT NULL,
+    reg_params_key TEXT NOT NULL,
+    preprocessing TEXT,
+    use_masks INTEGER,
+    split TEXT NOT NULL,
+    sample_name TEXT NOT NULL,
+    landmark INTEGER NOT NULL,
+    tre REAL,
+    runtime REAL,
+    PRIMARY KEY (experiment, reg_params_key, split, sample_name, landmark)
+);
+CREATE INDEX IF NOT EXISTS subject_results_configuration ON subject_results (experiment, reg_params_key);
+CREATE INDEX IF NOT EXISTS landmark_results_configuration ON landmark_results (experiment, reg_params_key);
+'''
+
+
+def connect(db_path):
+    '''
+    Open (and create if needed) the results database. Several processes can write to it, a writer waits
+    for the others instead of failing.
+
+    Args:
+        db_path ('str'): Path to the sqlite file.
+
+    Returns:
+        connection ('sqlite3.Connection'): Open connection.
+    '''
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+def get_preprocessing_variant(dataset_path):
+    '''
+    Get the preprocessing variant of a dataset split, from the dataset_processed/<variant>/<split> layout
+    created by preprocess.py.
+
+    Args:
+        dataset_path ('str'): Path to the dataset split.
+
+    Returns:
+        variant ('str'): Preprocessing variant (e.g. Normalization), 'None' for the raw dataset.
+    '''
+    parts = os.path.normpath(dataset_path).replace('\\', '/').split('/')
+    if len(parts) >= 3 and parts[-3] == 'dataset_processed':
+        return parts[-2]
+    return 'None'
+
+def get_experiment_configuration(exp_output, experiment_name):
+    '''
+    Get the preprocessing variant and the mask setting of an experiment, from the parameters.json manifest
+    written by create_script.py, or from the experiment name (e.g. Normalization+UseMasks3+SingleParamFile)
+    for the older experiments.
+
+    Args:
+        exp_output ('str'): Experiment output directory (<output>/<experiment>/<reg_params_key>).
+        experiment_name ('str'): Experiment name.
+
+    Returns:
+        configuration ('dict'): preprocessing, use_masks and split (None for the older experiments).
+    '''
+    from .elastix import RUN_MANIFEST_FILENAME
+    from .catalog import get_split_name
+
+    manifest_path = os.path.join(exp_output, RUN_MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as json_file:
+            manifest = json.load(json_file)
+        return {'preprocessing': get_preprocessing_variant(manifest['dataset_path']), 'use_masks': int(manifest['use_masks']),
+                'split': get_split_name(manifest['dataset_path'])}
+
+    tokens = experiment_name.split('+')
+    preprocessing = [token for token in tokens if not re.match(r'^(UseMasks\d*|\w*ParamFiles?|NoPreprocessing)$', token)]
+    return {
+        'preprocessing': '+'.join(preprocessing) if preprocessing else 'None',
+        'use_masks': int(any(token.startswith('UseMasks') for token in tokens)),
+        'split': None,
+    }
+
+def ingest_subject(connection, configuration, sample_name, landmark_tre, runtime=None):
+    '''
+    Add (or replace) the results of a single registration, its per-landmark TRE and their summary. The
+    rows of the other registrations are not touched, so runs can be added one by one.
+
+    Args:
+        connection ('sqlite3.Connection'): Open connection.
+        configuration ('dict'): experiment, reg_params_key, preprocessing, use_masks and split.
+        sample_name ('str'): Subject name (e.g. copd1).
+        landmark_tre ('np.array'): TRE of every landmark, in mm.
+        runtime ('float'): Optional registration runtime, in seconds.
+
+    Returns:
+        None
+    '''
+    import numpy as np
+
+    key = [configuration[column] for column in CONFIGURATION_COLUMNS]
+    landmark_tre = np.asarray(landmark_tre, dtype=np.float64)
+    runtime = None if runtime is None or not np.isfinite(runtime) else float(runtime)
+
+    with connection:
+        connection.execute(
+            'DELETE FROM landmark_results WHERE experiment = ? AND reg_params_key = ? AND split = ? AND sample_name = ?',
+            (configuration['experiment'], configuration['reg_params_key'], configuration['split'], sample_name))
+        connection.executemany(
+            'INSERT INTO landmark_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((*key, sample_name, idx, float(tre), runtime) for idx, tre in enumerate(landmark_tre.tolist())))
+        connection.execute(
+            'INSERT OR REPLACE INTO subject_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (*key, sample_name, float(np.mean(landmark_tre)), float(np.std(landmark_tre)), len(landmark_tre), runtime, time.time()))
+
+def ingest_csv_results(connection, output_dir, experiment_name, split=None):
+    '''
+    Import the TRE_sample_results.csv files of an experiment evaluated before the results database existed.
+    Only the per-subject rows can be imported, the csv files have no per-landmark values. The split of every
+    parameters key is read from its parameters.json manifest.
+
+    Args:
+        connection ('sqlite3.Connection'): Open connection.
+        output_dir ('str'): Root dir of the experiments outputs.
+        experiment_name ('str'): Experiment name.
+        split ('str'): Split of the keys without a manifest (e.g. test), these keys are skipped if not given.
+
+    Returns:
+        count ('int'): Number of imported subject rows.
+    '''
+    import csv
+
+    experiment_dir = os.path.join(output_dir, experiment_name)
+    count = 0
+
+    for reg_params_key in sorted(os.listdir(experiment_dir)):
+        csv_path = os.path.join(experiment_dir, reg_params_key, 'points', 'TRE_sample_results.csv')
+        if not os.path.exists(csv_path):
+            continue
+
+        configuration = get_experiment_configuration(os.path.join(experiment_dir, reg_params_key), experiment_name)
+        key_split = configuration['split'] or split
+        if key_split is None:
+            logger.warning(f"The split of {experiment_name}/{reg_params_key} is unknown, pass it to import its results.")
+            continue
+
+        with open(csv_path, 'r', newline='') as csv_file, connection:
+            for row in csv.DictReader(csv_file):
+                connection.execute(
+                    'INSERT OR IGNORE INTO subject_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (experiment_name, reg_params_key, configuration['preprocessing'], configuration['use_masks'], key_split,
+                     row['sample_name'], float(row['TRE_mean']), float(row['TRE_std']), None, None, time.time()))
+                count += 1
+
+    return count
+
+def query(connection, sql, params=()):
+    '''
+    Run a query on the results database.
+
+    Args:
+        connection ('sqlite3.Connection'): Open connection.
+        sql ('str'): SQL query, e.g. a group by over subject_results or landmark_results.
+        params ('tuple'): Query parameters.
+
+    Returns:
+        df ('pd.DataFrame'): Query result.
+    '''
+    import pandas as pd
+    return pd.read_sql_query(sql, connection, params=params)
+
+def get_subject_results(connection, experiment_name=None, split=None):
+    '''
+    Get the per-subject TRE of the experiments, one row per registration.
+
+    Args:
+        connection ('sqlite3.Connection'): Open connection.
+        experiment_name ('str'): Optional experiment to restrict the results to.
+        split ('str'): Optional dataset split to restrict the results to.
+
+    Returns:
+        df ('pd.DataFrame'): Subject results.
+    '''
+    conditions, params = [], []
+    if experiment_name:
+        conditions.append('experiment = ?')
+        params.append(experiment_name)
+    if split:
+        conditions.append('split = ?')
+        params.append(split)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return query(connection, f'SELECT * FROM subject_results {where} ORDER BY experiment, reg_params_key, sample_name', tuple(params))
+
+def get_leaderboard(connection, split=None, limit=None):
+    '''
+    Rank the configurations by their mean TRE over all the landmarks (or the subjects means when the
+    landmarks were not stored).
+
+    Args:
+        connection ('sqlite3.Connection'): Open connection.
+        split ('str'): Optional dataset split to restrict the ranking to.
+        limit ('int'): Optional number of configurations to return.
+
+    Returns:
+        df ('pd.DataFrame'): One row per configuration with subjects, tre_mean, tre_std (over the subjects
+            means), worst_subject and mean runtime, the best configuration first.
+    '''
+    where = 'WHERE split = ?' if split else ''
+    params = (split,) if split else ()
+
+    sql = f'''
+        SELECT experiment, reg_params_key, preprocessing, use_masks, split,
+               COUNT(*) AS subjects,
+               SUM(tre_mean * COALESCE(landmarks, 1)) / SUM(COALESCE(landmarks, 1)) AS tre_mean,
+               AVG(tre_mean * tre_mean) - AVG(tre_mean) * AVG(tre_mean) AS tre_var,
+               MAX(tre_mean) AS worst_subject,
+               AVG(runtime) AS runtime
+        FROM subject_results {where}
+        GROUP BY experiment, reg_params_key, preprocessing, use_masks, split
+        ORDER BY tre_mean ASC
+    '''
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+
+    import numpy as np
+
+    df = query(connection, sql, params)
+    df.insert(df.columns.get_loc('tre_var'), 'tre_std', np.sqrt(df.pop('tre_var').clip(lower=0)))
+    return df
+
+def get_landmark_matrix(connection, experiments=None, split=None):
+    '''
+    Get the per-landmark TRE of the configurations as a matrix, one row per configuration and one column
+    per (subject, landmark) evaluated by all of them.
+
+    Args:
+        connection ('sqlite3.Connection'): Open connection.
+        experiments ('list'): Optional experiments to restrict the configurations to.
+        split ('str'): Optional dataset split to restrict the landmarks to.
+
+    Returns:
+        tre ('np.array'): TRE (n_configurations, n_landmarks).
+        names ('list'): <experiment>/<reg_params_key> of every row.
+        groups ('np.array'): Subject of every column.
+    '''
+    conditions, params = [], []
+    if experiments:
+        conditions.append(f"experiment IN ({', '.join('?' for _ in experiments)})")
+        params.extend(experiments)
+    if split:
+        conditions.append('split = ?')
+        params.append(split)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    df = query(connection, f'SELECT experiment, reg_params_key, split, sample_name, landmark, tre FROM landmark_results {where}', tuple(params))
+
+    df['name'] = df['experiment'] + '/' + df['reg_params_key']
+    matrix = df.pivot_table(index='name', columns=['split', 'sample_name', 'landmark'], values='tre')
+
+    # the configurations are compared on the landmarks all of them were evaluated on
+    matrix = matrix.dropna(axis=1)
+
+    return matrix.to_numpy(), list(matrix.index), matrix.columns.get_level_values('sample_name').to_numpy()
@@ -0,0 +1,352 @@
+import os
+import re
+import json
+import asyncio
+import statistics
+
+from .elastix import read_parameter_file, parameters_fingerprint
+from .executor import run_command
+from .checkpoint import run_resumable
+
+# bytes per voxel of the elastix internal pixel types
+PIXEL_TYPE_BYTES = {
+    'char': 1, 'unsigned char': 1, 'short': 2, 'unsigned short': 2,
+    'int': 4, 'unsigned int': 4, 'float': 4, 'double': 8,
+}
+
+# memory elastix uses regardless of the images (executable, ITK factories, ...)
+BASE_MEMORY = 150 * 1024 ** 2
+
+# estimated memory per sample (image values, derivatives, jacobian indices) without the transform jacobian
+BYTES_PER_SAMPLE = 64
+
+# the measured peak is kept within this factor of the corrected estimate when admitting jobs
+SAFETY_FACTOR = 1.1
+
+# output directory of a command of create_script.py, .../output_<fixed_name>/<moving_name>, names its registration
+RUN_OUTPUT_PATTERN = re.compile(r'(?:-out|--elastix_output_dir)\s+"[^"]*/output_([^/"]+)/([^/"]+?)/?"')
+
+# marker create_script.py writes before the commands of every subject, REM Processing <moving_path> and <fixed_path>
+PROCESSING_PATTERN = re.compile(r'^REM Processing (\S+) and (\S+)$')
+
+
+def _first(parameters, key, default):
+    return parameters.get(key, [default])[0]
+
+def _max_value(parameters, key, default):
+    return max(parameters.get(key, [default]))
+
+def read_image_size(image_path):
+    '''
+    Read the size of an image from its header, without loading the pixel data.
+
+    Args:
+        image_path ('str'): Path to the image.
+
+    Returns:
+        size ('tuple'): Image size (x, y, z).
+    '''
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    return reader.GetSize()
+
+def estimate_parameter_file_memory(image_size, parameters, use_masks=False):
+    '''
+    Estimate the peak memory of elastix for a single parameter file.
+
+    The model accounts for the fixed and moving images, their pyramids in the internal pixel type
+    (the smoothing pyramids keep every level at full size, the recursive and shrinking ones downsample),
+    the B-spline interpolator coefficients, the masks, the image samples and the transform jacobian.
+
+    Args:
+        image_size ('tuple'): Size of the fixed (and moving) image.
+        parameters ('dict'): Parameters from read_parameter_file.
+        use_masks ('bool'): If the fixed and moving masks are passed to elastix.
+
+    Returns:
+        memory ('dict'): Estimated bytes per component and their total.
+    '''
+    voxels = 1
+    for size in image_size:
+        voxels *= size
+    dimension = len(image_size)
+
+    resolutions = int(_first(parameters, 'NumberOfResolutions', 4))
+    fixed_bytes = PIXEL_TYPE_BYTES.get(_first(parameters, 'FixedInternalImagePixelType', 'float'), 4)
+    moving_bytes = PIXEL_TYPE_BYTES.get(_first(parameters, 'MovingInternalImagePixelType', 'float'), 4)
+
+    # voxels kept by every pyramid, the default schedule halves each dimension per level
+    def pyramid_voxels(pyramid):
+        if 'Smoothing' in pyramid:
+            return voxels * resolutions
+        return sum(voxels / (2 ** dimension) ** level for level in range(resolutions))
+
+    fixed_pyramid = pyramid_voxels(_first(parameters, 'FixedImagePyramid', 'FixedSmoothingImagePyramid')) * fixed_bytes
+    moving_pyramid = pyramid_voxels(_first(parameters, 'MovingImagePyramid', 'MovingSmoothingImagePyramid')) * moving_bytes
+
+    # the input images are read as short
+    inputs = 2 * voxels * 2
+
+    # the B-spline interpolator stores double coefficients of the (full size) moving level
+    interpolator = voxels * 8 if _first(parameters, 'Interpolator', '') == 'BSplineInterpolator' else 0
+
+    masks = 2 * voxels if use_masks else 0
+
+    # samples and their transform jacobian (spline order + 1)^dimension non zero entries per dimension
+    if _first(parameters, 'ImageSampler', 'Random') == 'Full':
+        samples = voxels
+    else:
+        samples = _max_value(parameters, 'NumberOfSpatialSamples', 5000)
+    spline_order = int(_first(parameters, 'BSplineTransformSplineOrder', 3))
+    jacobian_entries = (spline_order + 1) ** dimension * dimension if _first(parameters, 'Transform', '') == 'BSplineTransform' else 12
+    sampling = samples * (BYTES_PER_SAMPLE + jacobian_entries * 8)
+
+    # the result image is resampled at the end when it is written
+    result = voxels * 4 if _first(parameters, 'WriteResultImage', 'true') == 'true' else 0
+
+    memory = {
+        'base': BASE_MEMORY,
+        'inputs': inputs,
+        'pyramids': fixed_pyramid + moving_pyramid,
+        'interpolator': interpolator,
+        'masks': masks,
+        'sampling': sampling,
+        'result': result,
+    }
+    memory['total'] = int(sum(memory.values()))
+    return memory
+
+def estimate_memory(image_size, parameter_files, use_masks=False):
+    '''
+    Estimate the peak memory of an elastix registration, the parameter files run one after the other so
+    the peak is the largest of them.
+
+    Args:
+        image_size ('tuple'): Size of the fixed (and moving) image.
+        parameter_files ('list'): Parameter files passed to elastix.
+        use_masks ('bool'): If the fixed and moving masks are passed to elastix.
+
+    Returns:
+        memory ('int'): Estimated peak memory in bytes, BASE_MEMORY without parameter files (no registration).
+    '''
+    return max((
+        estimate_parameter_file_memory(image_size, read_parameter_file(path), use_masks)['total']
+        for path in parameter_files), default=BASE_MEMORY)
+
+class MemoryHistory:
+    '''
+    Measured peak memory of earlier runs, used to correct the estimates of the model. The correction is the
+    median ratio of measured to estimated memory of the same parameter files, or of all runs if these
+    parameter files were never run.
+    '''
+
+    def __init__(self, history_path=None):
+        '''
+        Args:
+            history_path ('str'): Optional json file the measurements are loaded from and saved to.
+        '''
+        self.history_path = history_path
+        self.ratios = {}
+
+        if history_path and os.path.exists(history_path):
+            with open(history_path, 'r') as json_file:
+                self.ratios = json.load(json_file)
+
+    def correction(self, key):
+        '''
+        Get the correction factor of the estimates of a configuration.
+
+        Args:
+            key ('str'): Configuration key (see job_key).
+
+        Returns:
+            factor ('float'): Median measured/estimated ratio, 1.0 without measurements.
+        '''
+        if self.ratios.get(key):
+            return statistics.median(self.ratios[key])
+
+        all_ratios = [ratio for ratios in self.ratios.values() for ratio in ratios]
+        return statistics.median(all_ratios) if all_ratios else 1.0
+
+    def record(self, key, estimate, measured):
+        '''
+        Record the measured peak memory of a run and save the history.
+
+        Args:
+            key ('str'): Configuration key (see job_key).
+            estimate ('int'): Uncorrected estimate of the model, in bytes.
+            measured ('int'): Measured peak memory, in bytes.
+
+        Returns:
+            None
+        '''
+        if not estimate or not measured:
+            return
+
+        # only the last measurements are kept, so the correction follows changes of the machines
+        self.ratios.setdefault(key, []).append(measured / estimate)
+        self.ratios[key] = self.ratios[key][-20:]
+
+        if self.history_path:
+            tmp_path = f'{self.history_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as json_file:
+                json.dump(self.ratios, json_file)
+            os.replace(tmp_path, self.history_path)
+
+def job_key(parameter_files, use_masks):
+    '''
+    Key of a registration configuration in the memory history.
+
+    Args:
+        parameter_files ('list'): Parameter files passed to elastix.
+        use_masks ('bool'): If the masks are passed to elastix.
+
+    Returns:
+        key ('str'): Configuration key.
+    '''
+    return '+'.join(parameters_fingerprint(path)[:12] for path in parameter_files) + ('+masks' if use_masks else '')
+
+def _run_name(path):
+    return path.replace('\\', '/').split('/')[-1].split('.')[0]
+
+def jobs_from_batch_file(bat_path):
+    '''
+    Read the elastix_transformix.bat file created by create_script.py as a list of jobs, one per subject.
+    The commands are grouped by the output directory they write to (output_<fixed_name>/<moving_name>), so the
+    transformix command of a subject whose registration was reused or restored (a REM line) still gets its own
+    job. The commands of a subject run in the order of the file.
+
+    Args:
+        bat_path ('str'): Path to the .bat file.
+
+    Returns:
+        jobs ('list'): One dict per subject with commands, fixed_path, parameter_files and use_masks. A job
+            without a registration has no parameter files.
+    '''
+    jobs = {}
+
+    def get_job(run):
+        return jobs.setdefault(run, {'commands': [], 'fixed_path': None, 'parameter_files': [], 'use_masks': False})
+
+    with open(bat_path, 'r') as file:
+        for line in file:
+            command = line.strip()
+
+            # the fixed image of the subject, also known when its registration is not run
+            processing_match = PROCESSING_PATTERN.match(command)
+            if processing_match:
+                moving_path, fixed_path = processing_match.groups()
+                get_job((_run_name(fixed_path), _run_name(moving_path)))['fixed_path'] = fixed_path
+                continue
+
+            if not command or command.startswith(('@echo', 'echo ', 'REM ')):
+                continue
+
+            run_match = RUN_OUTPUT_PATTERN.search(command)
+            job = get_job(run_match.groups() if run_match else command)
+            job['commands'].append(command)
+
+            fixed_match = re.search(r'-f\s+"([^"]+)"', command)
+            if fixed_match:
+                job.update({
+                    'fixed_path': fixed_match.group(1),
+                    'parameter_files': re.findall(r'-p\s+"([^"]+)"', command),
+                    'use_masks': '-fMask' in command or '-mMask' in command,
+                })
+
+    return [job for job in jobs.values() if job['commands']]
+
+def default_memory_budget(fraction=0.9):
+    '''
+    Get the default memory budget, a fraction of the memory available on the machine.
+
+    Args:
+        fraction ('float'): Fraction of the available memory.
+
+    Returns:
+        budget ('int'): Memory budget in bytes.
+    '''
+    import psutil
+    return int(psutil.virtual_memory().available * fraction)
+
+async def _run_job(job, log_dir, timeout, resume):
+    results = []
+    for idx, command in enumerate(job['commands']):
+        log_path = os.path.join(log_dir, f"{job['name']}.{idx}.log") if log_dir else None
+        run = run_resumable if resume else run_command
+        result = await run(command, log_path=log_path, timeout=timeout)
+        results.append(result)
+        if result['returncode'] != 0:
+            break
+    return results
+
+def run_scheduled(jobs, memory_budget=None, max_concurrency=os.cpu_count(), history_path=None, timeout=None, log_dir=None, resume=True):
+    '''
+    Run registration jobs concurrently while the sum of their estimated peak memory fits the budget.
+    Whenever a job finishes, the largest pending jobs that fit the freed memory are started. A job larger
+    than the whole budget is only started when nothing else is running.
+
+    Args:
+        jobs ('list'): Jobs from jobs_from_batch_file, with an optional image_size (read from the fixed image otherwise).
+        memory_budget ('int'): Memory budget in bytes, 90% of the available memory by default.
+        max_concurrency ('int'): Maximum number of jobs running at once.
+        history_path ('str'): Optional json file of the measured memory used to correct the estimates.
+        timeout ('float'): Optional time limit in seconds for every command.
+        log_dir ('str'): Optional dir the output of every command is written to.
+        resume ('bool'): If True, the interrupted registrations resume from their checkpoints (see utils.checkpoint).
+
+    Returns:
+        results ('list'): One dict per job with estimate, corrected_estimate and the run_command results.
+    '''
+    memory_budget = memory_budget or default_memory_budget()
+    history = MemoryHistory(history_path)
+
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    for idx, job in enumerate(jobs):
+        job.setdefault('name', f'job{idx:05d}')
+        image_size = job.get('image_size') or (read_image_size(job['fixed_path']) if job['parameter_files'] else None)
+        job['key'] = job_key(job['parameter_files'], job['use_masks'])
+        job['estimate'] = estimate_memory(image_size, job['parameter_files'], job['use_masks'])
+        job['corrected_estimate'] = int(job['estimate'] * history.correction(job['key']) * SAFETY_FACTOR)
+
+    async def main():
+        # largest jobs first, the smaller ones fill the remaining memory
+        pending = sorted(range(len(jobs)), key=lambda idx: jobs[idx]['corrected_estimate'], reverse=True)
+        running, results, used = {}, {}, 0
+
+        while pending or running:
+            for idx in list(pending):
+                if len(running) >= max_concurrency:
+                    break
+                estimate = jobs[idx]['corrected_estimate']
+                if used + estimate <= memory_budget or not running:
+                    pending.remove(idx)
+                    used += estimate
+                    running[asyncio.ensure_future(_run_job(jobs[idx], log_dir, timeout, resume))] = (idx, estimate)
+
+            done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                idx, estimate = running.pop(task)
+                used -= estimate
+                results[idx] = task.result()
+
+                # refine the estimates of the pending jobs with the measured peak of the registration
+                if results[idx] and jobs[idx]['parameter_files']:
+                    history.record(jobs[idx]['key'], jobs[idx]['estimate'], results[idx][0]['peak_memory'])
+                    for pending_idx in pending:
+                        jobs[pending_idx]['corrected_estimate'] = int(
+                            jobs[pending_idx]['estimate'] * history.correction(jobs[pending_idx]['key']) * SAFETY_FACTOR)
+                    pending.sort(key=lambda idx: jobs[idx]['corrected_estimate'], reverse=True)
+
+        return [results[idx] for idx in range(len(jobs))]
+
+    job_results = asyncio.run(main())
+
+    return [
+        {'name': job['name'], 'estimate': job['estimate'], 'corrected_estimate': job['corrected_estimate'], 'results': results}
+        for job, results in zip(jobs, job_results)]
@@ -0,0 +1,127 @@
+import os
+import csv
+import math
+import itertools
+import numpy as np
+
+from .elastix import parse_parameter_text, read_parameter_file, write_parameter_file
+
+
+def parse_grid(entries):
+    '''
+    Parse the searched parameters, given as 'Name=value,value' entries. A value can hold several tokens, e.g.
+    'FinalGridSpacingInPhysicalUnits=10,15 15 10' or 'Metric="AdvancedMattesMutualInformation","AdvancedNormalizedCorrelation"'.
+
+    Args:
+        entries ('list'): Grid entries.
+
+    Returns:
+        grid ('dict'): Parameter name -> list of values, every value is a list of tokens as read_parameter_file returns them.
+    '''
+    grid = {}
+    for entry in entries:
+        name, _, alternatives = entry.partition('=')
+        if not name or not alternatives:
+            raise ValueError(f"Grid entry {entry} is not Name=value,value")
+        grid[name.strip()] = [parse_parameter_text(f'({name.strip()} {alternative.strip()})')[name.strip()] for alternative in alternatives.split(',')]
+    return grid
+
+def expand_grid(grid):
+    '''
+    Every combination of the grid values, named c00, c01, ... in a stable order.
+
+    Args:
+        grid ('dict'): Parameter name -> list of values, see parse_grid.
+
+    Returns:
+        configurations ('dict'): Configuration name -> overrides (parameter name -> values).
+    '''
+    names = list(grid)
+    combinations = list(itertools.product(*[grid[name] for name in names])) if names else [()]
+    width = max(2, len(str(len(combinations) - 1)))
+    return {f'c{idx:0{width}d}': dict(zip(names, values)) for idx, values in enumerate(combinations)}
+
+def rung_fractions(rungs, eta):
+    '''
+    Fraction of the full iteration schedule of every rung, e.g. 3 rungs with eta 3 -> [1/9, 1/3, 1].
+    '''
+    return [float(eta) ** -(rungs - 1 - rung) for rung in range(rungs)]
+
+def promoted_count(count, eta):
+    '''
+    Number of configurations promoted to the next rung, the best 1/eta of them and at least one.
+    '''
+    return max(1, int(math.ceil(count / eta)))
+
+def scale_iterations(values, fraction):
+    '''
+    Scale the MaximumNumberOfIterations of every resolution, at least one iteration per resolution.
+    '''
+    return [max(1, int(round(value * fraction))) for value in values]
+
+def write_variant(base_path, overrides, iterations, output_path):
+    '''
+    Write a variant of a parameter file: the base parameters, the overrides of a configuration and the
+    iterations of a rung.
+
+    Args:
+        base_path ('str'): Base elastix parameter file.
+        overrides ('dict'): Parameter name -> values, see expand_grid.
+        iterations ('list'): MaximumNumberOfIterations of every resolution.
+        output_path ('str'): Path of the variant parameter file.
+
+    Returns:
+        parameters ('dict'): Parameters of the variant.
+    '''
+    parameters = read_parameter_file(base_path)
+    parameters.update(overrides)
+    parameters['MaximumNumberOfIterations'] = list(iterations)
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    write_parameter_file(parameters, output_path)
+    return parameters
+
+def run_iterations(parameters):
+    '''
+    Iterations of a registration with these parameters, over all its resolutions, the cost unit of the search.
+    A single MaximumNumberOfIterations value applies to every resolution.
+    '''
+    values = parameters.get('MaximumNumberOfIterations', [0])
+    resolutions = parameters.get('NumberOfResolutions', [1])[0]
+    return int(sum(values)) if len(values) > 1 else int(values[0]) * int(resolutions)
+
+def read_score(points_dir):
+    '''
+    Mean TRE over the subjects of an evaluated experiment key (TRE_sample_results.csv of evaluate_transformation.py).
+
+    Args:
+        points_dir ('str'): points folder of the experiment key.
+
+    Returns:
+        score ('float'): Mean of the subject TRE means, inf if the key was not evaluated or a subject failed.
+        subjects ('int'): Number of evaluated subjects.
+    '''
+    results_path = os.path.join(points_dir, 'TRE_sample_results.csv')
+    if not os.path.exists(results_path):
+        return np.inf, 0
+
+    with open(results_path, 'r', newline='') as csv_file:
+        values = [float(row['TRE_mean']) for row in csv.DictReader(csv_file)]
+
+    if len(values) == 0 or not np.all(np.isfinite(values)):
+        return np.inf, len(values)
+    return float(np.mean(values)), len(values)
+
+def select_promoted(scores, count):
+    '''
+    Names of the best configurations of a rung, the lowest scores first, ties broken by name.
+
+    Args:
+        scores ('dict'): Configuration name -> score.
+        count ('int'): Number of configurations to promote.
+
+    Returns:
+        promoted ('list'): Names of the promoted configurations.
+    '''
+    ranked = sorted(scores, key=lambda name: (scores[name], name))
+    return [name for name in ranked[:count] if np.isfinite(scores[name])]
@@ -0,0 +1,357 @@
+import io
+import os
+import sys
+import json
+import time
+import runpy
+import socket
+import asyncio
+import threading
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .logger import logger
+
+# default port of the local pipeline service
+SERVICE_PORT = 5050
+
+# modules imported once when the service starts, so the first requests do not pay for them either
+PRELOAD_MODULES = ['numpy', 'SimpleITK', 'scipy.ndimage', 'utils.catalog', 'utils.metrics', 'utils.results', 'utils.landmarks', 'utils.elastix', 'utils.cache']
+
+_local = threading.local()
+
+
+class _ThreadLocalArgv(list):
+    '''
+    sys.argv replacement, every request thread sees its own arguments (argparse reads sys.argv[0] and
+    sys.argv[1:]), the other threads see the arguments of the service.
+    '''
+    def _current(self):
+        return getattr(_local, 'argv', None) or list.__iter__(self)
+
+    def __getitem__(self, index):
+        return list(self._current())[index]
+
+    def __iter__(self):
+        return iter(list(self._current()))
+
+    def __len__(self):
+        return len(list(self._current()))
+
+
+class _ThreadLocalStream(io.TextIOBase):
+    '''
+    sys.stdout/sys.stderr replacement, the output of a request thread is captured in its own buffer, the
+    other threads write to the default stream.
+    '''
+    def __init__(self, default):
+        self.default = default
+
+    def write(self, text):
+        stream = getattr(_local, 'output', None) or self.default
+        return stream.write(text)
+
+    def flush(self):
+        (getattr(_local, 'output', None) or self.default).flush()
+
+
+def install_request_context(default_stream=None):
+    '''
+    Make sys.argv, sys.stdout and sys.stderr per request thread, so several scripts can run at once in the
+    same process. The logger is redirected to the per-request stderr as well.
+
+    Args:
+        default_stream ('io.TextIOBase'): Stream the output of the other threads goes to, sys.stdout by default.
+
+    Returns:
+        None
+    '''
+    from .logger import logger, fmt
+
+    if isinstance(sys.argv, _ThreadLocalArgv):
+        return
+
+    sys.argv = _ThreadLocalArgv(sys.argv)
+    sys.stdout = _ThreadLocalStream(default_stream or sys.stdout)
+    sys.stderr = _ThreadLocalStream(sys.stderr)
+
+    # the sink looks up sys.stderr on every message instead of keeping the stream of the service
+    logger.remove()
+    logger.add(lambda message: sys.stderr.write(message), format=fmt)
+
+def get_scripts(repo_path):
+    '''
+    Get the command line scripts of the repository that can be run by the service.
+
+    Args:
+        repo_path ('str'): Repository root.
+
+    Returns:
+        scripts ('list'): Script file names (e.g. evaluate_transformation.py).
+    '''
+    scripts = []
+    for name in sorted(os.listdir(repo_path)):
+        if name.endswith('.py'):
+            with open(os.path.join(repo_path, name), 'r') as file:
+                if 'argparse' in file.read():
+                    scripts.append(name)
+    return scripts
+
+def run_script(repo_path, script, args=()):
+    '''
+    Run a command line script as a function call in the current process, as `python <script> <args>` would.
+    The modules it imports stay loaded for the next requests.
+
+    Args:
+        repo_path ('str'): Repository root.
+        script ('str'): Script file name (e.g. evaluate_transformation.py).
+        args ('list'): Command line arguments.
+
+    Returns:
+        result ('dict'): returncode and output (stdout and stderr of the script).
+    '''
+    output = io.StringIO()
+    _local.argv, _local.output = [script, *map(str, args)], output
+
+    try:
+        runpy.run_path(os.path.join(repo_path, script), run_name='__main__')
+        returncode = 0
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        if e.code is not None and not isinstance(e.code, int):
+            output.write(f'{e.code}\n')
+    except Exception:
+        returncode = 1
+        output.write(traceback.format_exc())
+    finally:
+        _local.argv, _local.output = None, None
+
+    return {'returncode': returncode, 'output': output.getvalue()}
+
+
+class PipelineService:
+    '''
+    Long running service executing the command line scripts of the repository in a single process, with warm
+    imports and catalogs. Arbitrary shell commands are not accepted, the bat files run on the client side (see
+    utils.monitor.run_batch_file). Requests are json objects, one per line:
+
+    {"id": 1, "script": "evaluate_transformation.py", "args": ["--experiment_name", "..."]}
+    {"id": 2, "op": "status"}
+    {"id": 3, "op": "shutdown"}
+
+    Every response is a json line with the id of its request, the returncode, the output, the time the
+    request waited for a free worker and its run time.
+    '''
+    def __init__(self, repo_path, max_workers=os.cpu_count()):
+        self.repo_path = os.path.abspath(repo_path)
+        self.scripts = get_scripts(self.repo_path)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stopped = asyncio.Event()
+        self.started = time.time()
+        self.stats = {}
+
+    def preload(self, modules=PRELOAD_MODULES):
+        for module in modules:
+            try:
+                __import__(module)
+            except ImportError as e:
+                sys.stderr.write(f"Could not preload {module}: {e}\n")
+
+    def _record(self, name, result):
+        stats = self.stats.setdefault(name, {'requests': 0, 'failed': 0, 'seconds': 0.0})
+        stats['requests'] += 1
+        stats['failed'] += int(result['returncode'] != 0)
+        stats['seconds'] += result['seconds']
+
+    async def handle(self, request):
+        '''
+        Run a single request.
+
+        Args:
+            request ('dict'): Decoded request.
+
+        Returns:
+            response ('dict'): id, returncode, output, wait_seconds and seconds.
+        '''
+        received = time.time()
+        response = {'id': request.get('id')}
+        op = request.get('op', 'script' if 'script' in request else None)
+
+        if op == 'status':
+            return {**response, 'returncode': 0, 'uptime': time.time() - self.started, 'scripts': self.scripts, 'stats': self.stats}
+
+        if op == 'shutdown':
+            self.stopped.set()
+            return {**response, 'returncode': 0}
+
+        if op == 'script':
+            script = os.path.basename(request['script'])
+            if script not in self.scripts:
+                return {**response, 'returncode': 2, 'output': f"Unknown script {request['script']}, available: {self.scripts}\n"}
+
+            loop = asyncio.get_running_loop()
+            started = {}
+
+            def call():
+                started['time'] = time.time()
+                return run_script(self.repo_path, script, request.get('args', []))
+
+            result = await loop.run_in_executor(self.executor, call)
+            result.update({'wait_seconds': started['time'] - received, 'seconds': time.time() - started['time']})
+            self._record(script, result)
+            return {**response, **result}
+
+        return {**response, 'returncode': 2, 'output': f"Unknown request {request}\n"}
+
+    async def _answer(self, line, write):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = {'op': None}
+        response = await self.handle(request)
+        await write(json.dumps(response) + '\n')
+
+    async def serve_stream(self, reader, write):
+        '''
+        Serve the requests of a stream, every request runs as soon as it is read and is answered when it
+        is done, so the responses can come out of order.
+        '''
+        tasks = set()
+        stop = asyncio.ensure_future(self.stopped.wait())
+
+        while True:
+            read = asyncio.ensure_future(reader())
+            await asyncio.wait({read, stop}, return_when=asyncio.FIRST_COMPLETED)
+            if not read.done():
+                read.cancel()
+                break
+
+            line = read.result()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(self._answer(line, write))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        stop.cancel()
+
+    async def serve_socket(self, host='127.0.0.1', port=SERVICE_PORT):
+        '''
+        Serve the requests of local socket connections until a shutdown request.
+        '''
+        connections = set()
+
+        async def connection(reader, writer):
+            connections.add(asyncio.current_task())
+            lock = asyncio.Lock()
+
+            async def write(text):
+                async with lock:
+                    writer.write(text.encode())
+                    await writer.drain()
+
+            try:
+                await self.serve_stream(lambda: reader.readline(), write)
+            finally:
+                writer.close()
+                connections.discard(asyncio.current_task())
+
+        server = await asyncio.start_server(connection, host, port)
+        async with server:
+            await self.stopped.wait()
+            # the running requests of every connection are answered before the service stops
+            if connections:
+                await asyncio.gather(*connections, return_exceptions=True)
+
+    async def serve_stdio(self, output):
+        '''
+        Serve the requests read from stdin, the responses are written to output (the original stdout).
+        '''
+        loop = asyncio.get_running_loop()
+        lock = threading.Lock()
+
+        def write_line(text):
+            with lock:
+                output.write(text)
+                output.flush()
+
+        async def write(text):
+            write_line(text)
+
+        # stdin is read in a daemon thread, a blocking read neither stops the running requests nor the shutdown
+        lines = asyncio.Queue()
+
+        def read_stdin():
+            for line in iter(sys.stdin.readline, ''):
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, '')
+
+        threading.Thread(target=read_stdin, daemon=True).start()
+        await self.serve_stream(lines.get, write)
+
+def send_requests(requests, host='127.0.0.1', port=SERVICE_PORT):
+    '''
+    Send requests to a running pipeline service and wait for all the responses.
+
+    Args:
+        requests ('list'): Request dicts, an id is added to the ones without.
+        host ('str'): Service host.
+        port ('int'): Service port.
+
+    Returns:
+        responses ('list'): Responses, in the order of the requests.
+    '''
+    requests = [{'id': idx, **request} for idx, request in enumerate(requests)]
+
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall(''.join(json.dumps(request) + '\n' for request in requests).encode())
+        responses = {}
+        with connection.makefile('r') as stream:
+            while len(responses) < len(requests):
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError(f"The service closed the connection after {len(responses)}/{len(requests)} responses")
+                response = json.loads(line)
+                responses[response['id']] = response
+
+    return [responses[request['id']] for request in requests]
+
+def run_pipeline_script(script, args=(), port=None, check=False):
+    '''
+    Run a command line script of the repository, in a new interpreter or through a running pipeline service.
+
+    Args:
+        script ('str'): Script path (e.g. create_script.py).
+        args ('list'): Arguments of the script.
+        port ('int'): Port of a running pipeline_service.py, None starts a new interpreter.
+        check ('bool'): If True, raise subprocess.CalledProcessError when the script fails.
+
+    Returns:
+        returncode ('int'): Return code of the script, the failures are logged.
+    '''
+    args = [str(arg) for arg in args]
+
+    if port is None:
+        # the output is copied line by line to sys.stdout: inside the service it is the buffer of the request (see
+        # install_request_context), the child never writes to the file descriptors of the service
+        process = subprocess.Popen([sys.executable, script, *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, errors='replace', env={**os.environ, 'PYTHONUNBUFFERED': '1'})
+        for line in process.stdout:
+            sys.stdout.write(line)
+        returncode = process.wait()
+    else:
+        response = send_requests([{'script': script, 'args': args}], port=port)[0]
+        print(response['output'], end='')
+        returncode = response['returncode']
+        logger.info(f"{script} finished with code {returncode} in {response.get('seconds', 0.0):.2f}s")
+
+    if returncode != 0:
+        logger.error(f"{script} failed with code {returncode} ({' '.join(args)})")
+        if check:
+            raise subprocess.CalledProcessError(returncode, [script, *args])
+
+    return returncode
@@ -0,0 +1,164 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# distance bins (mm) to the lung boundary the errors are stratified by, negative distances are outside the mask
+BOUNDARY_BINS = [-np.inf, 0, 5, 10, 20, 40, np.inf]
+
+
+def landmarks_to_physical(landmarks, voxel_dim):
+    '''
+    Convert landmark voxel indices to physical coordinates (mm), the distances between landmarks are
+    then euclidean distances.
+
+    Args:
+        landmarks ('np.array'): Landmark voxel indices (N, 3), x y z.
+        voxel_dim ('tuple'): Voxel size (mm) from description.json.
+
+    Returns:
+        points ('np.array'): Physical coordinates (N, 3).
+    '''
+    return np.asarray(landmarks, dtype=np.float64) * np.asarray(voxel_dim, dtype=np.float64)
+
+def local_mean_error(points, errors, radius, tree=None):
+    '''
+    Mean error of the landmarks within a radius of every landmark (itself included).
+
+    Args:
+        points ('np.array'): Physical coordinates (N, 3).
+        errors ('np.array'): Error of every landmark (N,).
+        radius ('float'): Neighbourhood radius in mm.
+        tree ('cKDTree'): Optional KD-tree of the points, built if not given.
+
+    Returns:
+        local_error ('np.array'): Mean error of the neighbourhood of every landmark (N,).
+        neighbours ('np.array'): Number of landmarks in the neighbourhood of every landmark (N,).
+    '''
+    tree = tree or cKDTree(points)
+    errors = np.asarray(errors, dtype=np.float64)
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+
+    # every pair counts for both of its landmarks
+    sums = errors + np.bincount(pairs[:, 0], weights=errors[pairs[:, 1]], minlength=len(errors)) \
+                  + np.bincount(pairs[:, 1], weights=errors[pairs[:, 0]], minlength=len(errors))
+    neighbours = 1 + np.bincount(pairs.ravel(), minlength=len(errors))
+
+    return sums / neighbours, neighbours
+
+def find_error_clusters(points, errors, radius, threshold=None, min_size=3, tree=None):
+    '''
+    Find spatial clusters of high errors, the connected groups of landmarks whose error is above a threshold
+    and that are within a radius of each other.
+
+    Args:
+        points ('np.array'): Physical coordinates (N, 3).
+        errors ('np.array'): Error of every landmark (N,).
+        radius ('float'): Linking distance in mm.
+        threshold ('float'): Error threshold (mm), the 90th percentile of the errors by default.
+        min_size ('int'): Minimum number of landmarks of a cluster.
+        tree ('cKDTree'): Optional KD-tree of the points, built if not given.
+
+    Returns:
+        labels ('np.array'): Cluster of every landmark (N,), -1 for the landmarks outside the clusters.
+        clusters ('list'): One dict per cluster with size, mean_error, max_error and centroid, the largest first.
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    tree = tree or cKDTree(points)
+    errors = np.asarray(errors, dtype=np.float64)
+    threshold = np.percentile(errors, 90) if threshold is None else threshold
+    high = errors >= threshold
+
+    # the edges between two high error landmarks within the radius
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    pairs = pairs[high[pairs[:, 0]] & high[pairs[:, 1]]]
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(points), len(points)))
+    _, components = connected_components(graph, directed=False)
+
+    sizes = np.bincount(components[high], minlength=components.max() + 1)
+    kept = [component for component in np.argsort(-sizes, kind='stable') if sizes[component] >= min_size]
+
+    labels = np.full(len(points), -1)
+    clusters = []
+    for label, component in enumerate(kept):
+        members = high & (components == component)
+        labels[members] = label
+        clusters.append({
+            'size': int(members.sum()),
+            'mean_error': float(errors[members].mean()),
+            'max_error': float(errors[members].max()),
+            'centroid': points[members].mean(axis=0).tolist(),
+        })
+
+    return labels, clusters
+
+def build_boundary_tree(mask, voxel_dim):
+    '''
+    Build a KD-tree over the boundary voxels of a lung mask, in physical coordinates.
+
+    Args:
+        mask ('np.array'): Lung mask (z, y, x), any non zero voxel is inside.
+        voxel_dim ('tuple'): Voxel size (mm) x y z.
+
+    Returns:
+        tree ('cKDTree'): KD-tree of the boundary voxels (x, y, z, in mm).
+        mask ('np.array'): Binary mask (z, y, x).
+    '''
+    from scipy.ndimage import binary_erosion
+
+    mask = np.asarray(mask) > 0
+    boundary = mask & ~binary_erosion(mask, border_value=0)
+    z, y, x = np.nonzero(boundary)
+    return cKDTree(landmarks_to_physical(np.stack([x, y, z], axis=1), voxel_dim)), mask
+
+def boundary_distance(landmarks, voxel_dim, boundary_tree, mask, index_base=1):
+    '''
+    Signed distance of every landmark to the lung boundary, positive inside the lungs.
+
+    Args:
+        landmarks ('np.array'): Landmark voxel indices (N, 3), x y z.
+        voxel_dim ('tuple'): Voxel size (mm) x y z.
+        boundary_tree ('cKDTree'): KD-tree from build_boundary_tree.
+        mask ('np.array'): Binary mask from build_boundary_tree.
+        index_base ('int'): Base of the landmark indices, 1 for the DIR-Lab files (see SubjectRecord.index_base).
+
+    Returns:
+        distances ('np.array'): Signed distances in mm (N,).
+    '''
+    # to the 0-based mask indexing, as in visualize_landmarks
+    index = np.rint(np.asarray(landmarks)).astype(np.int64) - index_base
+    distances, _ = boundary_tree.query(landmarks_to_physical(index, voxel_dim))
+
+    shape = np.array(mask.shape[::-1])
+    valid = np.all((index >= 0) & (index < shape), axis=1)
+    inside = np.zeros(len(index), dtype=bool)
+    inside[valid] = mask[index[valid, 2], index[valid, 1], index[valid, 0]]
+
+    return np.where(inside, distances, -distances)
+
+def stratify_errors(values, errors, bins):
+    '''
+    Summarize the errors per bin of another per-landmark value (e.g. the distance to the lung boundary).
+
+    Args:
+        values ('np.array'): Value the landmarks are binned by (N,).
+        errors ('np.array'): Error of every landmark (N,).
+        bins ('list'): Bin edges.
+
+    Returns:
+        strata ('dict'): Columns bin_low, bin_high, count, mean_error, median_error and p95_error.
+    '''
+    errors = np.asarray(errors, dtype=np.float64)
+    bin_index = np.digitize(values, bins[1:-1])
+
+    strata = {name: [] for name in ['bin_low', 'bin_high', 'count', 'mean_error', 'median_error', 'p95_error']}
+    for idx in range(len(bins) - 1):
+        selected = errors[bin_index == idx]
+        strata['bin_low'].append(bins[idx])
+        strata['bin_high'].append(bins[idx + 1])
+        strata['count'].append(len(selected))
+        strata['mean_error'].append(selected.mean() if len(selected) else np.nan)
+        strata['median_error'].append(np.median(selected) if len(selected) else np.nan)
+        strata['p95_error'].append(np.percentile(selected, 95) if len(selected) else np.nan)
+
+    return {name: np.array(values) for name, values in strata.items()}
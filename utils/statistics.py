@@ -0,0 +1,154 @@
+import numpy as np
+
+# number of resamples (or permutations) evaluated at once, bounds the memory of the weight matrices
+CHUNK_SIZE = 1000
+
+
+def resample_weights(n_items, n_resamples, groups=None, seed=None):
+    '''
+    Draw all the bootstrap resamples at once as a single index matrix, returned as per item weights (how
+    many times every item was drawn, over the number of draws), so the resampled means of any number of
+    configurations are one matrix product.
+
+    Args:
+        n_items ('int'): Number of items (e.g. landmarks).
+        n_resamples ('int'): Number of bootstrap resamples.
+        groups ('np.array'): Optional group (e.g. subject) of every item. The groups are resampled instead of
+            the items, which keeps the correlation of the landmarks of a subject.
+        seed ('int'): Optional random seed.
+
+    Returns:
+        weights ('np.array'): Weights (n_resamples, n_items), every row sums to 1.
+    '''
+    rng = np.random.default_rng(seed)
+
+    def draw_counts(n):
+        # the index matrix, counted per row with a single bincount
+        indices = rng.integers(0, n, size=(n_resamples, n)) + np.arange(n_resamples)[:, None] * n
+        return np.bincount(indices.ravel(), minlength=n_resamples * n).reshape(n_resamples, n).astype(np.float64)
+
+    if groups is None:
+        counts = draw_counts(n_items)
+    else:
+        group_ids, inverse = np.unique(groups, return_inverse=True)
+        counts = draw_counts(len(group_ids))[:, inverse.ravel()]
+
+    return counts / counts.sum(axis=1, keepdims=True)
+
+def bootstrap_ci(tre, n_resamples=2000, confidence=0.95, groups=None, seed=None):
+    '''
+    Bootstrap percentile confidence intervals of the mean TRE of many configurations. The same resamples
+    are used for all the configurations, as they are evaluated on the same landmarks.
+
+    Args:
+        tre ('np.array'): TRE (n_configurations, n_landmarks), the same landmarks in every row.
+        n_resamples ('int'): Number of bootstrap resamples.
+        confidence ('float'): Confidence level of the intervals.
+        groups ('np.array'): Optional subject of every landmark, to resample the subjects (see resample_weights).
+        seed ('int'): Optional random seed.
+
+    Returns:
+        ci ('dict'): mean, ci_low and ci_high arrays (n_configurations,).
+    '''
+    tre = np.atleast_2d(np.asarray(tre, dtype=np.float64))
+    alpha = (1 - confidence) / 2
+
+    means = np.empty((len(tre), n_resamples))
+    for start in range(0, n_resamples, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, n_resamples)
+        weights = resample_weights(tre.shape[1], stop - start, groups=groups, seed=None if seed is None else seed + start)
+        means[:, start:stop] = tre @ weights.T
+
+    low, high = np.quantile(means, [alpha, 1 - alpha], axis=1)
+    return {'mean': tre.mean(axis=1), 'ci_low': low, 'ci_high': high}
+
+def paired_permutation_test(differences, n_permutations=10000, seed=None):
+    '''
+    Two-sided paired permutation (sign flip) tests of the mean of paired TRE differences, for many pairs of
+    configurations at once. Under the null hypothesis the sign of every paired difference is random, all
+    the sign flips are drawn as one matrix shared by all the pairs.
+
+    Args:
+        differences ('np.array'): Paired differences (n_pairs, n_landmarks), e.g. tre[a] - tre[b].
+        n_permutations ('int'): Number of random sign flips.
+        seed ('int'): Optional random seed.
+
+    Returns:
+        p_values ('np.array'): Two-sided p-values (n_pairs,).
+    '''
+    differences = np.atleast_2d(np.asarray(differences, dtype=np.float64))
+    n_landmarks = differences.shape[1]
+    observed = np.abs(differences.mean(axis=1))
+
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(len(differences))
+
+    for start in range(0, n_permutations, CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, n_permutations)
+        signs = rng.integers(0, 2, size=(stop - start, n_landmarks)) * 2.0 - 1.0
+        permuted = np.abs(differences @ signs.T) / n_landmarks
+        # the tolerance keeps the ties of the identity-like flips with the observed value
+        exceed += (permuted >= observed[:, None] - 1e-12).sum(axis=1)
+
+    return (exceed + 1) / (n_permutations + 1)
+
+def holm_correction(p_values):
+    '''
+    Holm-Bonferroni adjustment of p-values for multiple comparisons.
+
+    Args:
+        p_values ('np.array'): Unadjusted p-values.
+
+    Returns:
+        adjusted ('np.array'): Adjusted p-values, in the order of the inputs.
+    '''
+    p_values = np.asarray(p_values, dtype=np.float64)
+    order = np.argsort(p_values)
+    scaled = p_values[order] * (len(p_values) - np.arange(len(p_values)))
+    adjusted = np.empty_like(p_values)
+    adjusted[order] = np.minimum(np.maximum.accumulate(scaled), 1.0)
+    return adjusted
+
+def compare_configurations(tre, names, reference=None, n_resamples=2000, n_permutations=10000, confidence=0.95, groups=None, seed=None):
+    '''
+    Compare many configurations with a reference configuration on the same landmarks: bootstrap confidence
+    intervals of every mean TRE, and paired permutation tests of every configuration against the reference.
+
+    Args:
+        tre ('np.array'): TRE (n_configurations, n_landmarks), the same landmarks in every row.
+        names ('list'): Name of every configuration.
+        reference ('str'): Reference configuration, the one with the lowest mean TRE by default.
+        n_resamples ('int'): Number of bootstrap resamples.
+        n_permutations ('int'): Number of random sign flips of the permutation tests.
+        confidence ('float'): Confidence level of the intervals.
+        groups ('np.array'): Optional subject of every landmark, to resample the subjects.
+        seed ('int'): Optional random seed.
+
+    Returns:
+        comparison ('dict'): Columns name, mean, ci_low, ci_high, difference (mean paired difference to the
+            reference), p_value and p_value_holm, sorted by mean TRE.
+    '''
+    tre = np.atleast_2d(np.asarray(tre, dtype=np.float64))
+    names = np.asarray(names)
+
+    ci = bootstrap_ci(tre, n_resamples=n_resamples, confidence=confidence, groups=groups, seed=seed)
+    reference_idx = int(np.argmin(ci['mean'])) if reference is None else int(np.flatnonzero(names == reference)[0])
+
+    differences = tre - tre[reference_idx]
+    p_values = paired_permutation_test(differences, n_permutations=n_permutations, seed=seed)
+    p_values[reference_idx] = 1.0
+
+    others = np.arange(len(tre)) != reference_idx
+    p_values_holm = np.ones(len(tre))
+    p_values_holm[others] = holm_correction(p_values[others])
+
+    order = np.argsort(ci['mean'], kind='stable')
+    return {
+        'name': names[order],
+        'mean': ci['mean'][order],
+        'ci_low': ci['ci_low'][order],
+        'ci_high': ci['ci_high'][order],
+        'difference': differences.mean(axis=1)[order],
+        'p_value': p_values[order],
+        'p_value_holm': p_values_holm[order],
+    }
@@ -0,0 +1,520 @@
+import io
+import os
+import re
+import json
+import time
+import shutil
+import socket
+import hashlib
+import zipfile
+import threading
+import contextlib
+
+# content addressed store shared by all the experiments of an output tree, <output_path>/.store
+STORE_DIRNAME = '.store'
+OBJECTS_FILENAME = 'objects.json'
+
+# held while the packs and objects.json are updated, <output_path>/.store/store.lock
+LOCK_FILENAME = 'store.lock'
+
+# a lock not refreshed for this many seconds belongs to a crashed compaction
+LOCK_TIMEOUT = 600
+
+# index of the compacted runs of an experiment key, <output_path>/<experiment>/<key>/outputs.index.json
+INDEX_FILENAME = 'outputs.index.json'
+
+# a new pack is started once the current one is larger than this
+PACK_SIZE = 1024 * 2 ** 20
+
+# the run directories, <key>/<kind>/output_<fixed>/<moving>/<file>, as create_script.py writes them
+RUN_KINDS = ('images', 'points', 'labels')
+
+# files dropped from the run directories when they are compacted, elastix.log, the final TransformParameters
+# files and the points are always kept
+PRUNE_POLICIES = {
+    'keep': [],
+    # per resolution transforms and result images (WriteTransformParametersEachResolution, WriteResultImageAfterEachResolution)
+    'default': [r'^TransformParameters\.\d+\.R\d+\.txt$', r'^result\.\d+\.R\d+\.'],
+    # also the iteration logs (used by analyze_logs.py) and every result image
+    'minimal': [r'^TransformParameters\.\d+\.R\d+\.txt$', r'^result\.', r'^IterationInfo\.'],
+}
+
+# already compressed files are stored as they are
+STORED_EXTENSIONS = ('.gz', '.zip', '.png', '.jpg')
+
+# files still being written (atomic writes), never compacted
+TMP_PATTERN = re.compile(r'\.tmp(\.|$)')
+
+_INDEXES = {}
+_PACKS = {}
+_lock = threading.Lock()
+
+
+def _split_run_path(path):
+    # <key_dir>, <kind>/output_<fixed>/<moving>/<file> of a run file path, (None, None) otherwise
+    parts = os.path.abspath(path).replace('\\', '/').split('/')
+    if len(parts) < 5 or parts[-4] not in RUN_KINDS or not parts[-3].startswith('output_'):
+        return None, None
+    return '/'.join(parts[:-4]), '/'.join(parts[-4:])
+
+def load_index(key_dir):
+    '''
+    Load the index of the compacted runs of an experiment key, cached by modification time.
+
+    Args:
+        key_dir ('str'): Experiment key directory (<output_path>/<experiment>/<key>).
+
+    Returns:
+        index ('dict'): store (path of the store relative to key_dir), files (relative path -> sha256, size,
+            mtime_ns) and pruned (relative paths), empty if the key is not compacted.
+    '''
+    index_path = os.path.join(key_dir, INDEX_FILENAME)
+    try:
+        mtime_ns = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    cached = _INDEXES.get(os.path.abspath(index_path))
+    if cached is None or cached[0] != mtime_ns:
+        with open(index_path, 'r') as json_file:
+            cached = (mtime_ns, json.load(json_file))
+        _INDEXES[os.path.abspath(index_path)] = cached
+    return cached[1]
+
+def _save_json(path, content):
+    # written atomically, the directory mtime changes so the catalog scans see the update
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(content, json_file, indent=4)
+    os.replace(tmp_path, path)
+
+def _find_entry(path):
+    key_dir, relative = _split_run_path(path)
+    if key_dir is None:
+        return None, None
+    index = load_index(key_dir)
+    entry = index.get('files', {}).get(relative)
+    return (os.path.normpath(os.path.join(key_dir, index['store'])), entry) if entry else (None, None)
+
+def _pack_reader(pack_path):
+    with _lock:
+        mtime_ns = os.stat(pack_path).st_mtime_ns
+        cached = _PACKS.get(pack_path)
+        if cached is None or cached[0] != mtime_ns:
+            _close_pack(pack_path)
+            cached = (mtime_ns, zipfile.ZipFile(pack_path, 'r'))
+            _PACKS[pack_path] = cached
+        return cached[1]
+
+def _close_pack(pack_path):
+    # called with _lock held, the members already opened stay readable (the file is shared until they are closed)
+    cached = _PACKS.pop(pack_path, None)
+    if cached is not None:
+        cached[1].close()
+
+@contextlib.contextmanager
+def _store_lock(store_dir, poll=0.5):
+    '''
+    Hold the lock of a store while its packs and objects.json are read, updated and written, so concurrent
+    compactions (and gc_store) never append to the same pack or lose each other's objects. The lock is a file
+    created exclusively, the holder refreshes it with os.utime and a lock older than LOCK_TIMEOUT is removed.
+
+    Args:
+        store_dir ('str'): Store directory.
+        poll ('float'): Seconds between two attempts.
+
+    Returns:
+        lock_path ('str'): Path of the lock file, to refresh during long updates.
+    '''
+    lock_path = os.path.join(store_dir, LOCK_FILENAME)
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll)
+
+    try:
+        os.write(fd, f'{socket.gethostname()} {os.getpid()}'.encode())
+        os.close(fd)
+        yield lock_path
+    finally:
+        os.remove(lock_path)
+
+def _load_objects(store_dir):
+    objects_path = os.path.join(store_dir, OBJECTS_FILENAME)
+    if not os.path.exists(objects_path):
+        return {}
+    with open(objects_path, 'r') as json_file:
+        return json.load(json_file)
+
+def output_exists(path):
+    '''
+    os.path.exists for the outputs, True for the files of compacted runs as well.
+    '''
+    return os.path.exists(path) or _find_entry(path)[1] is not None
+
+def output_signature(path):
+    '''
+    Size, modification time and sha256 (None for loose files) of an output file, loose or compacted.
+
+    Args:
+        path ('str'): Path of the output file, as it was before the compaction.
+
+    Returns:
+        signature ('dict'): size, mtime_ns and sha256.
+    '''
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': None}
+
+    _, entry = _find_entry(path)
+    if entry is None:
+        raise FileNotFoundError(f"Output file {path} not found")
+    return {'size': entry['size'], 'mtime_ns': entry['mtime_ns'], 'sha256': entry['sha256']}
+
+def open_output(path, mode='r', **kwargs):
+    '''
+    open() for the outputs: loose files are opened from the disk, the files of compacted runs are read from
+    their pack (random access, only the file itself is decompressed). Loose files take precedence, so the
+    files written after the compaction (e.g. the evaluation outputs) are read as usual.
+
+    Args:
+        path ('str'): Path of the output file, as it was before the compaction.
+        mode ('str'): 'r' or 'rb', the compacted files can only be read.
+        kwargs: encoding and errors of the text mode.
+
+    Returns:
+        file ('io.IOBase'): Opened file.
+    '''
+    if os.path.exists(path) or mode not in ('r', 'rb'):
+        return open(path, mode, **kwargs)
+
+    store_dir, entry = _find_entry(path)
+    if entry is None:
+        raise FileNotFoundError(f"Output file {path} not found")
+
+    objects = _load_objects(store_dir)
+    member = _pack_reader(os.path.join(store_dir, objects[entry['sha256']])).open(entry['sha256'])
+    if mode == 'rb':
+        return member
+    return io.TextIOWrapper(member, encoding=kwargs.get('encoding') or 'utf-8', errors=kwargs.get('errors'))
+
+def materialize(path, directory=None):
+    '''
+    Extract a compacted output file back to its path (with its modification time), for the tools that read
+    it from the disk (elastix -t0, SimpleITK). Loose files are left as they are.
+
+    Args:
+        path ('str'): Path of the output file.
+        directory ('str'): Optional scratch directory the file is extracted to instead, the run stays compacted.
+
+    Returns:
+        path ('str'): Path of the file on the disk.
+    '''
+    if os.path.exists(path):
+        return path
+
+    original_path = path
+    signature = output_signature(path)
+    if directory is not None:
+        # named by content, the extension is kept for the readers that need it (.nii.gz)
+        name = os.path.basename(path)
+        path = os.path.join(directory, f"{signature['sha256'][:16]}.{name.split('.', 1)[1] if '.' in name else 'bin'}")
+        if os.path.exists(path):
+            return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open_output(original_path, 'rb') as source, open(tmp_path, 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+    os.replace(tmp_path, path)
+    os.utime(path, ns=(signature['mtime_ns'], signature['mtime_ns']))
+    return path
+
+def materialize_transform(transform_path):
+    '''
+    Extract an elastix TransformParameters file and the chain of its initial transforms, elastix reads them
+    from the disk.
+
+    Args:
+        transform_path ('str'): Path to the TransformParameters file.
+
+    Returns:
+        transform_path ('str'): The same path.
+    '''
+    from .elastix import read_parameter_file
+
+    path = transform_path
+    while path and path != 'NoInitialTransform':
+        # the initial transforms are usually relative to the directory elastix ran from, as in utils.warp
+        if not output_exists(path):
+            path = os.path.join(os.path.dirname(transform_path), os.path.basename(path))
+        materialize(path)
+        path = read_parameter_file(path).get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+
+    return transform_path
+
+def expand_compacted(root, relatives):
+    '''
+    Add the files of the compacted runs to the relative paths of a scanned output tree (see scan_tree), so
+    the catalog and the log analysis see them where they were.
+
+    Args:
+        root ('str'): Scanned directory.
+        relatives ('list'): Relative file paths found by the scan.
+
+    Returns:
+        relatives ('list'): The loose files and the compacted ones, a loose file hides its compacted version.
+    '''
+    relatives = list(relatives)
+    loose = set(relatives)
+
+    for relative in list(relatives):
+        if relative.split('/')[-1] != INDEX_FILENAME:
+            continue
+        key_relative = relative[:-len(INDEX_FILENAME)].rstrip('/')
+        for member in load_index(os.path.join(root, key_relative)).get('files', {}):
+            member_relative = f'{key_relative}/{member}' if key_relative else member
+            if member_relative not in loose:
+                relatives.append(member_relative)
+
+    return relatives
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _referenced_transforms(key_dir, relatives):
+    # names of the transforms the TransformParameters files of a run start from
+    from .elastix import read_parameter_file
+
+    referenced = set()
+    for relative in relatives:
+        if relative.split('/')[-1].startswith('TransformParameters.'):
+            initial = read_parameter_file(os.path.join(key_dir, relative)).get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+            referenced.add(os.path.basename(str(initial).replace('\\', '/')))
+    return referenced
+
+def _is_finished(key_dir, kind, fixed_dir, moving):
+    '''
+    Check that the outputs of a run directory are complete. The registration is finished once elastix wrote its
+    total time, or when it has no elastix.log (cache restores, reused runs). The points and labels follow the
+    registration and are finished once transformix logged its end, transformix creates its log before writing
+    any output. Without transformix.log they come from a cache restore or were written atomically in-process.
+    '''
+    from .elastix_logs import parse_elastix_log
+    import numpy as np
+
+    log_path = os.path.join(key_dir, 'images', fixed_dir, moving, 'elastix.log')
+    if os.path.exists(log_path) and np.isnan(parse_elastix_log(log_path)['total_time']):
+        return False
+    if kind == 'images':
+        return True
+
+    log_path = os.path.join(key_dir, kind, fixed_dir, moving, 'transformix.log')
+    if not os.path.exists(log_path):
+        return True
+    with open(log_path, 'r', errors='replace') as log_file:
+        return any(line.startswith('transformix has finished') for line in log_file)
+
+def compact_key(key_dir, output_path, policy='default', pack_size=PACK_SIZE, dry_run=False):
+    '''
+    Compact the finished runs of an experiment key: their files are pruned by policy, stored once (by
+    content) in the packs of the output tree store and removed from the disk. The runs can still be read
+    with open_output and listed with expand_compacted.
+
+    Args:
+        key_dir ('str'): Experiment key directory (<output_path>/<experiment>/<key>).
+        output_path ('str'): Root of the output tree, the store is <output_path>/.store.
+        policy ('str'): Key of PRUNE_POLICIES.
+        pack_size ('int'): Size (bytes) after which a new pack is started.
+        dry_run ('bool'): Only compute the statistics.
+
+    Returns:
+        stats ('dict'): runs, files, pruned, deduplicated, bytes (loose bytes before), stored_bytes (new bytes
+            in the packs, compressed).
+    '''
+    prune = [re.compile(pattern) for pattern in PRUNE_POLICIES[policy]]
+    store_dir = os.path.join(output_path, STORE_DIRNAME)
+    stats = {'runs': 0, 'files': 0, 'pruned': 0, 'deduplicated': 0, 'bytes': 0, 'stored_bytes': 0}
+
+    # the files of every finished run, the points and labels of a run follow its images
+    run_files = {}
+    for kind in RUN_KINDS:
+        kind_dir = os.path.join(key_dir, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for fixed_dir in sorted(os.listdir(kind_dir)):
+            if not fixed_dir.startswith('output_') or not os.path.isdir(os.path.join(kind_dir, fixed_dir)):
+                continue
+            for moving in sorted(os.listdir(os.path.join(kind_dir, fixed_dir))):
+                run_dir = os.path.join(kind_dir, fixed_dir, moving)
+                if not os.path.isdir(run_dir) or not _is_finished(key_dir, kind, fixed_dir, moving):
+                    continue
+                names = [name for name in sorted(os.listdir(run_dir)) if os.path.isfile(os.path.join(run_dir, name)) and not TMP_PATTERN.search(name)]
+                if names:
+                    run_files.setdefault((fixed_dir, moving), []).extend(f'{kind}/{fixed_dir}/{moving}/{name}' for name in names)
+
+    if not run_files:
+        return stats
+
+    if not dry_run:
+        os.makedirs(store_dir, exist_ok=True)
+
+    # the store is read and written by one compaction at a time, a dry run only reads it
+    with _store_lock(store_dir) if not dry_run else contextlib.nullcontext() as lock_path:
+        objects = _load_objects(store_dir)
+        index = load_index(key_dir) or {'store': os.path.relpath(store_dir, key_dir).replace('\\', '/'), 'files': {}, 'pruned': []}
+        index = {'store': index['store'], 'files': dict(index['files']), 'pruned': list(index['pruned'])}
+
+        packs = sorted(name for name in os.listdir(store_dir) if name.startswith('pack-') and name.endswith('.zip')) if os.path.isdir(store_dir) else []
+        pack_name = packs[-1] if packs else 'pack-0000.zip'
+        pack = None
+        removed = []
+
+        try:
+            for relatives in run_files.values():
+                stats['runs'] += 1
+                if lock_path:
+                    os.utime(lock_path)
+
+                # the per resolution transforms of resumed runs (see utils.checkpoint) are part of their transform chains
+                referenced = _referenced_transforms(key_dir, relatives)
+
+                for relative in relatives:
+                    path = os.path.join(key_dir, relative)
+                    stat = os.stat(path)
+                    stats['files'] += 1
+                    stats['bytes'] += stat.st_size
+                    removed.append(path)
+
+                    name = relative.split('/')[-1]
+                    if name not in referenced and any(pattern.match(name) for pattern in prune):
+                        stats['pruned'] += 1
+                        index['pruned'].append(relative)
+                        index['files'].pop(relative, None)
+                        continue
+
+                    sha256 = _file_sha256(path)
+                    index['files'][relative] = {'sha256': sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+                    if sha256 in objects:
+                        stats['deduplicated'] += 1
+                        continue
+                    if dry_run:
+                        objects[sha256] = pack_name
+                        continue
+
+                    # a new pack once the current one is full
+                    if pack is not None and pack.fp.tell() > pack_size:
+                        pack.close()
+                        pack = None
+                        pack_name = f'pack-{int(pack_name[5:9]) + 1:04d}.zip'
+                    if pack is None:
+                        pack = zipfile.ZipFile(os.path.join(store_dir, pack_name), 'a')
+
+                    compression = zipfile.ZIP_STORED if relative.endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+                    before = pack.fp.tell()
+                    pack.write(path, arcname=sha256, compress_type=compression)
+                    stats['stored_bytes'] += pack.fp.tell() - before
+                    objects[sha256] = pack_name
+        finally:
+            if pack is not None:
+                pack.close()
+
+        if dry_run:
+            return stats
+
+        # the packs, then the objects, then the index, the loose files are removed last
+        _save_json(os.path.join(store_dir, OBJECTS_FILENAME), objects)
+        index['pruned'] = sorted(set(index['pruned']))
+        _save_json(os.path.join(key_dir, INDEX_FILENAME), index)
+
+    for path in removed:
+        os.remove(path)
+    for kind in RUN_KINDS:
+        for root, _, _ in sorted(os.walk(os.path.join(key_dir, kind)), reverse=True):
+            if root != os.path.join(key_dir, kind) and not os.listdir(root):
+                os.rmdir(root)
+
+    return stats
+
+def restore_key(key_dir):
+    '''
+    Extract the compacted runs of an experiment key back to the disk and remove its index. The blobs stay in
+    the store until gc_store.
+
+    Args:
+        key_dir ('str'): Experiment key directory.
+
+    Returns:
+        count ('int'): Number of files restored.
+    '''
+    index = load_index(key_dir)
+    for relative in index.get('files', {}):
+        materialize(os.path.join(key_dir, relative))
+
+    if index:
+        os.remove(os.path.join(key_dir, INDEX_FILENAME))
+    return len(index.get('files', {}))
+
+def gc_store(output_path):
+    '''
+    Remove the blobs no index of the output tree refers to anymore, the packs holding them are rewritten.
+
+    Args:
+        output_path ('str'): Root of the output tree.
+
+    Returns:
+        removed ('int'): Number of blobs removed.
+    '''
+    store_dir = os.path.join(output_path, STORE_DIRNAME)
+    if not os.path.isdir(store_dir):
+        return 0
+
+    # the indexes are read under the store lock, no compaction adds objects meanwhile
+    with _store_lock(store_dir):
+        referenced = set()
+        for root, directories, files in os.walk(output_path):
+            directories[:] = [directory for directory in directories if directory != STORE_DIRNAME]
+            if INDEX_FILENAME in files:
+                referenced.update(entry['sha256'] for entry in load_index(root).get('files', {}).values())
+
+        objects = _load_objects(store_dir)
+        removed = 0
+        for pack_name in sorted(set(objects.values())):
+            pack_path = os.path.join(store_dir, pack_name)
+            with zipfile.ZipFile(pack_path, 'r') as pack:
+                members = pack.infolist()
+                if all(member.filename in referenced for member in members):
+                    continue
+
+                tmp_path = f'{pack_path}.{os.getpid()}.tmp'
+                with zipfile.ZipFile(tmp_path, 'w') as new_pack:
+                    for member in members:
+                        if member.filename in referenced:
+                            new_pack.writestr(member, pack.read(member.filename))
+                        else:
+                            objects.pop(member.filename, None)
+                            removed += 1
+
+            with _lock:
+                _close_pack(pack_path)
+            if any(member.filename in referenced for member in members):
+                os.replace(tmp_path, pack_path)
+            else:
+                os.remove(tmp_path)
+                os.remove(pack_path)
+
+        _save_json(os.path.join(store_dir, OBJECTS_FILENAME), objects)
+
+    return removed
@@ -0,0 +1,168 @@
+import numpy as np
+
+from .prealign import index_to_physical, physical_to_index
+
+
+def make_phantom(size=(128, 128, 64), spacing=(2.5, 2.5, 5.0), seed=0):
+    '''
+    Chest CT phantom with the intensities of the dataset volumes: air around the body, soft tissue, two lungs
+    and bright vessel like blobs inside the lungs, so the registrations have texture to align.
+
+    Args:
+        size ('tuple'): Volume size (x, y, z).
+        spacing ('tuple'): Voxel size (x, y, z), in mm.
+        seed ('int'): Seed of the vessels.
+
+    Returns:
+        volume ('sitk.Image'): Phantom volume, int16.
+        mask ('sitk.Image'): Lung mask, uint8.
+    '''
+    import SimpleITK as sitk
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, count) for count in size[::-1]], indexing='ij')
+
+    volume = np.zeros(size[::-1], dtype=np.float32)
+    volume[(x / 0.9) ** 2 + (y / 0.7) ** 2 < 1] = 1000
+
+    lungs = np.zeros(size[::-1], dtype=bool)
+    for center in (-0.38, 0.38):
+        lungs |= ((x - center) / 0.3) ** 2 + (y / 0.5) ** 2 + ((z + 0.05) / 0.85) ** 2 < 1
+    volume[lungs] = 150
+
+    # vessels: random points inside the lungs, blurred into blobs
+    vessels = np.zeros(size[::-1], dtype=np.float32)
+    candidates = np.flatnonzero(lungs)
+    vessels.flat[rng.choice(candidates, size=max(1, len(candidates) // 200), replace=False)] = 1
+    vessels = gaussian_filter(vessels, sigma=1.0)
+    volume[lungs] += 700 * vessels[lungs] / vessels.max()
+
+    volume = sitk.GetImageFromArray(volume.astype(np.int16))
+    mask = sitk.GetImageFromArray(lungs.astype(np.uint8))
+    for image in (volume, mask):
+        image.SetSpacing([float(value) for value in spacing])
+
+    return volume, mask
+
+def breathing_transform(image, magnitude=30.0, noise=2.0, grid_spacing=40.0, seed=0):
+    '''
+    Random smooth B-spline deformation with the magnitude of breathing motion. As elastix, the transform maps
+    the fixed (inhale) space to the moving (exhale) space. Its coefficients are a breathing field, a
+    displacement along the slice axis growing linearly from 0 at the last slice to magnitude at the first one
+    (the diaphragm) and an anterior-posterior contraction of 20% of it, plus gaussian noise.
+
+    Args:
+        image ('sitk.Image'): Image the transform is defined on.
+        magnitude ('float'): Largest displacement of the breathing field, in mm.
+        noise ('float'): Standard deviation of the random part of the coefficients, in mm.
+        grid_spacing ('float'): Control point spacing, in mm.
+        seed ('int'): Seed of the random part.
+
+    Returns:
+        transform ('sitk.BSplineTransform'): The deformation.
+    '''
+    import SimpleITK as sitk
+
+    extent = np.array(image.GetSize()) * np.array(image.GetSpacing())
+    mesh_size = [max(1, int(round(length / grid_spacing))) for length in extent]
+    transform = sitk.BSplineTransformInitializer(image, mesh_size, order=3)
+
+    # the control points in the index frame of the image, normalized to [0, 1]
+    grid = transform.GetCoefficientImages()[0]
+    grid_size = grid.GetSize()
+    # the coefficient buffers are in the x fastest order, as the arrays of SimpleITK (z, y, x)
+    grid_index = np.stack(np.meshgrid(*[np.arange(count) for count in grid_size[::-1]], indexing='ij'), axis=-1).reshape(-1, 3)[:, ::-1]
+    position = physical_to_index(image, index_to_physical(grid, grid_index)) / np.maximum(np.array(image.GetSize()) - 1, 1)
+
+    local = np.zeros((len(position), 3))
+    local[:, 2] = magnitude * (1 - np.clip(position[:, 2], 0, 1))
+    local[:, 1] = 0.2 * magnitude * (0.5 - position[:, 1])
+
+    # from the index axes to physical directions
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    displacement = local @ direction.T + np.random.default_rng(seed).normal(0, noise, size=local.shape)
+
+    transform.SetParameters([float(value) for value in displacement.T.ravel()])
+    return transform
+
+def min_jacobian_determinant(transform, image, shrink=4):
+    '''
+    Smallest Jacobian determinant of a transform on a coarse grid of an image, a value below 0 means the
+    deformation folds.
+    '''
+    import SimpleITK as sitk
+
+    size = [max(2, count // shrink) for count in image.GetSize()]
+    spacing = [length * count / new for length, count, new in zip(image.GetSpacing(), image.GetSize(), size)]
+    field = sitk.TransformToDisplacementField(transform, sitk.sitkVectorFloat64, size, image.GetOrigin(), spacing, image.GetDirection())
+    # the determinant is not defined on the border of the field
+    return float(sitk.GetArrayFromImage(sitk.DisplacementFieldJacobianDeterminant(field))[1:-1, 1:-1, 1:-1].min())
+
+def deform_pair(volume, transform, mask=None):
+    '''
+    Create the fixed (inhale) partner of a volume, fixed(x) = volume(transform(x)), so the volume is the moving
+    (exhale) image of the pair and the transform is the exact solution of the registration.
+
+    Args:
+        volume ('sitk.Image'): Source volume, the moving image.
+        transform ('sitk.Transform'): Fixed to moving transform.
+        mask ('sitk.Image'): Optional lung mask of the source volume, warped the same way (nearest neighbour).
+
+    Returns:
+        fixed ('sitk.Image'): Fixed volume, on the grid of the source volume.
+        fixed_mask ('sitk.Image'): Fixed lung mask, None without a mask.
+    '''
+    import SimpleITK as sitk
+
+    background = float(sitk.GetArrayViewFromImage(volume).min())
+    fixed = sitk.Resample(volume, volume, transform, sitk.sitkBSpline, background, volume.GetPixelID())
+    fixed_mask = sitk.Resample(mask, mask, transform, sitk.sitkNearestNeighbor, 0, mask.GetPixelID()) if mask is not None else None
+    return fixed, fixed_mask
+
+def sample_landmarks(transform, fixed, moving, count=300, fixed_mask=None, margin=2, seed=0):
+    '''
+    Pick landmarks on the voxels of the fixed image (inside its lung mask if given) and map them with the
+    transform, so the correspondences are exact. The indices are 0-based (x y z), the frame the keypoint files are
+    read in by the rest of the pipeline (transformix InputIndex and compute_landmark_TRE).
+
+    Args:
+        transform ('sitk.Transform'): Fixed to moving transform.
+        fixed ('sitk.Image'): Fixed volume.
+        moving ('sitk.Image'): Moving volume.
+        count ('int'): Number of landmarks.
+        fixed_mask ('sitk.Image'): Optional fixed lung mask.
+        margin ('int'): Landmarks are kept this many voxels away from the borders of both images.
+        seed ('int'): Seed of the landmark selection.
+
+    Returns:
+        fixed_points ('np.array'): Fixed landmarks (N, 3), integer indices.
+        moving_points ('np.array'): Moving landmarks (N, 3), continuous indices.
+    '''
+    import SimpleITK as sitk
+
+    size = np.array(fixed.GetSize())
+    if fixed_mask is not None:
+        z, y, x = np.nonzero(sitk.GetArrayViewFromImage(fixed_mask))
+        candidates = np.stack([x, y, z], axis=1)
+    else:
+        candidates = np.stack(np.meshgrid(*[np.arange(length) for length in size], indexing='ij'), axis=-1).reshape(-1, 3)
+
+    candidates = candidates[np.all((candidates >= margin) & (candidates < size - margin), axis=1)]
+    candidates = candidates[np.random.default_rng(seed).permutation(len(candidates))]
+
+    fixed_points, moving_points = [], []
+    moving_size = np.array(moving.GetSize())
+    for start in range(0, len(candidates), count):
+        chunk = candidates[start:start + count]
+        mapped = np.array([transform.TransformPoint(point) for point in index_to_physical(fixed, chunk).tolist()])
+        mapped = physical_to_index(moving, mapped)
+
+        # the landmarks moved out of the moving image are dropped
+        inside = np.all((mapped >= margin) & (mapped < moving_size - 1 - margin), axis=1)
+        fixed_points.append(chunk[inside])
+        moving_points.append(mapped[inside])
+        if sum(len(points) for points in fixed_points) >= count:
+            break
+
+    return np.concatenate(fixed_points)[:count], np.concatenate(moving_points)[:count]
@@ -0,0 +1,204 @@
+# plotting helpers of the notebooks, kept out of the modules used by the command line scripts so they do not load matplotlib
+import os
+import numpy as np
+import nibabel as nib
+import matplotlib.pyplot as plt
+from matplotlib.colors import LinearSegmentedColormap
+
+from .catalog import load_description
+from .results import connect, get_subject_results, ingest_csv_results, RESULTS_DB_FILENAME
+
+
+def display_two_volumes(volume1, volume2, title1, title2, slice=70):
+    '''
+    Display two volumes side by side.
+
+    Args:
+        volume1 (numpy array): first volume to be displayed
+        volume2 (numpy array): second volume to be displayed
+        title1 (str): title of the first volume
+        title2 (str): title of the second volume
+        slice (int): slice to be displayed
+
+    Returns:
+        None
+    '''
+    plt.figure(figsize=(9, 6))
+
+    plt.subplot(1, 2, 1)
+    plt.imshow(volume1[slice, :, :], cmap='gray') 
+    plt.title(title1)
+    plt.axis('off')
+
+    plt.subplot(1, 2, 2)
+    plt.imshow(volume2[slice, :, :], cmap='gray') 
+    plt.title(title2)
+    plt.axis('off')
+
+    plt.show()
+
+def display_volumes(*volumes, **titles_and_slices):
+    '''
+    Display multiple volumes side by side.
+
+    Args:
+        volumes (tuple of numpy arrays): volumes to be displayed
+        titles_and_slices (dict): titles and slices for each volume
+        
+    Returns:
+        None
+    '''
+    num_volumes = len(volumes)
+    
+    plt.figure(figsize=(6 * num_volumes, 6))
+
+    for i, volume in enumerate(volumes, start=1):
+        title = titles_and_slices.get(f'title{i}', f'Title {i}')
+        slice_val = titles_and_slices.get(f'slice{i}', 70)
+
+        plt.subplot(1, num_volumes, i)
+        plt.imshow(volume[slice_val, :, :], cmap='gray') #gray
+        plt.title(title)
+        plt.axis('off')
+
+    plt.show()
+
+def visualize_landmarks(slice_index=70, subject='copd1', split='train'):
+    '''
+    Visualize the landmarks on the reference image or a mask.
+    '''
+    # Define the paths
+    landmarks_path = os.path.join(os.getcwd(),f'../dataset/{split}/{subject}/{subject}_300_iBH_xyz_r1.txt')
+    reference_image_path = os.path.join(os.getcwd(),f'../dataset/{split}/{subject}/{subject}_iBHCT.nii.gz') # _lung
+    reference_mask_path = os.path.join(os.getcwd(),f'../dataset/{split}/{subject}/{subject}_iBHCT_lung.nii.gz') # _lung
+    # reference_mask_path = os.path.join(os.getcwd(),f'../dataset/segmentation_trails/mask1/train/{subject}_eBHCT_lung.nii.gz') # _lung
+
+    # -1 to match the MATLAB visualizer indexing result
+    slice_index = slice_index - 1
+
+    # the keypoint indices are 1-based as in the DIR-Lab files, unless description.json records another base
+    index_base = load_description(os.path.join(os.getcwd(), f'../dataset/{split}')).get(split, {}).get(subject, {}).get('index_base', 1)
+
+    # Load the reference image
+    nii_image = nib.load(reference_image_path)
+    reference_image = nii_image.get_fdata()
+
+    # Load the reference mask
+    nii_mask = nib.load(reference_mask_path)
+    reference_mask = nii_mask.get_fdata()
+
+    # transpose the axis to rotate for visualization
+    reference_image = reference_image.transpose(2, 1, 0)
+    reference_mask = reference_mask.transpose(2, 1, 0)
+    
+    # Load 3D landmarks from the file
+    landmarks_data = np.loadtxt(landmarks_path, skiprows=2)
+    slice_landmarsk = np.array([inner_list for inner_list in landmarks_data if inner_list[2] == slice_index + index_base])
+    
+    # Create a red-green colormap with opacity
+    cmap = LinearSegmentedColormap.from_list('red_green', ['red', 'green'], N=256)
+    
+    # Visualize a specific slice
+    plt.figure(figsize=(8, 8))
+    plt.imshow(reference_image[slice_index, :, :], cmap='gray')
+
+    # Overlay the mask with color on the landmarks
+    mask_overlay = np.ma.masked_where(reference_mask[slice_index, :, :] == 0, reference_mask[slice_index, :, :])
+    plt.imshow(mask_overlay, cmap=cmap, alpha=0.5)
+
+    if len(slice_landmarsk) > 0:
+            
+        # Extract x, y, z coordinates
+        x_coords = slice_landmarsk[:, 0].astype(int)
+        y_coords = slice_landmarsk[:, 1].astype(int)
+        z_coords = slice_landmarsk[:, 2].astype(int)
+
+        # Plot landmarks on the current slice
+        plt.scatter(x_coords, y_coords, c='b', marker='+', label=f'{landmarks_path.split("/")[-1].split(".txt")[0]} landmarks')
+
+    plt.legend()
+    plt.axis('off')
+    # plt.title(f"Slice {slice_index+1}")
+    plt.show()
+
+def plot_boxplot(experiment_name, output_dir, exclude=[], title="Boxplot", db_path=None, split='train'):
+    '''
+    Plot boxplot for the given data.
+
+    Args:
+        experiment_name (str): Name of the experiment.
+        output_dir (str): Path to the output directory.
+        exclude (list): List of columns to exclude from the boxplot.
+        title (str): Title of the plot.
+        db_path (str): Path to the results database, <output_dir>/results.sqlite by default.
+        split (str): Split of the csv reports imported when the experiment has no parameters.json manifest.
+
+    Note:
+        The dataframe holds the data in columns. Each column represents an experiment (single box plot) that we want to plot.
+        We add the data to specific column of the experiment in the datafraame.
+
+        Each row in the dataframe represents the result obtained from each subject in the experiment.
+
+        >> df.head()
+        >>          Par0003.affine  Par0003.bs-R1-fg  Par0003.bs-R6-ug  experiment_name
+        >> copd1    10.62             26.25              1.34            ..
+        >> copd2    10.07             21.45              2.68            ..
+        >> copd3    03.57             12.04              1.27            ..
+        >> copd4    07.48             29.45              1.53            ..
+
+        If we describe the dataframe, we get the following:
+
+        >> stats = df.describe()
+        >> stats
+        >>       Par0003.affine  Par0003.bs-R1-fg  Par0003.bs-R6-ug
+        >> count  4.000000        4.000000          4.000000
+        >> mean   7.935000        22.795000         1.705000
+        >> std    3.417692        7.221071          0.700713
+        >> min    3.570000        12.040000         1.270000
+        >> 25%    6.345000        19.522500         1.330000
+        >> 50%    8.775000        23.850000         1.435000
+        >> 75%    10.365000       27.122500         2.060000
+        >> max    10.620000       29.450000         2.680000
+
+    Returns:
+        None. The function generates and displays the box plot.
+    '''
+
+    # Get the data from the results database, the csv reports of the experiments evaluated before it existed are imported once
+    connection = connect(db_path or os.path.join(output_dir, RESULTS_DB_FILENAME))
+    results = get_subject_results(connection, experiment_name)
+
+    if results.empty:
+        ingest_csv_results(connection, output_dir, experiment_name, split=split)
+        results = get_subject_results(connection, experiment_name)
+
+    assert not results.empty, f"No results found for {experiment_name}"
+
+    # Remove the excluded columns
+    results = results[~results['reg_params_key'].isin(exclude)]
+
+    # Create a dataframe, a column per parameters key and a row per subject
+    df = results.pivot_table(index='sample_name', columns='reg_params_key', values='tre_mean')
+    columns = [f"{column} ({df[column].mean():.3f})" for column in df.columns]
+    df.columns = columns
+        
+    # Plot the boxplot
+    boxplot = df.boxplot(column=columns, rot=90)
+
+    # Get the lowest values for each column
+    lowest_values = df.mean()
+
+    # Get the column with the overall lowest minimum value
+    lowest_column = lowest_values.idxmin()
+
+    # Highlight the entire boxplot for the column with the lowest minimum value in red
+    position = columns.index(lowest_column) + 1
+
+    # 7 is the number of data that represents a single boxplot (divide len(boxplot.get_lines())//len(columns) to get the number of data per boxplot)
+    boxplot.get_lines()[position * 7 - 7].set(color='red', linewidth=3) 
+
+    # Set plot title
+    plt.title(title)
+
+    # Show the plot
+    plt.show()
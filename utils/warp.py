@@ -0,0 +1,277 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .elastix import read_parameter_file
+from .storage import output_exists
+
+# number of z slices of the output grid transformed at once, bounds the memory of the point arrays
+SLAB_SIZE = 8
+
+
+def _values(parameters, key, default=None):
+    return parameters.get(key, default)
+
+def _direction(parameters, key, dimension):
+    values = _values(parameters, key)
+    if not values:
+        return np.eye(dimension)
+    # elastix writes the direction cosines column by column
+    return np.array(values, dtype=np.float64).reshape(dimension, dimension).T
+
+def _euler_matrix(angles, compute_zyx=False):
+    '''
+    Rotation matrix of an itk Euler3DTransform, Rz Rx Ry (or Rz Ry Rx with ComputeZYX).
+    '''
+    rx, ry, rz = angles
+    cx, sx, cy, sy, cz, sz = np.cos(rx), np.sin(rx), np.cos(ry), np.sin(ry), np.cos(rz), np.sin(rz)
+    Rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    Ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    Rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return Rz @ Ry @ Rx if compute_zyx else Rz @ Rx @ Ry
+
+def _versor_matrix(versor):
+    '''
+    Rotation matrix of the right part (x, y, z) of a unit quaternion.
+    '''
+    x, y, z = versor
+    w = np.sqrt(max(0.0, 1.0 - (x * x + y * y + z * z)))
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+
+def _bspline_weights(u, order):
+    '''
+    Start index and weights of the B-spline basis functions of a given order around continuous indices u.
+    '''
+    start = np.floor(u - (order - 1) / 2.0).astype(np.int64)
+    weights = []
+    for k in range(order + 1):
+        x = np.abs(u - (start + k))
+        if order == 3:
+            w = np.where(x < 1, (4 - 6 * x ** 2 + 3 * x ** 3) / 6, np.where(x < 2, (2 - x) ** 3 / 6, 0))
+        elif order == 2:
+            w = np.where(x < 0.5, 0.75 - x ** 2, np.where(x < 1.5, (1.5 - x) ** 2 / 2, 0))
+        elif order == 1:
+            w = np.maximum(0, 1 - x)
+        else:
+            raise ValueError(f"BSpline order {order} is not supported")
+        weights.append(w)
+    return start, weights
+
+def read_transform(transform_path):
+    '''
+    Read an elastix TransformParameters file and the chain of its initial transforms.
+
+    Args:
+        transform_path ('str'): Path to the last TransformParameters file of the registration.
+
+    Returns:
+        transforms ('list'): Parameters of the transforms, the initial transform first.
+    '''
+    transforms = []
+    path = transform_path
+
+    while path and path != 'NoInitialTransform':
+        parameters = read_parameter_file(path)
+        transforms.insert(0, parameters)
+        path = _values(parameters, 'InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+
+        # the initial transforms are usually relative to the directory elastix ran from
+        if path != 'NoInitialTransform' and not output_exists(path):
+            sibling = os.path.join(os.path.dirname(transform_path), os.path.basename(path))
+            if not output_exists(sibling):
+                raise FileNotFoundError(f"Initial transform {path} of {transform_path} not found")
+            path = sibling
+
+    return transforms
+
+def _apply_single(parameters, points):
+    '''
+    Map fixed physical points (N, 3) to the moving space with a single elastix transform.
+    '''
+    name = _values(parameters, 'Transform', [''])[0]
+    values = np.array(_values(parameters, 'TransformParameters', []), dtype=np.float64)
+    dimension = points.shape[1]
+    center = np.array(_values(parameters, 'CenterOfRotationPoint', [0.0] * dimension), dtype=np.float64)
+
+    if name == 'TranslationTransform':
+        return points + values[:dimension]
+
+    if name == 'AffineTransform':
+        matrix = values[:dimension * dimension].reshape(dimension, dimension)
+        translation = values[dimension * dimension:]
+        return (points - center) @ matrix.T + center + translation
+
+    if name == 'EulerTransform':
+        compute_zyx = _values(parameters, 'ComputeZYX', ['false'])[0] == 'true'
+        matrix = _euler_matrix(values[:3], compute_zyx)
+        return (points - center) @ matrix.T + center + values[3:6]
+
+    if name == 'SimilarityTransform':
+        matrix = _versor_matrix(values[:3]) * values[6]
+        return (points - center) @ matrix.T + center + values[3:6]
+
+    if name in ('BSplineTransform', 'RecursiveBSplineTransform'):
+        order = int(_values(parameters, 'BSplineTransformSplineOrder', [3])[0])
+        grid_size = np.array(_values(parameters, 'GridSize'), dtype=np.int64)
+        grid_spacing = np.array(_values(parameters, 'GridSpacing'), dtype=np.float64)
+        grid_origin = np.array(_values(parameters, 'GridOrigin'), dtype=np.float64)
+        grid_direction = _direction(parameters, 'GridDirection', dimension)
+
+        # one coefficient image per dimension, x fastest
+        coefficients = values.reshape(dimension, *grid_size[::-1])
+
+        u = ((points - grid_origin) @ np.linalg.inv(grid_direction).T) / grid_spacing
+        start, weights = zip(*[_bspline_weights(u[:, axis], order) for axis in range(dimension)])
+
+        # outside the support of the control points grid the displacement is zero, as in itk
+        inside = np.all([(start[axis] >= 0) & (start[axis] + order < grid_size[axis]) for axis in range(dimension)], axis=0)
+
+        displacement = np.zeros_like(points)
+        for k in np.ndindex(*([order + 1] * dimension)):
+            weight = np.ones(len(points))
+            index = []
+            for axis in range(dimension):
+                weight = weight * weights[axis][k[axis]]
+                index.append(np.clip(start[axis] + k[axis], 0, grid_size[axis] - 1))
+            for axis in range(dimension):
+                displacement[:, axis] += weight * coefficients[axis][tuple(index[::-1])]
+
+        return points + displacement * inside[:, None]
+
+    raise ValueError(f"Transform {name} is not supported")
+
+def transform_points(transforms, points):
+    '''
+    Map fixed physical points to the moving space with a chain of elastix transforms.
+
+    Args:
+        transforms ('list'): Transforms from read_transform, the initial transform first.
+        points ('np.array'): Physical points (N, 3).
+
+    Returns:
+        points ('np.array'): Transformed physical points (N, 3).
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    result = points
+
+    for parameters in transforms:
+        how = _values(parameters, 'HowToCombineTransforms', ['Compose'])[0]
+        if how == 'Compose' or result is points:
+            result = _apply_single(parameters, result)
+        else:
+            # additive combination, T(x) = T0(x) + T1(x) - x
+            result = result + _apply_single(parameters, points) - points
+
+    return result
+
+def _output_grid(parameters):
+    dimension = len(_values(parameters, 'Size'))
+    return {
+        'size': np.array(_values(parameters, 'Size'), dtype=np.int64),
+        'spacing': np.array(_values(parameters, 'Spacing'), dtype=np.float64),
+        'origin': np.array(_values(parameters, 'Origin'), dtype=np.float64),
+        'direction': _direction(parameters, 'Direction', dimension),
+    }
+
+def warp_labels(transform_path, label_images, slab_size=SLAB_SIZE, num_threads=os.cpu_count()):
+    '''
+    Warp label maps (moving space) onto the fixed grid of an elastix registration with nearest neighbour
+    lookup, as transformix does with FinalBSplineInterpolationOrder 0. The deformation is evaluated once
+    for all the label maps, slab by slab along z, with the slabs spread over several threads.
+
+    Args:
+        transform_path ('str'): Path to the last TransformParameters file of the registration.
+        label_images ('list'): SimpleITK label images in the moving space, all on the same grid.
+        slab_size ('int'): Number of z slices transformed at once.
+        num_threads ('int'): Number of slabs processed in parallel.
+
+    Returns:
+        warped ('list'): SimpleITK label images on the fixed grid, with the dtype of the inputs.
+    '''
+    import SimpleITK as sitk
+
+    transforms = read_transform(transform_path)
+    grid = _output_grid(transforms[-1])
+    default_value = _values(transforms[-1], 'DefaultPixelValue', [0])[0]
+    size_x, size_y, size_z = grid['size']
+
+    # the moving grid, physical point -> continuous index
+    moving = label_images[0]
+    moving_origin = np.array(moving.GetOrigin())
+    moving_spacing = np.array(moving.GetSpacing())
+    moving_inverse = np.linalg.inv(np.array(moving.GetDirection()).reshape(3, 3))
+    moving_size = np.array(moving.GetSize())
+
+    # arrays are (z, y, x)
+    arrays = [sitk.GetArrayViewFromImage(image) for image in label_images]
+    outputs = [np.full((size_z, size_y, size_x), default_value, dtype=array.dtype) for array in arrays]
+
+    # physical points of a slab, p = origin + direction (index * spacing)
+    index_y, index_x = np.meshgrid(np.arange(size_y), np.arange(size_x), indexing='ij')
+    plane = np.stack([index_x.ravel(), index_y.ravel()], axis=1).astype(np.float64)
+
+    def process(z_start):
+        z_stop = min(z_start + slab_size, size_z)
+        z = np.repeat(np.arange(z_start, z_stop, dtype=np.float64), len(plane))
+        index = np.column_stack([np.tile(plane, (z_stop - z_start, 1)), z])
+        points = grid['origin'] + (index * grid['spacing']) @ grid['direction'].T
+
+        mapped = transform_points(transforms, points)
+        moving_index = np.rint(((mapped - moving_origin) @ moving_inverse.T) / moving_spacing).astype(np.int64)
+        inside = np.all((moving_index >= 0) & (moving_index < moving_size), axis=1)
+        x, y, z = moving_index[inside].T
+
+        for array, output in zip(arrays, outputs):
+            slab = output[z_start:z_stop].reshape(-1)
+            slab[inside] = array[z, y, x]
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(process, range(0, size_z, slab_size)))
+
+    warped = []
+    for output in outputs:
+        image = sitk.GetImageFromArray(output)
+        image.SetOrigin(tuple(grid['origin']))
+        image.SetSpacing(tuple(grid['spacing']))
+        image.SetDirection(tuple(grid['direction'].ravel()))
+        warped.append(image)
+
+    return warped
+
+def label_propagation_resample(transform_path, input_labels, output_dir, create_dir_callback, slab_size=SLAB_SIZE, num_threads=os.cpu_count()):
+    '''
+    Apply label propagation in-process, the replacement of label_propagation_transformix. The transform
+    file is not edited and no transformix process is started.
+
+    Args:
+        transform_path ('str'): Path to the transformation parameters.
+        input_labels ('list'): Paths to the input label images, in the moving space.
+        output_dir ('str'): Directory the warped labels are written to, with the names of the inputs.
+        create_dir_callback ('function'): Callback function to create directories.
+        slab_size ('int'): Number of z slices transformed at once.
+        num_threads ('int'): Number of slabs processed in parallel.
+
+    Returns:
+        output_paths ('list'): Paths to the warped label images.
+    '''
+    import SimpleITK as sitk
+
+    create_dir_callback(output_dir)
+
+    label_images = [sitk.ReadImage(path) for path in input_labels]
+    warped = warp_labels(transform_path, label_images, slab_size=slab_size, num_threads=num_threads)
+
+    output_paths = []
+    for path, image in zip(input_labels, warped):
+        output_path = os.path.join(output_dir, os.path.basename(path)).replace('\\', '/')
+        # written under a .tmp name first (the extension is kept for SimpleITK), compact_outputs.py never packs a partial label
+        name, _, extension = os.path.basename(path).partition('.')
+        tmp_path = os.path.join(output_dir, f'{name}.{os.getpid()}.tmp.{extension}')
+        sitk.WriteImage(image, tmp_path, useCompression=True)
+        os.replace(tmp_path, output_path)
+        output_paths.append(output_path)
+
+    return output_paths
@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import hashlib
+import threading
+
+from .executor import run_command
+from .checkpoint import run_resumable
+
+# a job file moves pending -> claimed -> done/failed, every move is an atomic rename
+QUEUE_STATES = ['pending', 'claimed', 'done', 'failed']
+
+# a claimed job whose heartbeat is older than this (seconds) belongs to a lost worker
+STALE_TIMEOUT = 300
+
+# seconds between two heartbeats of a running job
+HEARTBEAT_INTERVAL = 30
+
+# a job is failed for good after this many claims
+MAX_ATTEMPTS = 3
+
+
+def _job_path(queue_dir, state, job_id):
+    return os.path.join(queue_dir, state, f'{job_id}.json')
+
+def _write_json(path, data):
+    '''
+    Write a json file atomically, readers never see a partially written job.
+    '''
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=4)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+def _staging_path(queue_dir, job_id):
+    # a job being claimed, not a .json file so requeue_stale_jobs and queue_status do not see it as claimed yet
+    return f"{_job_path(queue_dir, 'claimed', job_id)}.{socket.gethostname()}.{os.getpid()}.claiming"
+
+def _is_owner(path, job):
+    '''
+    Check that a claimed job file still holds the claim of this worker, and not a later claim of the same job.
+    '''
+    try:
+        claimed = _read_json(path)
+    except (FileNotFoundError, ValueError):
+        return False
+    return claimed.get('worker_id') == job.get('worker_id') and claimed.get('claimed_at') == job.get('claimed_at')
+
+def create_queue(queue_dir):
+    '''
+    Create the state directories of a queue (pending, claimed, done, failed).
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+
+    Returns:
+        None
+    '''
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+def make_job(kind, depends_on=None, **spec):
+    '''
+    Create a job spec. The job id is a hash of the spec, submitting the same job twice is a no-op.
+
+    Args:
+        kind ('str'): 'register' (fixed_path, moving_path, parameter_files, output_dir, and optionally fixed_mask,
+            moving_mask, initial_transform, input_points, points_output_dir, elastix, transformix) or
+            'command' (commands, a list of command lines run in order).
+        depends_on ('list'): Optional job ids that have to be done before this job is claimed.
+        **spec: Job specific fields.
+
+    Returns:
+        job ('dict'): Job spec.
+    '''
+    job = {'kind': kind, 'depends_on': depends_on or [], **spec}
+    job['job_id'] = f"{kind}-{hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()[:16]}"
+    job['attempts'] = 0
+    return job
+
+def submit_job(queue_dir, job):
+    '''
+    Add a job to the pending jobs of a queue, unless a job with the same id is already in the queue.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+        job ('dict'): Job spec from make_job.
+
+    Returns:
+        submitted ('bool'): False if the job was already in the queue.
+    '''
+    create_queue(queue_dir)
+
+    if any(os.path.exists(_job_path(queue_dir, state, job['job_id'])) for state in QUEUE_STATES):
+        return False
+
+    _write_json(_job_path(queue_dir, 'pending', job['job_id']), job)
+    return True
+
+def claim_job(queue_dir, worker_id):
+    '''
+    Claim the first pending job whose dependencies are done. The claim is an atomic rename, so when
+    several workers race for a job only one of them gets it. The job is renamed to a staging file, written
+    with the claim and only then renamed into claimed, so requeue_stale_jobs never sees it with the old
+    mtime or without its worker id.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+        worker_id ('str'): Id of the claiming worker.
+
+    Returns:
+        job ('dict'): The claimed job, None if no job can be claimed.
+    '''
+    pending_dir = os.path.join(queue_dir, 'pending')
+
+    for filename in sorted(os.listdir(pending_dir)):
+        if not filename.endswith('.json'):
+            continue
+
+        job_id = filename[:-len('.json')]
+        pending_path = _job_path(queue_dir, 'pending', job_id)
+        claimed_path = _job_path(queue_dir, 'claimed', job_id)
+
+        try:
+            job = _read_json(pending_path)
+        except (FileNotFoundError, ValueError):
+            continue
+
+        # a job can never run once one of its dependencies failed for good
+        if any(os.path.exists(_job_path(queue_dir, 'failed', dependency)) for dependency in job.get('depends_on', [])):
+            try:
+                os.rename(pending_path, _job_path(queue_dir, 'failed', job_id))
+            except OSError:
+                pass
+            continue
+
+        if not all(os.path.exists(_job_path(queue_dir, 'done', dependency)) for dependency in job.get('depends_on', [])):
+            continue
+
+        # the staging file keeps a fresh mtime from the rename on, a lost claim is then requeued after the timeout
+        staging_path = _staging_path(queue_dir, job_id)
+        try:
+            os.utime(pending_path)
+            os.rename(pending_path, staging_path)
+        except OSError:
+            # another worker claimed it first
+            continue
+
+        job['attempts'] = job.get('attempts', 0) + 1
+        job['worker_id'] = worker_id
+        job['claimed_at'] = time.time()
+        _write_json(staging_path, job)
+        os.rename(staging_path, claimed_path)
+        return job
+
+    return None
+
+def heartbeat(queue_dir, job_id):
+    '''
+    Mark a claimed job as alive by touching its file.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+        job_id ('str'): Id of the claimed job.
+
+    Returns:
+        None
+    '''
+    try:
+        os.utime(_job_path(queue_dir, 'claimed', job_id))
+    except FileNotFoundError:
+        pass
+
+def finish_job(queue_dir, job, results, success):
+    '''
+    Move a claimed job to done, or back to pending (failed after MAX_ATTEMPTS claims) if it failed. Only the
+    worker holding the claim moves the job.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+        job ('dict'): The claimed job.
+        results ('list'): Results of the job commands.
+        success ('bool'): If all the commands succeeded.
+
+    Returns:
+        state ('str'): The new state of the job, None if the job was requeued and claimed by another worker.
+    '''
+    job['results'] = results
+    job['finished_at'] = time.time()
+
+    if success:
+        state = 'done'
+    elif job['attempts'] < job.get('max_attempts', MAX_ATTEMPTS):
+        state = 'pending'
+    else:
+        state = 'failed'
+
+    claimed_path = _job_path(queue_dir, 'claimed', job['job_id'])
+
+    # the job was requeued while this worker was considered lost, take it back from pending unless another
+    # worker claimed it again in the meantime, that worker then finishes it
+    if not _is_owner(claimed_path, job):
+        staging_path = _staging_path(queue_dir, job['job_id'])
+        try:
+            os.utime(_job_path(queue_dir, 'pending', job['job_id']))
+            os.rename(_job_path(queue_dir, 'pending', job['job_id']), staging_path)
+        except OSError:
+            return None
+        _write_json(staging_path, job)
+        os.replace(staging_path, _job_path(queue_dir, state, job['job_id']))
+        return state
+
+    _write_json(claimed_path, job)
+    os.replace(claimed_path, _job_path(queue_dir, state, job['job_id']))
+    return state
+
+def requeue_stale_jobs(queue_dir, stale_timeout=STALE_TIMEOUT):
+    '''
+    Move the claimed jobs of lost workers (no heartbeat for stale_timeout seconds) back to pending, and the
+    jobs a lost worker was claiming.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+        stale_timeout ('float'): Seconds without heartbeat after which a worker is considered lost.
+
+    Returns:
+        requeued ('list'): Ids of the requeued jobs.
+    '''
+    requeued = []
+    claimed_dir = os.path.join(queue_dir, 'claimed')
+
+    for filename in sorted(os.listdir(claimed_dir)):
+        if not filename.endswith(('.json', '.claiming')):
+            continue
+
+        job_id = filename.split('.json')[0]
+        claimed_path = os.path.join(claimed_dir, filename)
+        try:
+            if time.time() - os.path.getmtime(claimed_path) < stale_timeout:
+                continue
+            os.rename(claimed_path, _job_path(queue_dir, 'pending', job_id))
+            requeued.append(job_id)
+        except OSError:
+            # finished, or requeued by another worker, in the meantime
+            continue
+
+    return requeued
+
+def queue_status(queue_dir):
+    '''
+    Count the jobs of a queue per state.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+
+    Returns:
+        counts ('dict'): State -> number of jobs.
+    '''
+    return {
+        state: len([filename for filename in os.listdir(os.path.join(queue_dir, state)) if filename.endswith('.json')])
+        for state in QUEUE_STATES}
+
+def job_commands(job):
+    '''
+    Get the command lines of a job.
+
+    Args:
+        job ('dict'): Job spec.
+
+    Returns:
+        commands ('list'): Command lines, run in order.
+    '''
+    if job['kind'] == 'command':
+        return list(job['commands'])
+
+    if job['kind'] != 'register':
+        raise ValueError(f"Unknown job kind: {job['kind']}")
+
+    elastix = job.get('elastix', 'elastix')
+    command = f'{elastix} -f "{job["fixed_path"]}" -m "{job["moving_path"]}"'
+    if job.get('fixed_mask'):
+        command += f' -fMask "{job["fixed_mask"]}"'
+    if job.get('moving_mask'):
+        command += f' -mMask "{job["moving_mask"]}"'
+    command += ''.join(f' -p "{path}"' for path in job['parameter_files'])
+    if job.get('initial_transform'):
+        command += f' -t0 "{job["initial_transform"]}"'
+    command += f' -out "{job["output_dir"]}"'
+    commands = [command]
+
+    if job.get('input_points'):
+        transformix = job.get('transformix', 'transformix')
+        transform_path = f"{job['output_dir']}/TransformParameters.{len(job['parameter_files']) - 1}.txt"
+        commands.append(f'{transformix} -def "{job["input_points"]}" -tp "{transform_path}" -out "{job["points_output_dir"]}"')
+
+    return commands
+
+def run_job(job, log_dir=None, resume=True):
+    '''
+    Run the commands of a job in order, stopping at the first failure.
+
+    Args:
+        job ('dict'): Job spec.
+        log_dir ('str'): Optional dir the output of every command is written to.
+        resume ('bool'): If True, a registration interrupted on an earlier attempt (e.g. a preempted worker)
+            resumes from its checkpoints (see utils.checkpoint).
+
+    Returns:
+        results ('list'): run_command results without the command output.
+        success ('bool'): If all the commands succeeded.
+    '''
+    for directory in [job.get('output_dir'), job.get('points_output_dir'), log_dir]:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    results = []
+    for idx, command in enumerate(job_commands(job)):
+        log_path = os.path.join(log_dir, f"{job['job_id']}.{idx}.log") if log_dir else None
+        result = asyncio.run((run_resumable if resume else run_command)(command, log_path=log_path))
+        results.append(result)
+        if result['returncode'] != 0:
+            return results, False
+
+    return results, True
+
+def run_worker(queue_dir, worker_id=None, log_dir=None, poll_interval=10, exit_when_empty=False,
+               heartbeat_interval=HEARTBEAT_INTERVAL, stale_timeout=STALE_TIMEOUT, resume=True):
+    '''
+    Pull and run jobs from a shared queue until it is empty (or forever). Any number of workers, on any
+    number of hosts sharing the queue directory, can run at once.
+
+    Args:
+        queue_dir ('str'): Shared queue directory.
+        worker_id ('str'): Id of the worker, <host>:<pid> by default.
+        log_dir ('str'): Optional dir the output of every command is written to.
+        poll_interval ('float'): Seconds to wait when no job can be claimed.
+        exit_when_empty ('bool'): If True, return when no job is pending or claimed.
+        heartbeat_interval ('float'): Seconds between two heartbeats of the running job.
+        stale_timeout ('float'): Seconds without heartbeat after which a claimed job is requeued.
+        resume ('bool'): If True, the registrations of requeued jobs resume from their checkpoints.
+
+    Returns:
+        processed ('dict'): Job id -> final state of the jobs run by this worker.
+    '''
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    create_queue(queue_dir)
+    processed = {}
+
+    while True:
+        requeue_stale_jobs(queue_dir, stale_timeout)
+        job = claim_job(queue_dir, worker_id)
+
+        if job is None:
+            status = queue_status(queue_dir)
+            if exit_when_empty and status['pending'] == 0 and status['claimed'] == 0:
+                return processed
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{worker_id}] Running {job['job_id']} (attempt {job['attempts']})", file=sys.stderr)
+
+        # the heartbeat runs in the background while the job commands are running
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(heartbeat_interval):
+                heartbeat(queue_dir, job['job_id'])
+        beat_thread = threading.Thread(target=beat, daemon=True)
+        beat_thread.start()
+
+        try:
+            results, success = run_job(job, log_dir=log_dir, resume=resume)
+        except Exception as error:
+            results, success = [{'error': repr(error)}], False
+        finally:
+            stop.set()
+            beat_thread.join()
+
+        state = finish_job(queue_dir, job, results, success)
+        if state is None:
+            print(f"[{worker_id}] {job['job_id']} was claimed again by another worker, its results are dropped", file=sys.stderr)
+            continue
+        processed[job['job_id']] = state
+        print(f"[{worker_id}] {job['job_id']} -> {state}", file=sys.stderr)
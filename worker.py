@@ -0,0 +1,33 @@
+import argparse
+
+from utils.logger import logger
+from utils.workqueue import run_worker, queue_status, STALE_TIMEOUT, HEARTBEAT_INTERVAL
+
+if __name__ == "__main__":
+    # optional arguments from the command line
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--queue_dir', type=str, required=True, help='shared queue directory to pull the jobs from')
+    parser.add_argument('--worker_id', type=str, default=None, help='worker id, <host>:<pid> by default')
+    parser.add_argument('--log_dir', type=str, default=None, help='dir the output of every command is written to')
+    parser.add_argument('--poll_interval', type=float, default=10, help='seconds to wait when no job can be claimed')
+    parser.add_argument('--heartbeat_interval', type=float, default=HEARTBEAT_INTERVAL, help='seconds between two heartbeats of the running job')
+    parser.add_argument('--stale_timeout', type=float, default=STALE_TIMEOUT, help='seconds without heartbeat after which a claimed job is requeued')
+    parser.add_argument("--exit_when_empty", action='store_true', help='if True, the worker stops when no job is pending or running.')
+    parser.add_argument("--no_resume", action='store_true', help='if True, the registrations of requeued jobs start over instead of resuming from their last finished resolution.')
+
+    # parse the arguments
+    args = parser.parse_args()
+
+    processed = run_worker(
+        args.queue_dir,
+        worker_id=args.worker_id,
+        log_dir=args.log_dir,
+        poll_interval=args.poll_interval,
+        exit_when_empty=args.exit_when_empty,
+        heartbeat_interval=args.heartbeat_interval,
+        stale_timeout=args.stale_timeout,
+        resume=not args.no_resume)
+
+    logger.info(f"Processed {len(processed)} jobs: {processed}")
+    logger.info(f"Queue status: {queue_status(args.queue_dir)}")